@@ -4,8 +4,22 @@ import plotly.express as px
 from supabase import create_client
 from streamlit_cookies_controller import CookieController
 import io
+import os
 import datetime
-import json
+import time
+import cProfile
+import pstats
+import marshal
+import expense_core
+from expense_core import (
+    pa, CallLog, RerunProfiler, latency_summary, metrics, match_memo, record_import, track_session_memory, cached, invalidate, data_version, get_expenses, load_expenses, get_list, slice_period, filter_mask, dashboard_totals, changed_rows,
+    insert_expenses, upsert_expenses, delete_expenses, update_expenses_by_ids, move_to_trash,
+    load_trash, restore_from_trash, empty_trash, save_list,
+    save_rules_full, add_rules, delete_rules, get_rules, analyze_rules, learn_rules, parse_statement, fill_from_rules, drop_existing, reapply_rules,
+    RULE_LABEL_COLS, RULE_KIND_LABELS, make_keyword, normalize_keyword, invalid_keywords, changed_rule_keywords, rows_for_keywords, mark_rules_applied, flush_rule_hits,
+    format_timings, read_backup_header, iter_backup_tables, verify_backup, check_restore_mode, restore_backup,
+    user_backup_dir, load_manifest, create_saved_backup, replay_backup_chain
+)
 
 # --- CONFIGURATION ---
 DEFAULT_CATEGORIES = [
@@ -19,6 +33,8 @@ DEFAULT_SUBCATS = [
 ]
 DEFAULT_PEOPLE = ['Family', 'Partner', 'Business']
 
+EDITOR_PAGE_SIZES = [100, 250, 500, 1000]
+
 DEFAULT_RULES = {
     "uber": {"name": "Uber Ride", "category": "Transport", "subcategory": "Uber", "person": "Family"}, 
     "starbucks": {"name": "Starbucks Coffee", "category": "Dining", "subcategory": "Coffee", "person": "Family"},
@@ -29,13 +45,32 @@ DEFAULT_RULES = {
 COOKIE_NAME = "expense_tracker_auth"
 COOKIE_EXPIRY_DAYS = 30
 
+# Supabase clients kept for recently active users; older ones are dropped and recreated on demand
+SUPABASE_CLIENT_CACHE_SIZE = 32
+
 st.set_page_config(page_title="Cloud Expense Tracker", layout="wide", page_icon="💳")
 
+# --- METRICS ---
+# Prometheus-style metrics for the whole server; exported when EXPENSE_METRICS_PORT/EXPENSE_METRICS_FILE is set
+rerun_started = time.perf_counter()
+expense_core.start_metrics_exporters()
+
+# --- PROFILING (toggled in Settings) ---
+# Sections are timed between profiler.mark() calls; "🧪 cProfile Next Rerun" profiles one whole rerun
+profiler = st.session_state.setdefault('profiler', RerunProfiler())
+profiler.enabled = st.session_state.get('profiling', False)
+profiler.start_run()
+rerun_cprofile = None
+if st.session_state.pop('cprofile_next_rerun', False):
+    rerun_cprofile = cProfile.Profile()
+    rerun_cprofile.enable()
+
 controller = CookieController()
 
 # ============================================
 # 1. AUTHENTICATION WITH COOKIES
 # ============================================
+profiler.mark("Auth")
 def check_password():
     try:
         saved_cookie = controller.get(COOKIE_NAME)
@@ -102,6 +137,7 @@ if not check_password():
 # ============================================
 # 1.5 LICENSE CHECK
 # ============================================
+profiler.mark("License")
 def check_license():
     user = st.session_state["current_user"]
     
@@ -154,6 +190,7 @@ if not check_license():
 # ============================================
 # 2. SUPABASE CONNECTION
 # ============================================
+profiler.mark("Connect")
 current_user = st.session_state["current_user"]
 
 if "supabase" in st.secrets and f"{current_user}_url" in st.secrets["supabase"]:
@@ -168,7 +205,7 @@ if not db_connected:
     st.error(f"⚠️ No database configured for '{current_user}'.")
     st.stop()
 
-@st.cache_resource
+@st.cache_resource(max_entries=SUPABASE_CLIENT_CACHE_SIZE, ttl=datetime.timedelta(hours=12))
 def get_supabase_client(url, key, user):
     """Create Supabase client. User param ensures cache is per-user."""
     return create_client(url, key)
@@ -178,219 +215,30 @@ sb = get_supabase_client(sb_url, sb_key, current_user)
 # ============================================
 # 3. DATA ACCESS FUNCTIONS
 # ============================================
-EXP_COLS = {
-    'date': 'Date', 'description': 'Description', 'amount': 'Amount',
-    'name': 'Name', 'category': 'Category', 'subcategory': 'SubCategory', 
-    'source': 'Source', 'person': 'Person', 'locked': 'Locked'
-}
-EXP_COLS_REV = {v: k for k, v in EXP_COLS.items()}
-
-RULES_COLS = {
-    'keyword': 'Keyword', 'name': 'Name', 'category': 'Category',
-    'subcategory': 'SubCategory', 'person': 'Person', 'amount': 'Amount'
-}
-RULES_COLS_REV = {v: k for k, v in RULES_COLS.items()}
-
-def prepare_records(df):
-    records = []
-    for _, row in df.iterrows():
-        record = {}
-        for col, val in row.items():
-            if isinstance(val, bool):
-                record[col] = val
-            elif pd.isna(val):
-                record[col] = None
-            elif isinstance(val, (pd.Timestamp, datetime.datetime)):
-                record[col] = val.strftime('%Y-%m-%d')
-            elif isinstance(val, datetime.date):
-                record[col] = val.strftime('%Y-%m-%d')
-            elif hasattr(val, 'item'):
-                record[col] = val.item()
-            else:
-                record[col] = val
-        records.append(record)
-    return records
-
-def load_expenses():
-    try:
-        resp = sb.table("expenses").select("*").execute()
-        if resp.data:
-            df = pd.DataFrame(resp.data)
-            df = df.rename(columns=EXP_COLS)
-            return df
-        return pd.DataFrame(columns=['id'] + list(EXP_COLS.values()))
-    except Exception as e:
-        st.error(f"Error loading expenses: {e}")
-        return pd.DataFrame(columns=['id'] + list(EXP_COLS.values()))
-
-def insert_expenses(df):
-    df_save = df.rename(columns=EXP_COLS_REV)
-    if 'id' in df_save.columns:
-        df_save = df_save.drop(columns=['id'])
-    valid_cols = list(EXP_COLS_REV.values())
-    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
-    records = prepare_records(df_save)
-    if records:
-        sb.table("expenses").insert(records).execute()
-
-def upsert_expenses(df):
-    df_save = df.rename(columns=EXP_COLS_REV)
-    valid_cols = ['id'] + list(EXP_COLS_REV.values())
-    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
-    df_save['id'] = df_save['id'].astype(int)
-    records = prepare_records(df_save)
-    if records:
-        sb.table("expenses").upsert(records).execute()
-
-def delete_expenses(ids):
-    for id_val in ids:
-        sb.table("expenses").delete().eq("id", int(id_val)).execute()
-
-def move_to_trash(df):
-    df_save = df.copy()
-    rename_map = {col: EXP_COLS_REV[col] for col in df_save.columns if col in EXP_COLS_REV}
-    df_save = df_save.rename(columns=rename_map)
-    
-    if 'id' in df_save.columns:
-        df_save['original_id'] = df_save['id']
-        df_save = df_save.drop(columns=['id'])
-    
-    cols_to_remove = ['Delete', 'delete', 'Create Rule', 'create rule', 'Include Amt', 'include amt']
-    for col in cols_to_remove:
-        if col in df_save.columns:
-            df_save = df_save.drop(columns=[col])
-    
-    valid_cols = ['original_id', 'date', 'description', 'amount', 'name', 'category', 'subcategory', 'source', 'person', 'locked']
-    df_save = df_save[[c for c in df_save.columns if c.lower() in valid_cols]]
-    
-    records = prepare_records(df_save)
-    if records:
-        sb.table("deleted_expenses").insert(records).execute()
-
-def load_trash():
-    try:
-        resp = sb.table("deleted_expenses").select("*").order("deleted_at", desc=True).execute()
-        if resp.data:
-            df = pd.DataFrame(resp.data)
-            col_mapping = {
-                'date': 'Date', 'description': 'Description', 'amount': 'Amount',
-                'name': 'Name', 'category': 'Category', 'subcategory': 'SubCategory',
-                'source': 'Source', 'person': 'Person', 'locked': 'Locked',
-                'deleted_at': 'Deleted At', 'original_id': 'Original ID'
-            }
-            df = df.rename(columns=col_mapping)
-            return df
-        return pd.DataFrame()
-    except:
-        return pd.DataFrame()
-
-def restore_from_trash(ids):
-    restored_count = 0
-    for trash_id in ids:
-        try:
-            resp = sb.table("deleted_expenses").select("*").eq("id", int(trash_id)).execute()
-            if resp.data:
-                item = resp.data[0]
-                restore_item = {k: v for k, v in item.items() if k not in ['id', 'original_id', 'deleted_at']}
-                sb.table("expenses").insert(restore_item).execute()
-                sb.table("deleted_expenses").delete().eq("id", int(trash_id)).execute()
-                restored_count += 1
-        except Exception as e:
-            st.error(f"Error restoring item {trash_id}: {e}")
-    return restored_count
-
-def empty_trash():
-    try:
-        sb.table("deleted_expenses").delete().gte("id", 0).execute()
-    except Exception as e:
-        st.error(f"Error emptying trash: {e}")
-
-def load_list(table_name):
-    try:
-        resp = sb.table(table_name).select("name").execute()
-        if resp.data:
-            return sorted([r['name'] for r in resp.data if r.get('name')])
-        return []
-    except Exception as e:
-        st.error(f"⚠️ Failed to load {table_name}: {e}")
-        return None
-
-def save_list(table_name, items):
-    try:
-        sb.table(table_name).delete().gte("id", 0).execute()
-        if items:
-            sb.table(table_name).insert([{"name": item} for item in items if item]).execute()
-    except Exception as e:
-        st.error(f"Error saving {table_name}: {e}")
-
-def load_rules():
-    try:
-        resp = sb.table("rules").select("*").execute()
-        if resp.data:
-            df = pd.DataFrame(resp.data)
-            df = df.rename(columns=RULES_COLS)
-            return df
-        return pd.DataFrame(columns=['id'] + list(RULES_COLS.values()))
-    except:
-        return pd.DataFrame(columns=['id'] + list(RULES_COLS.values()))
-
-def save_rules_full(df):
-    try:
-        sb.table("rules").delete().gte("id", 0).execute()
-        df_save = df.rename(columns=RULES_COLS_REV)
-        if 'id' in df_save.columns:
-            df_save = df_save.drop(columns=['id'])
-        valid_cols = list(RULES_COLS_REV.values())
-        df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
-        records = prepare_records(df_save)
-        if records:
-            sb.table("rules").insert(records).execute()
-    except Exception as e:
-        st.error(f"Error saving rules: {e}")
-
-def add_rules(new_rules_df):
-    df_save = new_rules_df.rename(columns=RULES_COLS_REV)
-    if 'id' in df_save.columns:
-        df_save = df_save.drop(columns=['id'])
-    valid_cols = list(RULES_COLS_REV.values())
-    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
-    records = prepare_records(df_save)
-    if records:
-        sb.table("rules").upsert(records, on_conflict="keyword").execute()
-
-def get_match(description, amount, rules_df):
-    desc = str(description).lower()
-    if rules_df.empty:
-        return None, None, None, None
-    
-    rules_sorted = rules_df.copy()
-    rules_sorted['_kw_len'] = rules_sorted['Keyword'].str.len()
-    rules_sorted = rules_sorted.sort_values('_kw_len', ascending=False)
-    
-    for _, row in rules_sorted.iterrows():
-        if str(row['Keyword']).lower() in desc:
-            rule_amount = row.get('Amount')
-            if pd.notna(rule_amount) and rule_amount is not None:
-                if amount is None or abs(float(amount) - float(rule_amount)) > 0.01:
-                    continue
-            return (
-                row.get('Name', '') if pd.notna(row.get('Name')) else '',
-                row['Category'], 
-                row.get('SubCategory', '') if pd.notna(row.get('SubCategory')) else '', 
-                row.get('Person', 'Family') if pd.notna(row.get('Person')) else 'Family'
-            )
-    return None, None, None, None
+# Data access, rules and backups live in expense_core so the CLI can share them.
+# Every Supabase request is timed into this session's call log (see the ⚡ Performance panel).
+supabase_calls = st.session_state.setdefault('supabase_calls', CallLog())
+supabase_calls.new_run()
+expense_core.use_client(sb, current_user, supabase_calls, profiler)
 
 # ============================================
 # 4. LOAD ALL DATA
 # ============================================
+profiler.mark("Load data")
 try:
-    df_history = load_expenses()
-    df_rules = load_rules()
+    # Shared with this user's other tabs through the process-wide cache (expense_core.data_cache)
+    df_history = get_expenses()
+    
+    # A write from any tab bumps the data version; re-seed this session's lists when it moves
+    if st.session_state.get('data_version') != data_version():
+        for list_key in ('categories', 'subcategories', 'people'):
+            st.session_state.pop(list_key, None)
+        st.session_state['data_version'] = data_version()
     
-    loaded_cats = load_list("categories")
-    loaded_subcats = load_list("subcategories")
-    loaded_people = load_list("people")
+    # Lists only seed session state once; rules and trash load lazily when a panel needs them
+    loaded_cats = get_list("categories") if 'categories' not in st.session_state else None
+    loaded_subcats = get_list("subcategories") if 'subcategories' not in st.session_state else None
+    loaded_people = get_list("people") if 'people' not in st.session_state else None
     
     # If load failed (returned None), use session state or empty list - NEVER auto-populate defaults
     if loaded_cats is None:
@@ -401,10 +249,6 @@ try:
     
     if loaded_people is None:
         loaded_people = st.session_state.get('people', [])
-    
-    # Don't auto-seed rules - leave empty if empty
-    if df_rules.empty:
-        df_rules = pd.DataFrame(columns=['Keyword', 'Name', 'Category', 'SubCategory', 'Person', 'Amount'])
 except Exception as e:
     st.error(f"Error connecting to database: {e}")
     st.stop()
@@ -412,6 +256,7 @@ except Exception as e:
 # ============================================
 # 5. PRE-PROCESSING
 # ============================================
+profiler.mark("Pre-processing")
 if not df_history.empty:
     df_history['Date'] = pd.to_datetime(df_history['Date'], errors='coerce')
     df_history['Name'] = df_history['Name'].fillna('') if 'Name' in df_history.columns else ''
@@ -426,12 +271,6 @@ if not df_history.empty:
     if 'Name' not in df_history.columns:
         df_history['Name'] = ''
 
-if not df_rules.empty:
-    if 'Name' not in df_rules.columns:
-        df_rules['Name'] = ''
-    if 'Amount' not in df_rules.columns:
-        df_rules['Amount'] = None
-
 # ============================================
 # 6. SESSION STATE INIT
 # ============================================
@@ -450,14 +289,16 @@ st.title(f"💳 {current_user.title()}'s Cloud Expense Tracker")
 # ============================================
 # SIDEBAR
 # ============================================
+profiler.mark("Sidebar filters")
 st.sidebar.header("🔘 Filters")
 
 if not df_history.empty:
-    df_history = df_history.dropna(subset=['Date'])
+    # Keep history sorted by Date so the Period filter can binary-search it
+    df_history = df_history.dropna(subset=['Date']).sort_values('Date', kind='mergesort')
 
 if not df_history.empty:
-    min_date_avail = df_history['Date'].min().date()
-    max_date_avail = df_history['Date'].max().date()
+    min_date_avail = df_history['Date'].iloc[0].date()
+    max_date_avail = df_history['Date'].iloc[-1].date()
     start_date, end_date = st.sidebar.date_input("Period", [min_date_avail, max_date_avail])
     
     search_field = st.sidebar.radio("Search in:", ["Name", "Description", "Both"], horizontal=True, index=2)
@@ -576,168 +417,259 @@ else:
 
 st.sidebar.markdown("---")
 
-with st.sidebar.expander("📂 Manage Categories", expanded=False):
-    cat_df = pd.DataFrame(st.session_state['categories'], columns=["Category Name"]).sort_values("Category Name")
-    edited_cat_df = st.data_editor(cat_df, num_rows="dynamic", hide_index=True, use_container_width=True, key="cat_editor")
-    if st.button("💾 Save Categories"):
-        new_cats = sorted(edited_cat_df["Category Name"].dropna().unique().tolist())
-        st.session_state['categories'] = new_cats
-        save_list("categories", new_cats)
-        st.success("Saved!")
-        st.rerun()
+profiler.mark("Sidebar panels")
 
-with st.sidebar.expander("🏷️ Manage Sub-Categories", expanded=False):
-    sub_df = pd.DataFrame(st.session_state['subcategories'], columns=["Sub-Category Name"]).sort_values("Sub-Category Name")
-    edited_sub_df = st.data_editor(sub_df, num_rows="dynamic", hide_index=True, use_container_width=True, key="sub_editor")
-    if st.button("💾 Save Sub-Categories"):
-        new_subs = sorted(edited_sub_df["Sub-Category Name"].dropna().unique().tolist())
-        st.session_state['subcategories'] = new_subs
-        save_list("subcategories", new_subs)
-        st.success("Saved!")
+# Panels below run as fragments: interacting with them reruns only the panel.
+# Writes that change data shown elsewhere still trigger a full st.rerun().
+def rerun_fragment():
+    """Rerun only the calling fragment; falls back to a full rerun outside fragment reruns."""
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
         st.rerun()
 
-with st.sidebar.expander("👥 Manage People", expanded=False):
-    ppl_df = pd.DataFrame(st.session_state['people'], columns=["Person Name"]).sort_values("Person Name")
-    edited_ppl_df = st.data_editor(ppl_df, num_rows="dynamic", hide_index=True, use_container_width=True, key="ppl_editor")
-    if st.button("💾 Save People"):
-        new_ppl = sorted(edited_ppl_df["Person Name"].dropna().unique().tolist())
-        st.session_state['people'] = new_ppl
-        save_list("people", new_ppl)
-        st.success("Saved!")
-        st.rerun()
+def reset_transaction_editor():
+    """Forget pending editor edits and bulk actions, e.g. when a different page is shown."""
+    for key in ['transaction_editor', 'bulk_actions']:
+        if key in st.session_state:
+            del st.session_state[key]
+
+@st.fragment
+def manage_list_panel(label, state_key, column, editor_key, save_label):
+    supabase_calls.fragment_run(state_key)
+    with st.expander(label, expanded=False, key=f"{editor_key}_expander", on_change="rerun") as panel:
+        if not panel.open:
+            return
+        list_df = pd.DataFrame(st.session_state[state_key], columns=[column]).sort_values(column)
+        edited_list_df = st.data_editor(list_df, num_rows="dynamic", hide_index=True, use_container_width=True, key=editor_key)
+        if st.button(save_label):
+            new_items = sorted(edited_list_df[column].dropna().unique().tolist())
+            st.session_state[state_key] = new_items
+            save_list(state_key, new_items)
+            st.success("Saved!")
+            st.rerun()
 
-with st.sidebar.expander("📝 Manage Rules", expanded=False):
-    sort_option_rules = st.radio("Sort Rules by:", ["Keyword", "Name", "Category", "SubCategory"], horizontal=True, key="rule_sort")
-    rules_display = df_rules.drop(columns=['id'], errors='ignore').copy()
-    for col in ['Keyword', 'Name', 'Category', 'SubCategory', 'Person', 'Amount']:
-        if col not in rules_display.columns:
-            rules_display[col] = None if col == 'Amount' else ''
+@st.fragment
+def manage_rules_panel():
+    supabase_calls.fragment_run("rules")
+    with st.expander("📝 Manage Rules", expanded=False, key="rules_expander", on_change="rerun") as panel:
+        if not panel.open:
+            return
+        sort_option_rules = st.radio("Sort Rules by:", ["Keyword", "Name", "Category", "SubCategory"], horizontal=True, key="rule_sort")
+        rules_display = get_rules().drop(columns=['id'], errors='ignore').copy()
+        for col in ['Keyword', 'Name', 'Category', 'SubCategory', 'Person', 'Amount']:
+            if col not in rules_display.columns:
+                rules_display[col] = None if col == 'Amount' else ''
     
-    if sort_option_rules == "Keyword":
-        rules_display = rules_display.sort_values(by="Keyword")
-    elif sort_option_rules == "Name":
-        rules_display = rules_display.sort_values(by=["Name", "Keyword"])
-    elif sort_option_rules == "Category":
-        rules_display = rules_display.sort_values(by=["Category", "Keyword"])
-    elif sort_option_rules == "SubCategory":
-        rules_display = rules_display.sort_values(by=["SubCategory", "Keyword"])
-
-    edited_rules = st.data_editor(rules_display, num_rows="dynamic", use_container_width=True, hide_index=True, key="rule_editor",
-        column_config={
-            "Keyword": st.column_config.TextColumn("Keyword"),
-            "Name": st.column_config.TextColumn("Name"),
-            "Category": st.column_config.SelectboxColumn("Category", options=st.session_state['categories'], required=True),
-            "SubCategory": st.column_config.SelectboxColumn("SubCategory", options=st.session_state['subcategories']),
-            "Person": st.column_config.SelectboxColumn("Person", options=st.session_state['people'], required=True),
-            "Amount": st.column_config.NumberColumn("Amount", format="%.2f")
-        })
-    if st.button("💾 Save Rule Changes"):
-        edited_rules['Keyword'] = edited_rules['Keyword'].str.lower().str.strip()
-        edited_rules = edited_rules.dropna(subset=['Keyword'])
-        edited_rules = edited_rules[edited_rules['Keyword'] != '']
-        save_rules_full(edited_rules)
-        df_rules = load_rules()
-        st.success("✅ Rules Updated!")
-        st.rerun()
+        if sort_option_rules == "Keyword":
+            rules_display = rules_display.sort_values(by="Keyword")
+        elif sort_option_rules == "Name":
+            rules_display = rules_display.sort_values(by=["Name", "Keyword"])
+        elif sort_option_rules == "Category":
+            rules_display = rules_display.sort_values(by=["Category", "Keyword"])
+        elif sort_option_rules == "SubCategory":
+            rules_display = rules_display.sort_values(by=["SubCategory", "Keyword"])
+
+        edited_rules = st.data_editor(rules_display, num_rows="dynamic", use_container_width=True, hide_index=True, key="rule_editor",
+            column_config={
+                "Keyword": st.column_config.TextColumn("Keyword", help="Matched anywhere in the description. Start with word: for whole words, prefix: for how it starts, re: for a regex"),
+                "Name": st.column_config.TextColumn("Name"),
+                "Category": st.column_config.SelectboxColumn("Category", options=st.session_state['categories'], required=True),
+                "SubCategory": st.column_config.SelectboxColumn("SubCategory", options=st.session_state['subcategories']),
+                "Person": st.column_config.SelectboxColumn("Person", options=st.session_state['people'], required=True),
+                "Amount": st.column_config.NumberColumn("Amount", format="%.2f")
+            })
+        if st.button("💾 Save Rule Changes"):
+            edited_rules = edited_rules.dropna(subset=['Keyword'])
+            edited_rules['Keyword'] = edited_rules['Keyword'].map(normalize_keyword)
+            edited_rules = edited_rules[edited_rules['Keyword'] != '']
+            problems = invalid_keywords(edited_rules['Keyword'])
+            if problems:
+                st.error("Not saved, invalid patterns: " + "; ".join(f"'{k}': {e}" for k, e in problems.items()))
+            else:
+                save_rules_full(edited_rules)
+                st.success("✅ Rules Updated!")
+                st.rerun()
+
+        st.divider()
+        st.markdown("**🩺 Rule Health**")
+        if st.button("🔍 Analyze Rules"):
+            st.session_state['rule_health'] = analyze_rules(get_rules(), df_history)
+        if 'rule_health' in st.session_state:
+            health = st.session_state['rule_health']
+            prunable = health['Status'] != 'ok'
+            if (health['Status'] == 'prefixed').any():
+                st.warning(
+                    f"{int((health['Status'] == 'prefixed').sum())} rule(s) start with word:, prefix: or re: but occur as plain text "
+                    "in your descriptions, so they were probably meant literally. Edit them in the table above to contains:<keyword>."
+                )
+            st.caption(
+                f"{len(health)} rules: {int((health['Status'] == 'invalid').sum())} invalid, {int((health['Status'] == 'duplicate').sum())} duplicate, "
+                f"{int((health['Status'] == 'shadowed').sum())} shadowed by a longer keyword, "
+                f"{int((health['Status'] == 'unused').sum())} match no transaction. "
+                "Hits and Last Hit are counted by imports and Re-Apply."
+            )
+            show_all = st.checkbox("Show healthy rules too", key="health_show_all")
+            view = health if show_all else health[prunable]
+            picked = st.data_editor(
+                view.assign(Prune=~view['Status'].isin(['ok', 'prefixed'])), hide_index=True, key="health_editor",
+                column_order=['Prune', 'Status', 'Keyword', 'Amount', 'Name', 'Category', 'Reach', 'Wins', 'Hits', 'Last Hit'],
+                disabled=['Status', 'Keyword', 'Amount', 'Name', 'Category', 'Reach', 'Wins', 'Hits', 'Last Hit']
+            )
+            c1, c2 = st.columns(2)
+            if c1.button("🗑️ Delete Selected Rules"):
+                ids = picked.loc[picked['Prune'], 'id'].tolist()
+                delete_rules(ids)
+                del st.session_state['rule_health']
+                st.success(f"✅ Deleted {len(ids)} rules!")
+                st.rerun()
+            if c2.button("✖️ Close", key="health_close"):
+                del st.session_state['rule_health']
+                st.rerun()
 
-with st.sidebar.expander("🧠 Teach the App", expanded=False):
-    new_keyword = st.text_input("Keyword (e.g. Netflix):").lower()
-    new_name = st.text_input("Name (e.g. Netflix Subscription):")
-    col_t1, col_t2 = st.columns(2)
-    new_cat_rule = col_t1.selectbox("Category:", st.session_state['categories'], key="teach_cat")
-    new_sub_rule = col_t2.selectbox("Sub-Category:", [""] + st.session_state['subcategories'], key="teach_sub")
-    new_person_rule = st.selectbox("Person:", st.session_state['people'], key="teach_ppl")
-    new_amount = st.number_input("Exact Amount (optional)", value=None, step=0.01, key="teach_amt")
+@st.fragment
+def teach_panel():
+    supabase_calls.fragment_run("teach")
+    with st.expander("🧠 Teach the App", expanded=False):
+        col_k1, col_k2 = st.columns([1, 2])
+        new_kind = col_k1.selectbox("Match:", list(RULE_KIND_LABELS), format_func=RULE_KIND_LABELS.get, key="teach_kind")
+        new_text = col_k2.text_input("Keyword (e.g. Netflix):" if new_kind != 'regex' else r"Pattern (e.g. uber\s*\*?(trip|eats)):", key="teach_keyword")
+        new_keyword = make_keyword(new_kind, new_text) if new_text.strip() else ''
+        new_name = st.text_input("Name (e.g. Netflix Subscription):")
+        col_t1, col_t2 = st.columns(2)
+        new_cat_rule = col_t1.selectbox("Category:", st.session_state['categories'], key="teach_cat")
+        new_sub_rule = col_t2.selectbox("Sub-Category:", [""] + st.session_state['subcategories'], key="teach_sub")
+        new_person_rule = st.selectbox("Person:", st.session_state['people'], key="teach_ppl")
+        new_amount = st.number_input("Exact Amount (optional)", value=None, step=0.01, key="teach_amt")
     
-    if st.button("➕ Add Rule"):
-        if new_keyword:
-            new_rule_row = pd.DataFrame([{"Keyword": new_keyword, "Name": new_name, "Category": new_cat_rule, "SubCategory": new_sub_rule, "Person": new_person_rule, "Amount": new_amount}])
-            add_rules(new_rule_row)
-            st.success(f"Saved! '{new_keyword}' -> {new_name} ({new_cat_rule})")
-            st.rerun()
+        if st.button("➕ Add Rule"):
+            problems = invalid_keywords([new_keyword]) if new_keyword else {}
+            if problems:
+                st.error(f"Invalid pattern: {problems[new_keyword]}")
+            elif new_keyword:
+                new_rule_row = pd.DataFrame([{"Keyword": new_keyword, "Name": new_name, "Category": new_cat_rule, "SubCategory": new_sub_rule, "Person": new_person_rule, "Amount": new_amount}])
+                add_rules(new_rule_row)
+                st.success(f"Saved! '{new_keyword}' -> {new_name} ({new_cat_rule})")
+                st.rerun()
     
-    if st.button("🧠 Auto-Learn Rules from History"):
-        if not df_history.empty:
-            existing_keywords = df_rules['Keyword'].str.lower().tolist() if not df_rules.empty else []
-            new_rules_list = []
-            for _, row in df_history.iterrows():
-                desc_key = str(row['Description']).lower().strip()
-                if row['Category'] != 'Uncategorized' and desc_key not in existing_keywords:
-                    new_rules_list.append({"Keyword": desc_key, "Name": row.get('Name', '') if pd.notna(row.get('Name')) else '', "Category": row['Category'], "SubCategory": row.get('SubCategory', ''), "Person": row['Person'], "Amount": None})
-                    existing_keywords.append(desc_key)
-            if new_rules_list:
-                add_rules(pd.DataFrame(new_rules_list))
-            st.success(f"✅ Learned {len(new_rules_list)} new rules!")
-            st.rerun()
-
-    if st.button("🔄 Re-Apply Rules"):
-        if not df_history.empty and not df_rules.empty:
-            changed_ids = []
-            for idx, row in df_history.iterrows():
-                if row.get('Locked', False):
-                    continue
-                name, cat, sub, person = get_match(row['Description'], row['Amount'], df_rules)
-                if name:
-                    df_history.at[idx, 'Name'] = name
-                if cat:
-                    df_history.at[idx, 'Category'] = cat
-                if sub:
-                    df_history.at[idx, 'SubCategory'] = sub
-                if person:
-                    df_history.at[idx, 'Person'] = person
-                if name or cat or sub or person:
-                    changed_ids.append(idx)
-            if changed_ids:
-                upsert_expenses(df_history.loc[changed_ids])
-            st.success(f"✅ Rules Re-Applied to {len(changed_ids)} transactions!")
-            st.rerun()
+        if st.button("🧠 Auto-Learn Rules from History"):
+            if not df_history.empty:
+                st.session_state['learn_proposal'] = learn_rules(df_history, get_rules())
+
+        if 'learn_proposal' in st.session_state:
+            proposal, report = st.session_state['learn_proposal']
+            if proposal.empty:
+                st.info(f"Nothing to learn: {report['already_matched']} of {report['labeled_rows']} categorized transactions already match a rule.")
+                if st.button("OK", key="learn_ok"):
+                    del st.session_state['learn_proposal']
+                    st.rerun()
+            else:
+                st.caption(
+                    f"{report['rules']} rules (instead of {report['one_per_description']} whole descriptions) "
+                    f"cover {report['coverage']:.0%} of the {report['to_learn']} transactions no rule matches yet, "
+                    f"{report['precision']:.1%} with the category they already have."
+                    + (f" {report['one_off_rules']} of them match a single past transaction ({report['one_off_covered']} rows); "
+                       f"the others cover {report['general_coverage']:.0%}." if report['one_off_rules'] else "")
+                )
+                picked = st.data_editor(
+                    proposal.assign(Add=True), hide_index=True, key="learn_editor",
+                    column_order=['Add', 'Keyword', 'Name', 'Category', 'SubCategory', 'Person', 'Matches', 'Precision'],
+                    disabled=['Matches', 'Precision']
+                )
+                c1, c2 = st.columns(2)
+                if c1.button("✅ Add Selected Rules"):
+                    chosen = picked[picked['Add']].drop(columns=['Add', 'Matches', 'Precision'])
+                    chosen['Keyword'] = chosen['Keyword'].map(normalize_keyword)
+                    problems = invalid_keywords(chosen['Keyword'])
+                    if problems:
+                        st.error("Not added, invalid patterns: " + "; ".join(f"'{k}': {e}" for k, e in problems.items()))
+                    else:
+                        if not chosen.empty:
+                            add_rules(chosen)
+                        del st.session_state['learn_proposal']
+                        st.success(f"✅ Learned {len(chosen)} new rules!")
+                        st.rerun()
+                if c2.button("✖️ Discard"):
+                    del st.session_state['learn_proposal']
+                    st.rerun()
 
-with st.sidebar.expander("🗑️ Recycle Bin", expanded=False):
-    trash_df = load_trash()
-    if not trash_df.empty:
-        trash_count = len(trash_df)
-        st.warning(f"**{trash_count} items in trash**")
-        trash_display = trash_df.copy()
-        if 'Date' in trash_display.columns:
-            trash_display['Date'] = pd.to_datetime(trash_display['Date'], errors='coerce').dt.date
-        if 'Deleted At' in trash_display.columns:
-            trash_display['Deleted At'] = pd.to_datetime(trash_display['Deleted At'], errors='coerce').dt.strftime('%b %d, %H:%M')
-        trash_display['Restore'] = False
-        display_trash_cols = ['id', 'Restore', 'Date', 'Name', 'Description', 'Amount', 'Category', 'Deleted At']
-        trash_display = trash_display[[c for c in display_trash_cols if c in trash_display.columns]]
-        edited_trash = st.data_editor(trash_display, column_config={"id": None, "Restore": st.column_config.CheckboxColumn("✅", width="small"), "Amount": st.column_config.NumberColumn("Amount", format="$%.2f")}, hide_index=True, use_container_width=True, height=200, key="trash_editor")
-        selected_restore = edited_trash[edited_trash['Restore'] == True] if 'Restore' in edited_trash.columns else pd.DataFrame()
-        restore_count = len(selected_restore)
-        col_trash1, col_trash2 = st.columns(2)
-        if restore_count > 0:
-            if col_trash1.button(f"♻️ Restore ({restore_count})", use_container_width=True, key="btn_restore"):
-                ids_to_restore = selected_restore['id'].dropna().tolist()
-                restored = restore_from_trash(ids_to_restore)
-                st.success(f"✅ Restored {restored} items!")
+        full_pass = st.checkbox("Re-check every transaction (not only those the rule changes affect)", key="reapply_full")
+        if st.button("🔄 Re-Apply Rules"):
+            df_rules = get_rules()
+            if not df_history.empty and not df_rules.empty:
+                keywords = None if full_pass else changed_rule_keywords(df_rules)
+                rows = None if keywords is None else rows_for_keywords(df_history, keywords)
+                original = df_history.loc[rows, RULE_LABEL_COLS].copy() if rows is not None else df_history[RULE_LABEL_COLS].copy()
+                matched = reapply_rules(df_history, df_rules, rows=rows)
+                changed = changed_rows(original, df_history.loc[matched], RULE_LABEL_COLS) if matched else df_history.iloc[0:0]
+                if not changed.empty:
+                    upsert_expenses(changed)
+                mark_rules_applied(df_rules)
+                flush_rule_hits()
+                checked = len(df_history) if rows is None else len(rows)
+                st.success(f"✅ Rules Re-Applied: {checked} transactions checked, {len(changed)} updated!")
                 st.rerun()
+
+@st.fragment
+def recycle_bin_panel():
+    supabase_calls.fragment_run("recycle_bin")
+    with st.expander("🗑️ Recycle Bin", expanded=False, key="trash_expander", on_change="rerun") as panel:
+        if not panel.open:
+            return
+        trash_df = cached("trash", load_trash)
+        if not trash_df.empty:
+            trash_count = len(trash_df)
+            st.warning(f"**{trash_count} items in trash**")
+            trash_display = trash_df.copy()
+            if 'Date' in trash_display.columns:
+                trash_display['Date'] = pd.to_datetime(trash_display['Date'], errors='coerce').dt.date
+            if 'Deleted At' in trash_display.columns:
+                trash_display['Deleted At'] = pd.to_datetime(trash_display['Deleted At'], errors='coerce').dt.strftime('%b %d, %H:%M')
+            trash_display['Restore'] = False
+            display_trash_cols = ['id', 'Restore', 'Date', 'Name', 'Description', 'Amount', 'Category', 'Deleted At']
+            trash_display = trash_display[[c for c in display_trash_cols if c in trash_display.columns]]
+            edited_trash = st.data_editor(trash_display, column_config={"id": None, "Restore": st.column_config.CheckboxColumn("✅", width="small"), "Amount": st.column_config.NumberColumn("Amount", format="$%.2f")}, hide_index=True, use_container_width=True, height=200, key="trash_editor")
+            selected_restore = edited_trash[edited_trash['Restore'] == True] if 'Restore' in edited_trash.columns else pd.DataFrame()
+            restore_count = len(selected_restore)
+            col_trash1, col_trash2 = st.columns(2)
+            if restore_count > 0:
+                if col_trash1.button(f"♻️ Restore ({restore_count})", use_container_width=True, key="btn_restore"):
+                    ids_to_restore = selected_restore['id'].dropna().tolist()
+                    restored = restore_from_trash(ids_to_restore)
+                    st.success(f"✅ Restored {restored} items!")
+                    st.rerun()
+            else:
+                col_trash1.button("♻️ Restore (0)", disabled=True, use_container_width=True, key="btn_restore_disabled")
+            if col_trash2.button("🗑️ Empty Trash", use_container_width=True, key="btn_empty"):
+                st.session_state['confirm_empty_trash'] = True
+            if st.session_state.get('confirm_empty_trash', False):
+                st.error(f"⚠️ Permanently delete all {trash_count} items?")
+                col_c1, col_c2 = st.columns(2)
+                if col_c1.button("✅ Yes, Empty", key="confirm_empty_yes"):
+                    empty_trash()
+                    st.session_state['confirm_empty_trash'] = False
+                    st.success("🗑️ Trash emptied!")
+                    rerun_fragment()
+                if col_c2.button("❌ Cancel", key="confirm_empty_no"):
+                    st.session_state['confirm_empty_trash'] = False
+                    rerun_fragment()
         else:
-            col_trash1.button("♻️ Restore (0)", disabled=True, use_container_width=True, key="btn_restore_disabled")
-        if col_trash2.button("🗑️ Empty Trash", use_container_width=True, key="btn_empty"):
-            st.session_state['confirm_empty_trash'] = True
-        if st.session_state.get('confirm_empty_trash', False):
-            st.error(f"⚠️ Permanently delete all {trash_count} items?")
-            col_c1, col_c2 = st.columns(2)
-            if col_c1.button("✅ Yes, Empty", key="confirm_empty_yes"):
-                empty_trash()
-                st.session_state['confirm_empty_trash'] = False
-                st.success("🗑️ Trash emptied!")
-                st.rerun()
-            if col_c2.button("❌ Cancel", key="confirm_empty_no"):
-                st.session_state['confirm_empty_trash'] = False
-                st.rerun()
-    else:
-        st.info("🗑️ Trash is empty")
+            st.info("🗑️ Trash is empty")
+
+with st.sidebar:
+    manage_list_panel("📂 Manage Categories", 'categories', "Category Name", "cat_editor", "💾 Save Categories")
+    manage_list_panel("🏷️ Manage Sub-Categories", 'subcategories', "Sub-Category Name", "sub_editor", "💾 Save Sub-Categories")
+    manage_list_panel("👥 Manage People", 'people', "Person Name", "ppl_editor", "💾 Save People")
+    manage_rules_panel()
+    teach_panel()
+    recycle_bin_panel()
 
 st.sidebar.markdown("---")
 
 # ============================================
 # IMPORT DATA - FIXED VERSION
 # ============================================
+profiler.mark("Import")
 st.sidebar.header("📤 Import Data")
 manual_source = st.sidebar.text_input("Source Name", placeholder="e.g. HSBC Credit", key="source_input")
 input_method = st.sidebar.radio("Input Method:", ["Upload File", "Paste Text"])
@@ -771,65 +703,20 @@ if input_method == "Upload File":
                 
                 # Process the data
                 if not new_data.empty:
-                    new_data.columns = [str(c).lower().strip() for c in new_data.columns]
-                    date_col = next((c for c in new_data.columns if 'date' in c), None)
-                    desc_col = next((c for c in new_data.columns if 'desc' in c or 'memo' in c), None)
-                    amt_col = next((c for c in new_data.columns if 'amount' in c or 'debit' in c or 'value' in c or 'hkd' in c), None)
-                    src_col = next((c for c in new_data.columns if 'source' in c), None)
-                    name_col_in = next((c for c in new_data.columns if c == 'name'), None)
-                    cat_col_in = next((c for c in new_data.columns if 'category' in c and 'sub' not in c), None)
-                    sub_col_in = next((c for c in new_data.columns if 'sub' in c), None)
-                    person_col_in = next((c for c in new_data.columns if 'person' in c), None)
-
-                    if date_col and desc_col and amt_col:
-                        new_data[amt_col] = new_data[amt_col].astype(str).str.upper().str.replace('CR','', regex=False).str.replace('DR','', regex=False).str.replace(',','', regex=False).str.replace('$','', regex=False)
-                        new_data[amt_col] = pd.to_numeric(new_data[amt_col], errors='coerce')
-                        file_source = new_data[src_col] if src_col else (manual_source if manual_source else "Uploaded")
-                        
-                        clean_new_data = pd.DataFrame({
-                            'Date': pd.to_datetime(new_data[date_col], errors='coerce'),
-                            'Description': new_data[desc_col],
-                            'Amount': new_data[amt_col],
-                            'Source': file_source,
-                            'Name': new_data[name_col_in] if name_col_in else '',
-                            'Category': new_data[cat_col_in] if cat_col_in else 'Uncategorized',
-                            'SubCategory': new_data[sub_col_in] if sub_col_in else '',
-                            'Person': new_data[person_col_in] if person_col_in else 'Family',
-                            'Locked': False
-                        })
-                        clean_new_data = clean_new_data.dropna(subset=['Date', 'Amount'])
-                        
-                        # Apply rules
-                        def apply_rules_smart(row):
-                            if row['Category'] != 'Uncategorized' and pd.notna(row['Category']) and row.get('Name', '') != '':
-                                return row
-                            name, cat, sub, person = get_match(row['Description'], row['Amount'], df_rules)
-                            if name and (row.get('Name', '') == '' or pd.isna(row.get('Name', ''))):
-                                row['Name'] = name
-                            if cat and (row['Category'] == 'Uncategorized' or pd.isna(row['Category'])):
-                                row['Category'] = cat
-                            if sub and (row.get('SubCategory', '') == '' or pd.isna(row.get('SubCategory', ''))):
-                                row['SubCategory'] = sub
-                            if person and (row.get('Person', '') == '' or pd.isna(row.get('Person', ''))):
-                                row['Person'] = person
-                            return row
-                        
-                        clean_new_data = clean_new_data.apply(apply_rules_smart, axis=1)
-                        
-                        # Check for duplicates
-                        existing = load_expenses()
-                        if not existing.empty:
-                            existing['_key'] = existing['Date'].astype(str) + '|' + existing['Description'].astype(str) + '|' + existing['Amount'].astype(str)
-                            clean_new_data['_key'] = clean_new_data['Date'].astype(str) + '|' + clean_new_data['Description'].astype(str) + '|' + clean_new_data['Amount'].astype(str)
-                            truly_new = clean_new_data[~clean_new_data['_key'].isin(existing['_key'])].drop(columns=['_key'])
-                        else:
-                            truly_new = clean_new_data
+                    import_started = time.perf_counter()
+                    clean_new_data = parse_statement(new_data, manual_source if manual_source else "Uploaded")
+
+                    if clean_new_data is not None:
+                        clean_new_data = fill_from_rules(clean_new_data, get_rules())
+                        truly_new = drop_existing(clean_new_data, load_expenses())
+                        flush_rule_hits()
                         
                         # Mark as processed BEFORE inserting
                         st.session_state['upload_processed'] = True
                         
                         if not truly_new.empty:
                             insert_expenses(truly_new)
+                            record_import(len(truly_new), time.perf_counter() - import_started)
                             st.sidebar.success(f"✅ Added {len(truly_new)} new transactions!")
                             st.rerun()
                         else:
@@ -853,62 +740,17 @@ elif input_method == "Paste Text":
                 new_data = pd.read_csv(io.StringIO(pasted_text), sep=',')
                 
                 if not new_data.empty:
-                    new_data.columns = [str(c).lower().strip() for c in new_data.columns]
-                    date_col = next((c for c in new_data.columns if 'date' in c), None)
-                    desc_col = next((c for c in new_data.columns if 'desc' in c or 'memo' in c), None)
-                    amt_col = next((c for c in new_data.columns if 'amount' in c or 'debit' in c or 'value' in c or 'hkd' in c), None)
-                    src_col = next((c for c in new_data.columns if 'source' in c), None)
-                    name_col_in = next((c for c in new_data.columns if c == 'name'), None)
-                    cat_col_in = next((c for c in new_data.columns if 'category' in c and 'sub' not in c), None)
-                    sub_col_in = next((c for c in new_data.columns if 'sub' in c), None)
-                    person_col_in = next((c for c in new_data.columns if 'person' in c), None)
-
-                    if date_col and desc_col and amt_col:
-                        new_data[amt_col] = new_data[amt_col].astype(str).str.upper().str.replace('CR','', regex=False).str.replace('DR','', regex=False).str.replace(',','', regex=False).str.replace('$','', regex=False)
-                        new_data[amt_col] = pd.to_numeric(new_data[amt_col], errors='coerce')
-                        file_source = new_data[src_col] if src_col else (manual_source if manual_source else "Pasted")
-                        
-                        clean_new_data = pd.DataFrame({
-                            'Date': pd.to_datetime(new_data[date_col], errors='coerce'),
-                            'Description': new_data[desc_col],
-                            'Amount': new_data[amt_col],
-                            'Source': file_source,
-                            'Name': new_data[name_col_in] if name_col_in else '',
-                            'Category': new_data[cat_col_in] if cat_col_in else 'Uncategorized',
-                            'SubCategory': new_data[sub_col_in] if sub_col_in else '',
-                            'Person': new_data[person_col_in] if person_col_in else 'Family',
-                            'Locked': False
-                        })
-                        clean_new_data = clean_new_data.dropna(subset=['Date', 'Amount'])
-                        
-                        # Apply rules
-                        def apply_rules_smart(row):
-                            if row['Category'] != 'Uncategorized' and pd.notna(row['Category']) and row.get('Name', '') != '':
-                                return row
-                            name, cat, sub, person = get_match(row['Description'], row['Amount'], df_rules)
-                            if name and (row.get('Name', '') == '' or pd.isna(row.get('Name', ''))):
-                                row['Name'] = name
-                            if cat and (row['Category'] == 'Uncategorized' or pd.isna(row['Category'])):
-                                row['Category'] = cat
-                            if sub and (row.get('SubCategory', '') == '' or pd.isna(row.get('SubCategory', ''))):
-                                row['SubCategory'] = sub
-                            if person and (row.get('Person', '') == '' or pd.isna(row.get('Person', ''))):
-                                row['Person'] = person
-                            return row
-                        
-                        clean_new_data = clean_new_data.apply(apply_rules_smart, axis=1)
-                        
-                        # Check for duplicates
-                        existing = load_expenses()
-                        if not existing.empty:
-                            existing['_key'] = existing['Date'].astype(str) + '|' + existing['Description'].astype(str) + '|' + existing['Amount'].astype(str)
-                            clean_new_data['_key'] = clean_new_data['Date'].astype(str) + '|' + clean_new_data['Description'].astype(str) + '|' + clean_new_data['Amount'].astype(str)
-                            truly_new = clean_new_data[~clean_new_data['_key'].isin(existing['_key'])].drop(columns=['_key'])
-                        else:
-                            truly_new = clean_new_data
+                    import_started = time.perf_counter()
+                    clean_new_data = parse_statement(new_data, manual_source if manual_source else "Pasted")
+
+                    if clean_new_data is not None:
+                        clean_new_data = fill_from_rules(clean_new_data, get_rules())
+                        truly_new = drop_existing(clean_new_data, load_expenses())
+                        flush_rule_hits()
                         
                         if not truly_new.empty:
                             insert_expenses(truly_new)
+                            record_import(len(truly_new), time.perf_counter() - import_started)
                             st.sidebar.success(f"✅ Added {len(truly_new)} new transactions!")
                             st.rerun()
                         else:
@@ -922,10 +764,15 @@ elif input_method == "Paste Text":
 
 st.sidebar.markdown("---")
 
+profiler.mark("Settings")
 st.sidebar.header("⚙️ Settings")
 font_choice = st.sidebar.select_slider("Aa Text Size", options=["Small", "Default", "Large"], value="Default")
 font_size = "14px" if font_choice == "Small" else "20px" if font_choice == "Large" else "16px"
 st.markdown(f"<style>html, body, [class*='css'] {{ font-size: {font_size} !important; }}</style>", unsafe_allow_html=True)
+st.sidebar.toggle("⏱️ Profile Reruns", key="profiling", help="Time every section and data-access call of each rerun")
+if st.sidebar.button("🧪 cProfile Next Rerun", use_container_width=True):
+    st.session_state['cprofile_next_rerun'] = True
+    st.rerun()
 
 st.sidebar.markdown("---")
 st.sidebar.header("📄 License")
@@ -941,58 +788,32 @@ st.sidebar.markdown("---")
 st.sidebar.header("📌 Connection")
 st.sidebar.success("✅ Connected to Supabase")
 st.sidebar.caption(f"Project: ...{sb_url[-25:]}")
+# Filled at the end of the script, once all of this rerun's Supabase calls are in
+perf_slot = st.sidebar.container()
 
 # ============================================
 # BACKUP & RESTORE SECTION
 # ============================================
+profiler.mark("Backup & restore")
 st.sidebar.markdown("---")
 st.sidebar.header("💾 Backup & Restore")
 
-# --- BACKUP BUTTON ---
-if st.sidebar.button("📥 Create Backup", use_container_width=True):
+# --- BACKUP BUTTONS ---
+# Backups are saved in the user's backup dir and chained in a manifest; incrementals hold only changes
+has_backup_chain = bool(load_manifest(current_user)['chain'])
+backup_formats = ["NDJSON (gzip)", "Parquet (zip)"] if pa is not None else ["NDJSON (gzip)"]
+backup_format = st.sidebar.radio("Backup format:", backup_formats, horizontal=True, key="backup_format")
+col_bk1, col_bk2 = st.sidebar.columns(2)
+create_full = col_bk1.button("📥 Create Backup", use_container_width=True, help="Saved on the server too; each full backup deletes older saved backups, keeping the newest full one and its incrementals")
+create_incremental = col_bk2.button("➕ Incremental", use_container_width=True, disabled=not has_backup_chain, help="Only rows added, changed or deleted since the last backup")
+if create_full or create_incremental:
     try:
-        import json
-        backup_date = datetime.datetime.now().strftime("%Y%m%d")
-        backup_name = f"supabase_backup_{backup_date}"
-        
-        backup_data = {}
-        
-        expenses_resp = sb.table("expenses").select("*").execute()
-        backup_data['expenses'] = expenses_resp.data if expenses_resp.data else []
-        
-        rules_resp = sb.table("rules").select("*").execute()
-        backup_data['rules'] = rules_resp.data if rules_resp.data else []
-        
-        cats_resp = sb.table("categories").select("*").execute()
-        backup_data['categories'] = cats_resp.data if cats_resp.data else []
-        
-        subcats_resp = sb.table("subcategories").select("*").execute()
-        backup_data['subcategories'] = subcats_resp.data if subcats_resp.data else []
-        
-        people_resp = sb.table("people").select("*").execute()
-        backup_data['people'] = people_resp.data if people_resp.data else []
-        
-        try:
-            trash_resp = sb.table("deleted_expenses").select("*").execute()
-            backup_data['deleted_expenses'] = trash_resp.data if trash_resp.data else []
-        except:
-            backup_data['deleted_expenses'] = []
-        
-        backup_data['_metadata'] = {
-            'backup_date': datetime.datetime.now().isoformat(),
-            'user': current_user,
-            'total_expenses': len(backup_data['expenses']),
-            'total_rules': len(backup_data['rules']),
-            'total_categories': len(backup_data['categories']),
-            'total_subcategories': len(backup_data['subcategories']),
-            'total_people': len(backup_data['people'])
-        }
-        
-        backup_json = json.dumps(backup_data, indent=2, default=str)
+        entry = create_saved_backup(current_user, incremental=create_incremental, fmt='parquet' if backup_format == "Parquet (zip)" else 'ndjson')
         
         st.session_state['backup_ready'] = True
-        st.session_state['backup_json'] = backup_json
-        st.session_state['backup_name'] = backup_name
+        st.session_state['backup_path'] = os.path.join(user_backup_dir(current_user), entry['file'])
+        st.session_state['backup_meta'] = entry['meta']
+        st.session_state['backup_name'] = entry['file']
         
         st.sidebar.success("✅ Backup ready!")
         st.rerun()
@@ -1001,26 +822,30 @@ if st.sidebar.button("📥 Create Backup", use_container_width=True):
         st.sidebar.error(f"❌ Backup failed: {e}")
 
 # --- DOWNLOAD BUTTON ---
-if st.session_state.get('backup_ready', False):
-    import json
-    backup_json = st.session_state.get('backup_json', '')
-    backup_name = st.session_state.get('backup_name', 'backup')
+if st.session_state.get('backup_ready', False) and os.path.exists(st.session_state.get('backup_path', '')):
+    backup_path = st.session_state['backup_path']
+    backup_name = st.session_state.get('backup_name', 'backup.ndjson.gz')
+    meta = st.session_state.get('backup_meta', {})
     
-    try:
-        backup_info = json.loads(backup_json)
-        meta = backup_info.get('_metadata', {})
-        st.sidebar.caption(
-            f"📊 {meta.get('total_expenses', 0)} expenses, "
-            f"{meta.get('total_rules', 0)} rules"
-        )
-    except:
-        pass
+    deleted_total = sum(meta.get('deleted', {}).values())
+    st.sidebar.caption(
+        f"📊 {meta.get('kind', 'full').title()}: {meta.get('total_expenses', 0)} expenses, "
+        f"{meta.get('total_rules', 0)} rules"
+        + (f", {deleted_total} deletions" if meta.get('kind') == 'incremental' else "")
+        + f" ({os.path.getsize(backup_path) / 1024:,.0f} KB compressed)"
+    )
+    if meta.get('timings'):
+        st.sidebar.caption(format_timings(meta['timings']))
+    
+    def read_backup_file(path=backup_path):
+        with open(path, 'rb') as f:
+            return f.read()
     
     st.sidebar.download_button(
         label="⬇️ Download Backup File",
-        data=backup_json,
-        file_name=f"{backup_name}.json",
-        mime="application/json",
+        data=read_backup_file,
+        file_name=backup_name,
+        mime="application/zip" if backup_name.endswith(".zip") else "application/gzip",
         use_container_width=True
     )
     
@@ -1030,25 +855,58 @@ if st.session_state.get('backup_ready', False):
 
 # --- RESTORE SECTION ---
 with st.sidebar.expander("🔄 Restore from Backup", expanded=False):
-    restore_file = st.file_uploader("Upload backup JSON", type=['json'], key="restore_upload")
+    if st.session_state.get('last_restore_timings'):
+        st.caption("⏱️ Last restore:  \n" + format_timings(st.session_state['last_restore_timings']))
+    restore_source = st.radio("Restore from:", ["Upload file", "Saved backups"], horizontal=True, key="restore_source")
+    restore_file = None
+    restore_point = None
+    if restore_source == "Upload file":
+        restore_file = st.file_uploader("Upload backup file", type=['json', 'gz', 'zip'], key="restore_upload")
+    else:
+        backup_chain = load_manifest(current_user)['chain']
+        if backup_chain:
+            restore_point = st.selectbox(
+                "Restore to point in time:",
+                list(range(len(backup_chain))),
+                index=len(backup_chain) - 1,
+                format_func=lambda i: f"{backup_chain[i]['created'][:16].replace('T', ' ')} ({backup_chain[i]['kind']})",
+                key="restore_point"
+            )
+        else:
+            st.caption("No saved backups yet.")
     
-    if restore_file is not None:
-        import json
-        try:
-            file_content = restore_file.read()
-            backup_data = json.loads(file_content.decode('utf-8'))
-            restore_file.seek(0)
-            
-            meta = backup_data.get('_metadata', {})
+    if restore_file is not None or restore_point is not None:
+        # Summary comes from the backup header or the manifest, never from parsing the rows
+        if restore_file is not None:
+            try:
+                meta = read_backup_header(restore_file)
+            except Exception:
+                meta = None
+            if meta:
+                st.info(
+                    f"📁 **Backup Info:**\n"
+                    f"- Date: {meta.get('backup_date', 'Unknown')[:10]}\n"
+                    f"- Expenses: {meta.get('total_expenses', 0)}\n"
+                    f"- Rules: {meta.get('total_rules', 0)}"
+                )
+                if meta.get('kind') == 'incremental':
+                    st.warning(
+                        "⚠️ This is an **incremental** backup: it only holds rows changed since the previous backup. "
+                        "Full Overwrite is not available for it - to restore that point in time, pick it under "
+                        "Saved backups, which replays the full backup and every incremental up to it."
+                    )
+            else:
+                st.info(f"📁 **Legacy JSON backup** ({restore_file.size / 1024:,.0f} KB)")
+        else:
+            chain_entry = backup_chain[restore_point]
+            base_index = max(i for i in range(restore_point + 1) if backup_chain[i]['kind'] == 'full')
+            meta = backup_chain[base_index]['meta']
             st.info(
                 f"📁 **Backup Info:**\n"
-                f"- Date: {meta.get('backup_date', 'Unknown')[:10]}\n"
-                f"- Expenses: {meta.get('total_expenses', len(backup_data.get('expenses', [])))}\n"
-                f"- Rules: {meta.get('total_rules', len(backup_data.get('rules', [])))}"
+                f"- Date: {chain_entry['created'][:16].replace('T', ' ')}\n"
+                f"- Full backup of {meta.get('total_expenses', 0)} expenses, {meta.get('total_rules', 0)} rules\n"
+                f"- Plus {restore_point - base_index} incremental backup(s)"
             )
-        except:
-            st.warning("Could not read backup info")
-            backup_data = None
         
         restore_mode = st.radio(
             "Restore Mode:",
@@ -1070,184 +928,34 @@ with st.sidebar.expander("🔄 Restore from Backup", expanded=False):
         
         if st.button("🔄 Restore Now", type="primary", use_container_width=True, key="restore_btn"):
             try:
-                import json
-                file_content = restore_file.read()
-                backup_data = json.loads(file_content.decode('utf-8'))
-                
-                added_counts = {}
-                updated_counts = {}
-                
-                if restore_mode == "🗑️ Full Overwrite (replace everything)":
-                    
-                    if 'expenses' in backup_data and backup_data['expenses']:
-                        sb.table("expenses").delete().gte("id", 0).execute()
-                        expenses_clean = [{k: v for k, v in exp.items() if k != 'id'} for exp in backup_data['expenses']]
-                        if expenses_clean:
-                            batch_size = 100
-                            for i in range(0, len(expenses_clean), batch_size):
-                                batch = expenses_clean[i:i+batch_size]
-                                sb.table("expenses").insert(batch).execute()
-                        added_counts['expenses'] = len(backup_data['expenses'])
-                    
-                    if 'rules' in backup_data and backup_data['rules']:
-                        sb.table("rules").delete().gte("id", 0).execute()
-                        rules_clean = [{k: v for k, v in rule.items() if k != 'id'} for rule in backup_data['rules']]
-                        if rules_clean:
-                            sb.table("rules").insert(rules_clean).execute()
-                        added_counts['rules'] = len(backup_data['rules'])
-                    
-                    if 'categories' in backup_data and backup_data['categories']:
-                        sb.table("categories").delete().gte("id", 0).execute()
-                        cats_clean = [{k: v for k, v in cat.items() if k != 'id'} for cat in backup_data['categories']]
-                        if cats_clean:
-                            sb.table("categories").insert(cats_clean).execute()
-                        added_counts['categories'] = len(backup_data['categories'])
-                    
-                    if 'subcategories' in backup_data and backup_data['subcategories']:
-                        sb.table("subcategories").delete().gte("id", 0).execute()
-                        subs_clean = [{k: v for k, v in sub.items() if k != 'id'} for sub in backup_data['subcategories']]
-                        if subs_clean:
-                            sb.table("subcategories").insert(subs_clean).execute()
-                        added_counts['subcategories'] = len(backup_data['subcategories'])
-                    
-                    if 'people' in backup_data and backup_data['people']:
-                        sb.table("people").delete().gte("id", 0).execute()
-                        people_clean = [{k: v for k, v in p.items() if k != 'id'} for p in backup_data['people']]
-                        if people_clean:
-                            sb.table("people").insert(people_clean).execute()
-                        added_counts['people'] = len(backup_data['people'])
-                    
-                    try:
-                        if 'deleted_expenses' in backup_data and backup_data['deleted_expenses']:
-                            sb.table("deleted_expenses").delete().gte("id", 0).execute()
-                            trash_clean = [{k: v for k, v in item.items() if k != 'id'} for item in backup_data['deleted_expenses']]
-                            if trash_clean:
-                                sb.table("deleted_expenses").insert(trash_clean).execute()
-                            added_counts['trash'] = len(backup_data['deleted_expenses'])
-                    except:
-                        pass
-                
+                mode = {
+                    "🗑️ Full Overwrite (replace everything)": 'overwrite',
+                    "📥 Prefer Backup (update conflicts)": 'prefer_backup'
+                }.get(restore_mode, 'keep_existing')
+                if restore_file is not None:
+                    check_restore_mode(mode, (meta or {}).get('kind'))
+                    # Check counts and checksums before anything is deleted or overwritten
+                    with st.spinner("Verifying backup..."):
+                        problems = verify_backup(restore_file)
+                    if problems:
+                        raise ValueError("backup failed verification, nothing was changed - " + "; ".join(problems))
+                    tables = iter_backup_tables(restore_file)
                 else:
-                    prefer_backup = (restore_mode == "📥 Prefer Backup (update conflicts)")
-                    
-                    if 'expenses' in backup_data and backup_data['expenses']:
-                        existing_resp = sb.table("expenses").select("*").execute()
-                        existing_map = {}
-                        if existing_resp.data:
-                            for exp in existing_resp.data:
-                                key = f"{exp.get('date')}|{exp.get('description')}|{exp.get('amount')}"
-                                existing_map[key] = exp
-                        
-                        new_expenses = []
-                        update_expenses = []
-                        
-                        for exp in backup_data['expenses']:
-                            key = f"{exp.get('date')}|{exp.get('description')}|{exp.get('amount')}"
-                            
-                            if key not in existing_map:
-                                clean_exp = {k: v for k, v in exp.items() if k != 'id'}
-                                new_expenses.append(clean_exp)
-                            elif prefer_backup:
-                                existing_id = existing_map[key]['id']
-                                clean_exp = {k: v for k, v in exp.items() if k != 'id'}
-                                clean_exp['id'] = existing_id
-                                update_expenses.append(clean_exp)
-                        
-                        if new_expenses:
-                            batch_size = 100
-                            for i in range(0, len(new_expenses), batch_size):
-                                batch = new_expenses[i:i+batch_size]
-                                sb.table("expenses").insert(batch).execute()
-                        
-                        if update_expenses:
-                            for exp in update_expenses:
-                                exp_id = exp.pop('id')
-                                sb.table("expenses").update(exp).eq("id", exp_id).execute()
-                        
-                        added_counts['expenses'] = len(new_expenses)
-                        updated_counts['expenses'] = len(update_expenses)
-                    
-                    if 'rules' in backup_data and backup_data['rules']:
-                        existing_resp = sb.table("rules").select("*").execute()
-                        existing_map = {}
-                        if existing_resp.data:
-                            for rule in existing_resp.data:
-                                key = rule.get('keyword', '').lower()
-                                existing_map[key] = rule
-                        
-                        new_rules = []
-                        update_rules = []
-                        
-                        for rule in backup_data['rules']:
-                            key = rule.get('keyword', '').lower()
-                            
-                            if key not in existing_map:
-                                clean_rule = {k: v for k, v in rule.items() if k != 'id'}
-                                new_rules.append(clean_rule)
-                            elif prefer_backup:
-                                existing_id = existing_map[key]['id']
-                                clean_rule = {k: v for k, v in rule.items() if k != 'id'}
-                                clean_rule['id'] = existing_id
-                                update_rules.append(clean_rule)
-                        
-                        if new_rules:
-                            sb.table("rules").insert(new_rules).execute()
-                        
-                        if update_rules:
-                            for rule in update_rules:
-                                rule_id = rule.pop('id')
-                                sb.table("rules").update(rule).eq("id", rule_id).execute()
-                        
-                        added_counts['rules'] = len(new_rules)
-                        updated_counts['rules'] = len(update_rules)
-                    
-                    if 'categories' in backup_data and backup_data['categories']:
-                        existing_resp = sb.table("categories").select("*").execute()
-                        existing_names = set()
-                        if existing_resp.data:
-                            existing_names = {c.get('name', '').lower() for c in existing_resp.data}
-                        
-                        new_cats = []
-                        for cat in backup_data['categories']:
-                            if cat.get('name', '').lower() not in existing_names:
-                                clean_cat = {k: v for k, v in cat.items() if k != 'id'}
-                                new_cats.append(clean_cat)
-                        
-                        if new_cats:
-                            sb.table("categories").insert(new_cats).execute()
-                        added_counts['categories'] = len(new_cats)
-                    
-                    if 'subcategories' in backup_data and backup_data['subcategories']:
-                        existing_resp = sb.table("subcategories").select("*").execute()
-                        existing_names = set()
-                        if existing_resp.data:
-                            existing_names = {s.get('name', '').lower() for s in existing_resp.data}
-                        
-                        new_subs = []
-                        for sub in backup_data['subcategories']:
-                            if sub.get('name', '').lower() not in existing_names:
-                                clean_sub = {k: v for k, v in sub.items() if k != 'id'}
-                                new_subs.append(clean_sub)
-                        
-                        if new_subs:
-                            sb.table("subcategories").insert(new_subs).execute()
-                        added_counts['subcategories'] = len(new_subs)
-                    
-                    if 'people' in backup_data and backup_data['people']:
-                        existing_resp = sb.table("people").select("*").execute()
-                        existing_names = set()
-                        if existing_resp.data:
-                            existing_names = {p.get('name', '').lower() for p in existing_resp.data}
-                        
-                        new_people = []
-                        for person in backup_data['people']:
-                            if person.get('name', '').lower() not in existing_names:
-                                clean_person = {k: v for k, v in person.items() if k != 'id'}
-                                new_people.append(clean_person)
-                        
-                        if new_people:
-                            sb.table("people").insert(new_people).execute()
-                        added_counts['people'] = len(new_people)
+                    snapshot = replay_backup_chain(current_user, restore_point)
+                    meta = snapshot['_metadata']
+                    tables = ((t, iter(rows)) for t, rows in snapshot.items() if not t.startswith('_'))
+                
+                restore_progress = st.progress(0.0, text="Restoring...")
+                meta = meta or {}
+                # An incremental's checksums only cover its changed rows, so never skip tables on them
+                checksums = meta.get('checksums') if meta.get('kind') != 'incremental' else None
+                added_counts, updated_counts, unchanged_counts, timings = restore_backup(
+                    tables, mode, restore_progress, meta.get('tables'), checksums, meta.get('kind')
+                )
+                restore_progress.empty()
+                st.session_state['last_restore_timings'] = timings
+                if any(unchanged_counts.values()):
+                    st.toast("⏭️ Skipped identical: " + ", ".join(f"{count} {table}" for table, count in unchanged_counts.items()))
                 
                 added_msg = ", ".join([f"{count} {table}" for table, count in added_counts.items() if count > 0])
                 updated_msg = ", ".join([f"{count} {table}" for table, count in updated_counts.items() if count > 0])
@@ -1265,6 +973,7 @@ with st.sidebar.expander("🔄 Restore from Backup", expanded=False):
                 if 'transaction_editor' in st.session_state:
                     del st.session_state['transaction_editor']
                 
+                invalidate()
                 st.rerun()
                 
             except Exception as e:
@@ -1291,36 +1000,23 @@ if st.sidebar.button("🚪 Logout"):
 # ============================================
 # MAIN DASHBOARD
 # ============================================
+profiler.mark("Dashboard")
 filtered_df = pd.DataFrame()
 
 if not df_history.empty and start_date and end_date:
+    period_df = slice_period(df_history, start_date, end_date)
+    mask = filter_mask(period_df, selected_categories, selected_subcats, selected_people, selected_sources, search_term, search_field)
+    filtered_df = period_df.loc[mask].copy()
+
+@st.fragment
+def render_dashboard():
+    """Charts and Transaction Editor; widget interactions here rerun only this fragment."""
+    supabase_calls.fragment_run("dashboard")
     st.subheader(f"📅 PERIOD: {start_date.strftime('%b %d, %Y')} - {end_date.strftime('%b %d, %Y')}")
     st.divider()
 
-    mask = (df_history['Date'].dt.date >= start_date) & (df_history['Date'].dt.date <= end_date) & (df_history['Category'].isin(selected_categories)) & (df_history['SubCategory'].isin(selected_subcats) | (df_history['SubCategory'] == '')) & (df_history['Person'].isin(selected_people)) & (df_history['Source'].isin(selected_sources))
-    
-    if search_term:
-        keywords = [k.strip() for k in search_term.replace(',', ' ').split() if k.strip()]
-        if keywords:
-            pattern = '|'.join(keywords)
-            if search_field == "Name":
-                mask = mask & df_history['Name'].astype(str).str.contains(pattern, case=False, na=False)
-            elif search_field == "Description":
-                mask = mask & df_history['Description'].astype(str).str.contains(pattern, case=False, na=False)
-            else:
-                mask = mask & (df_history['Name'].astype(str).str.contains(pattern, case=False, na=False) | df_history['Description'].astype(str).str.contains(pattern, case=False, na=False))
-
-    filtered_df = df_history.loc[mask].copy()
-
-    total_spending = filtered_df[filtered_df['Amount'] < 0]['Amount'].sum()  # Negative number
-    total_income = filtered_df[filtered_df['Amount'] > 0]['Amount'].sum()    # Positive number
+    total_spending, total_income, cat_group, p_group = dashboard_totals(filtered_df)
     net_total = total_spending + total_income  # Negative if spent more than earned
-    
-    cat_group = filtered_df.groupby('Category')['Amount'].sum().reset_index()
-    cat_group['AbsAmount'] = cat_group['Amount'].abs()  # For pie chart (needs positive)
-    
-    p_group = filtered_df.groupby('Person')['Amount'].sum().reset_index()
-    p_group['AbsAmount'] = p_group['Amount'].abs()  # For pie chart (needs positive)
 
     col_m1, col_m2, col_m3 = st.columns(3)
     col_m1.metric("💰 Net Total", f"${net_total:,.2f}")
@@ -1425,79 +1121,143 @@ if not df_history.empty and start_date and end_date:
             st.caption(", ".join(sorted(available_subcats)))
 # === END OF QUICK ADD CATEGORY === #
     
-    sort_option = st.selectbox("Sort By:", ["Date (Newest)", "Date (Oldest)", "Amount (Lowest first - Big Spends)", "Amount (Highest first - Income)", "Name (A-Z)", "Name (Z-A)", "Description (A-Z)", "Description (Z-A)", "Native (Click Headers to Sort)"])
+    sort_option = st.selectbox("Sort By:", ["Date (Newest)", "Date (Oldest)", "Amount (Lowest first - Big Spends)", "Amount (Highest first - Income)", "Name (A-Z)", "Name (Z-A)", "Description (A-Z)", "Description (Z-A)", "Native (Click Headers to Sort)"], on_change=reset_transaction_editor)
 
-    # Bulk Actions - Multi-Select Style
+    # Bulk Actions - Multi-Select Style (a form, so ticking boxes doesn't rerun anything)
     with st.expander("⚡ Bulk Actions", expanded=False):
-        st.markdown("**Select actions and click Apply:**")
+        with st.form("bulk_actions_form", border=False):
+            st.markdown("**Select actions and click Apply (applies to the current page):**")
         
-        col_b1, col_b2, col_b3, col_b4 = st.columns(4)
+            col_b1, col_b2, col_b3, col_b4 = st.columns(4)
         
-        with col_b1:
-            st.markdown("**🔒 Lock**")
-            lock_all = st.checkbox("Lock All", key="bulk_lock_all")
-            unlock_all = st.checkbox("Unlock All", key="bulk_unlock_all")
+            with col_b1:
+                st.markdown("**🔒 Lock**")
+                lock_all = st.checkbox("Lock All", key="bulk_lock_all")
+                unlock_all = st.checkbox("Unlock All", key="bulk_unlock_all")
         
-        with col_b2:
-            st.markdown("**💲 Amount**")
-            amt_all = st.checkbox("Include All", key="bulk_amt_all")
-            amt_clear = st.checkbox("Clear All", key="bulk_amt_clear")
+            with col_b2:
+                st.markdown("**💲 Amount**")
+                amt_all = st.checkbox("Include All", key="bulk_amt_all")
+                amt_clear = st.checkbox("Clear All", key="bulk_amt_clear")
         
-        with col_b3:
-            st.markdown("**➕ Rules**")
-            rule_all = st.checkbox("Select All", key="bulk_rule_all")
-            rule_clear = st.checkbox("Clear All", key="bulk_rule_clear")
+            with col_b3:
+                st.markdown("**➕ Rules**")
+                rule_all = st.checkbox("Select All", key="bulk_rule_all")
+                rule_clear = st.checkbox("Clear All", key="bulk_rule_clear")
         
-        with col_b4:
-            st.markdown("**🗑️ Delete**")
-            del_all = st.checkbox("Select All", key="bulk_del_all")
-            del_clear = st.checkbox("Clear All", key="bulk_del_clear")
+            with col_b4:
+                st.markdown("**🗑️ Delete**")
+                del_all = st.checkbox("Select All", key="bulk_del_all")
+                del_clear = st.checkbox("Clear All", key="bulk_del_clear")
         
-        if st.button("▶️ Apply Selected Actions", use_container_width=True, type="primary"):
-            if 'transaction_editor' in st.session_state:
-                del st.session_state['transaction_editor']
+            if st.form_submit_button("▶️ Apply Selected Actions", use_container_width=True, type="primary"):
+                if 'transaction_editor' in st.session_state:
+                    del st.session_state['transaction_editor']
             
-            actions = []
-            if lock_all:
-                actions.append('select_lock')
-            if unlock_all:
-                actions.append('clear_lock')
-            if amt_all:
-                actions.append('select_amt')
-            if amt_clear:
-                actions.append('clear_amt')
-            if rule_all:
-                actions.append('select_rule')
-            if rule_clear:
-                actions.append('clear_rule')
-            if del_all:
-                actions.append('select_delete')
-            if del_clear:
-                actions.append('clear_delete')
+                actions = []
+                if lock_all:
+                    actions.append('select_lock')
+                if unlock_all:
+                    actions.append('clear_lock')
+                if amt_all:
+                    actions.append('select_amt')
+                if amt_clear:
+                    actions.append('clear_amt')
+                if rule_all:
+                    actions.append('select_rule')
+                if rule_clear:
+                    actions.append('clear_rule')
+                if del_all:
+                    actions.append('select_delete')
+                if del_clear:
+                    actions.append('clear_delete')
             
-            if actions:
-                st.session_state['bulk_actions'] = actions
+                if actions:
+                    st.session_state['bulk_actions'] = actions
+                    rerun_fragment()
+
+        # Set-based actions on every row matching the sidebar filters, not just this page
+        st.markdown("---")
+        matching_ids = filtered_df['id'].dropna().tolist()
+        unlocked_ids = filtered_df.loc[~filtered_df['Locked'], 'id'].dropna().tolist()
+        st.markdown(f"**All {len(matching_ids):,} matching transactions** (locked rows are skipped by trash and recategorize):")
+        col_m1, col_m2, col_m3 = st.columns(3)
+        if col_m1.button("🔒 Lock all matching", key="bulk_lock_matching", use_container_width=True, disabled=not matching_ids):
+            updated = update_expenses_by_ids(unlocked_ids, {"locked": True})
+            reset_transaction_editor()
+            st.toast(f"🔒 Locked {updated} transactions", icon="✅")
+            st.rerun()
+        if col_m2.button("🔓 Unlock all matching", key="bulk_unlock_matching", use_container_width=True, disabled=not matching_ids):
+            locked_ids = filtered_df.loc[filtered_df['Locked'], 'id'].dropna().tolist()
+            updated = update_expenses_by_ids(locked_ids, {"locked": False})
+            reset_transaction_editor()
+            st.toast(f"🔓 Unlocked {updated} transactions", icon="✅")
+            st.rerun()
+        if col_m3.button("🗑️ Move all matching to trash", key="bulk_trash_matching", use_container_width=True, disabled=not unlocked_ids):
+            st.session_state['confirm_trash_matching'] = True
+        if st.session_state.get('confirm_trash_matching', False):
+            st.warning(f"⚠️ Move **{len(unlocked_ids):,}** unlocked matching transactions to the Recycle Bin?")
+            col_tm1, col_tm2 = st.columns(2)
+            if col_tm1.button("✅ Yes, Move", key="confirm_trash_matching_yes", type="primary", use_container_width=True):
+                trash_rows = filtered_df[filtered_df['id'].isin(unlocked_ids)]
+                move_to_trash(trash_rows)
+                delete_expenses(unlocked_ids)
+                st.session_state['confirm_trash_matching'] = False
+                reset_transaction_editor()
+                st.toast(f"🗑️ Moved {len(unlocked_ids)} items to Recycle Bin", icon="✅")
                 st.rerun()
+            if col_tm2.button("❌ Cancel", key="confirm_trash_matching_no", use_container_width=True):
+                st.session_state['confirm_trash_matching'] = False
+                rerun_fragment()
+
+        col_r1, col_r2, col_r3 = st.columns(3)
+        recat_cat = col_r1.selectbox("Category", available_cats, key="bulk_recat_cat")
+        recat_sub = col_r2.selectbox("Sub-Category", ["(keep)", ""] + available_subcats, key="bulk_recat_sub")
+        recat_person = col_r3.selectbox("Person", ["(keep)"] + available_people, key="bulk_recat_person")
+        if st.button("🏷️ Recategorize all matching", key="bulk_recat_matching", use_container_width=True, disabled=not unlocked_ids or not recat_cat):
+            values = {"category": recat_cat}
+            if recat_sub != "(keep)":
+                values["subcategory"] = recat_sub
+            if recat_person != "(keep)":
+                values["person"] = recat_person
+            updated = update_expenses_by_ids(unlocked_ids, values)
+            reset_transaction_editor()
+            st.toast(f"🏷️ Recategorized {updated} transactions as {recat_cat}", icon="✅")
+            st.rerun()
 
     if not filtered_df.empty:
-        filtered_df_display = filtered_df.copy()
+        ordered_df = filtered_df
         
         if sort_option == "Date (Newest)":
-            filtered_df_display = filtered_df_display.sort_values(by="Date", ascending=False)
+            ordered_df = filtered_df.sort_values(by="Date", ascending=False)
         elif sort_option == "Date (Oldest)":
-            filtered_df_display = filtered_df_display.sort_values(by="Date", ascending=True)
+            ordered_df = filtered_df.sort_values(by="Date", ascending=True)
         elif sort_option == "Amount (Lowest first - Big Spends)":
-            filtered_df_display = filtered_df_display.sort_values(by="Amount", ascending=True)
+            ordered_df = filtered_df.sort_values(by="Amount", ascending=True)
         elif sort_option == "Amount (Highest first - Income)":
-            filtered_df_display = filtered_df_display.sort_values(by="Amount", ascending=False)
+            ordered_df = filtered_df.sort_values(by="Amount", ascending=False)
         elif sort_option == "Name (A-Z)":
-            filtered_df_display = filtered_df_display.sort_values(by="Name", ascending=True)
+            ordered_df = filtered_df.sort_values(by="Name", ascending=True)
         elif sort_option == "Name (Z-A)":
-            filtered_df_display = filtered_df_display.sort_values(by="Name", ascending=False)
+            ordered_df = filtered_df.sort_values(by="Name", ascending=False)
         elif sort_option == "Description (A-Z)":
-            filtered_df_display = filtered_df_display.sort_values(by="Description", ascending=True)
+            ordered_df = filtered_df.sort_values(by="Description", ascending=True)
         elif sort_option == "Description (Z-A)":
-            filtered_df_display = filtered_df_display.sort_values(by="Description", ascending=False)
+            ordered_df = filtered_df.sort_values(by="Description", ascending=False)
+
+        # Only the current page is sent to the editor; the rest stays server-side
+        total_rows = len(ordered_df)
+        col_pg1, col_pg2, col_pg3 = st.columns([1, 1, 2])
+        page_size = col_pg1.selectbox("Rows per page", EDITOR_PAGE_SIZES, index=1, key="editor_page_size", on_change=reset_transaction_editor)
+        page_count = max(1, -(-total_rows // page_size))
+        if st.session_state.get('editor_page', 1) > page_count:
+            st.session_state['editor_page'] = page_count
+        page = col_pg2.number_input("Page", min_value=1, max_value=page_count, step=1, key="editor_page", on_change=reset_transaction_editor)
+        page_start = (page - 1) * page_size
+        page_end = min(page_start + page_size, total_rows)
+        col_pg3.markdown("<br>", unsafe_allow_html=True)
+        col_pg3.caption(f"Showing {page_start + 1:,}–{page_end:,} of {total_rows:,} transactions (page {page} of {page_count})")
+        filtered_df_display = ordered_df.iloc[page_start:page_end].copy()
 
         filtered_df_display['Date'] = filtered_df_display['Date'].dt.date
         filtered_df_display['Delete'] = False
@@ -1507,6 +1267,9 @@ if not df_history.empty and start_date and end_date:
         if 'Name' not in filtered_df_display.columns:
             filtered_df_display['Name'] = ''
 
+        # Snapshot before bulk actions so Save can tell which rows really changed
+        page_original = filtered_df_display.copy()
+
         # Apply bulk actions from session state (supports multiple)
         bulk_actions = st.session_state.get('bulk_actions', [])
         
@@ -1573,7 +1336,7 @@ if not df_history.empty and start_date and end_date:
         if delete_clicked and delete_count > 0:
             st.session_state['rows_to_delete'] = rows_to_delete.copy()
             st.session_state['confirm_delete_selected'] = True
-            st.rerun()
+            rerun_fragment()
 
         if st.session_state.get('confirm_delete_selected', False):
             saved_rows = st.session_state.get('rows_to_delete', pd.DataFrame())
@@ -1598,7 +1361,7 @@ if not df_history.empty and start_date and end_date:
                 if col_confirm2.button("❌ Cancel", key="confirm_del_no", use_container_width=True):
                     st.session_state['confirm_delete_selected'] = False
                     st.session_state['rows_to_delete'] = None
-                    st.rerun()
+                    rerun_fragment()
             else:
                 st.session_state['confirm_delete_selected'] = False
 
@@ -1678,7 +1441,7 @@ if not df_history.empty and start_date and end_date:
                     continue
                 
                 if row.get('Create Rule', False):
-                    desc_text = str(row['Description']).lower().strip()
+                    desc_text = make_keyword('substring', row['Description'])  # the description as plain text, whatever it starts with
                     name = row.get('Name', '')
                     cat = row.get('Category')
                     sub = row.get('SubCategory', '')
@@ -1699,6 +1462,10 @@ if not df_history.empty and start_date and end_date:
                         person = 'Family'
                     
                     rule_amount = row['Amount'] if row.get('Include Amt', False) else None
+                    problems = invalid_keywords([desc_text])
+                    if problems:
+                        rule_errors.append(f"'{desc_text[:30]}': {problems[desc_text]}")
+                        continue
                     
                     try:
                         new_rule = pd.DataFrame([{
@@ -1725,7 +1492,7 @@ if not df_history.empty and start_date and end_date:
             if rules_created > 0:
                 st.toast(f"✅ Created {rules_created} new rules!", icon="🧠")
             
-            # === SAVE ALL TRANSACTIONS ===
+            # === SAVE THIS PAGE ===
             try:
                 save_df = edited_df[edited_df['Delete'] == False].drop(
                     columns=['Delete', 'Create Rule', 'Include Amt'], errors='ignore'
@@ -1736,7 +1503,8 @@ if not df_history.empty and start_date and end_date:
                 save_df['Person'] = save_df['Person'].fillna('Family').replace('', 'Family')
                 save_df['Name'] = save_df['Name'].fillna('')
                 
-                existing_rows = save_df[save_df['id'].notna()].copy()
+                # Only write rows on this page that were actually edited
+                existing_rows = changed_rows(page_original, save_df[save_df['id'].notna()], ['Locked', 'Date', 'Name', 'Description', 'Amount', 'Category', 'SubCategory', 'Person']).copy()
                 new_rows = save_df[save_df['id'].isna()].copy()
                 
                 if not existing_rows.empty:
@@ -1757,5 +1525,73 @@ if not df_history.empty and start_date and end_date:
                 st.error(f"❌ Error saving transactions: {e}")
                 st.exception(e)
 
+
+if not df_history.empty and start_date and end_date:
+    render_dashboard()
 else:
     st.info("👋 Upload a file or Paste Text in the sidebar to begin!")
+
+# ============================================
+# PERFORMANCE PANEL
+# ============================================
+profiler.mark("Performance panel")
+
+def performance_panel():
+    with st.expander("⚡ Performance", expanded=False, key="perf_expander", on_change="rerun") as panel:
+        if not panel.open:
+            return
+        calls_df = supabase_calls.frame()
+        this_run = calls_df[calls_df['run'] == supabase_calls.run]
+        st.caption(
+            f"This rerun: {len(this_run)} Supabase calls, {int(this_run['rows'].sum()):,} rows, "
+            f"{this_run['payload_bytes'].sum() / 1024:,.1f} KB sent, {this_run['ms'].sum():,.0f} ms"
+            + (f" (p50 {this_run['ms'].quantile(0.5):,.0f} ms, p95 {this_run['ms'].quantile(0.95):,.0f} ms)" if not this_run.empty else "")
+        )
+        st.caption(f"Session: {len(calls_df):,} calls over {supabase_calls.run} reruns")
+        memo = match_memo.stats()
+        lookups = memo['hits'] + memo['misses']
+        if lookups:
+            st.caption(f"Rule matching (all sessions): {memo['hits'] / lookups:.0%} of {lookups:,} lookups served from the memo, {memo['entries']:,} entries cached")
+        st.dataframe(latency_summary(calls_df), hide_index=True, use_container_width=True)
+        st.download_button(
+            "⬇️ Export Calls (CSV)", data=calls_df.to_csv(index=False), file_name="supabase_calls.csv",
+            mime="text/csv", use_container_width=True, disabled=calls_df.empty
+        )
+
+def profile_overlay():
+    sections = profiler.section_summary()
+    st.markdown("**⏱️ Rerun Profile**")
+    if sections.empty:
+        st.caption("Timings appear after the next full rerun.")
+        return
+    complete_runs = sum(1 for run in profiler.runs if run['complete'])
+    st.caption(f"Last rerun {sections['last_s'].sum():.2f}s · mean and p95 over {complete_runs} reruns")
+    st.dataframe(sections, hide_index=True, use_container_width=True)
+    st.dataframe(profiler.function_summary(), hide_index=True, use_container_width=True)
+
+with perf_slot:
+    performance_panel()
+
+profiler.finish()
+metrics.observe('expense_rerun_seconds', time.perf_counter() - rerun_started)
+track_session_memory(current_user)
+if profiler.enabled:
+    with perf_slot:
+        profile_overlay()
+
+if rerun_cprofile is not None:
+    rerun_cprofile.disable()
+    cprofile_text = io.StringIO()
+    pstats.Stats(rerun_cprofile, stream=cprofile_text).sort_stats('cumulative').print_stats(40)
+    rerun_cprofile.create_stats()
+    st.session_state['cprofile_report'] = (cprofile_text.getvalue(), marshal.dumps(rerun_cprofile.stats))
+
+if st.session_state.get('cprofile_report'):
+    cprofile_report, cprofile_data = st.session_state['cprofile_report']
+    with st.expander("🧪 cProfile of One Rerun (top 40 by cumulative time)", expanded=True):
+        st.code(cprofile_report, language=None)
+        col_prof1, col_prof2 = st.columns(2)
+        col_prof1.download_button("⬇️ Download .prof", data=cprofile_data, file_name="rerun.prof", mime="application/octet-stream", use_container_width=True)
+        if col_prof2.button("✖️ Dismiss", use_container_width=True, key="cprofile_dismiss"):
+            del st.session_state['cprofile_report']
+            st.rerun()
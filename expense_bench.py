@@ -0,0 +1,690 @@
+"""Synthetic benchmarks for the expense tracker's hot paths.
+
+    python expense_bench.py run [--size small|medium|large] [--seed 42] [--out results.json]
+    python expense_bench.py e2e [--size small] [--latency-ms 40] [--jitter-ms 20]
+    python expense_bench.py load [--sessions 1 5 10 20] [--users 4] [--actions 20]
+    python expense_bench.py compare benchmarks/small-abc123.json benchmarks/small-def456.json
+
+`run` builds a seeded, realistic history (transactions over several years and
+sources, merchant descriptions, keyword rules some of which are amount-specific),
+times each case with the same code the app uses (expense_core) and writes the
+results as JSON, by default to benchmarks/<size>-<commit>.json. No database is
+needed. `e2e` drives the whole app with Streamlit's AppTest against an in-memory
+Supabase (expense_fakedb) with injected latency, through a scripted session (login,
+filter, edit and save, import, backup) and reports each interaction's wall time and
+request count, to benchmarks/e2e-<size>-<commit>.json. Interactions inside a fragment
+are timed twice: as a full rerun (how every interaction ran before the panels became
+fragments) and as the fragment-only rerun Streamlit now does (the *_fragment steps). `load` runs N such sessions
+at once in this process, the way one Streamlit server serves many tabs, replaying a
+random mix of browsing, searches, edits and imports, and reports throughput, tail
+latency, CPU and RSS for each session count. `compare` prints the
+median-time ratio per case and exits with status 1 when any case got slower than
+--threshold, so it can gate a CI job.
+"""
+import argparse
+import contextlib
+import datetime
+import functools
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import random
+import resource
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from streamlit.logger import set_log_level
+from streamlit.testing.v1 import local_script_runner
+import expense_core
+from expense_fakedb import FakeSupabase
+from expense_core import (
+    RuleSet, prepare_rules, get_match, fill_from_rules, reapply_rules, prepare_records, parse_statement,
+    filter_mask, dashboard_totals, changed_rows
+)
+
+# Rule matching is timed on a sample of rows (match_rows)
+SIZES = {
+    'small':  {'transactions': 10_000,    'rules': 100,    'sources': 5,  'match_rows': 500, 'records_rows': 10_000, 'statement_rows': 10_000},
+    'medium': {'transactions': 100_000,   'rules': 2_000,  'sources': 20, 'match_rows': 100, 'records_rows': 20_000, 'statement_rows': 100_000},
+    'large':  {'transactions': 1_000_000, 'rules': 20_000, 'sources': 50, 'match_rows': 20,  'records_rows': 50_000, 'statement_rows': 200_000},
+}
+EDITOR_PAGE_ROWS = 1000  # largest page of the Transaction Editor
+BENCH_DIR = "benchmarks"
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "expense_app.py")
+E2E_USER = "bench"
+E2E_PASTE_ROWS = 50
+# Interaction mix of a simulated session in `load`, as relative weights
+LOAD_MIX = {'browse': 50, 'search': 25, 'edit': 15, 'import': 10}
+LOAD_SEARCHES = ['cafe', 'star', 'mart', 'deli', 'hong kong', 'online', 'tokyo', 'card 01']
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'sun', 'tek', 'vo', 'zen', 'bar', 'cor', 'del', 'fin', 'gro', 'hal', 'jet', 'mar',
+             'nor', 'pel', 'qui', 'sto', 'tra', 'ul', 'ven', 'wex', 'yo', 'pho', 'star', 'mart', 'cafe', 'deli']
+CITIES = ['HONG KONG', 'KOWLOON', 'LONDON', 'SINGAPORE', 'NEW YORK', 'SEATTLE', 'ONLINE', 'TOKYO']
+CATEGORIES = ['Groceries', 'Dining', 'Transport', 'Utilities', 'Shopping', 'Health', 'Travel', 'Entertainment', 'Salary', 'Transfer/Payment']
+PEOPLE = ['Family', 'Alex', 'Sam', 'Kids']
+
+def merchant_names(count, rng):
+    """`count` distinct upper-case merchant names of 1-3 made-up words."""
+    names = set()
+    while len(names) < count:
+        words = [''.join(rng.choice(SYLLABLES, size=rng.integers(2, 4))) for _ in range(rng.integers(1, 4))]
+        names.add(' '.join(words).upper())
+    return sorted(names)
+
+def make_dataset(transactions, rules, sources, seed=42):
+    """(history, rules_df): a seeded history frame shaped like get_expenses() and its rules.
+
+    Merchant popularity is Zipf-like, about 80% of transactions hit a rule and the rest
+    are unknown merchants (the full-scan worst case for matching).
+    """
+    rng = np.random.default_rng(seed)
+    merchants = merchant_names(int(rules * 1.25) + 50, rng)
+    known = merchants[:rules]
+    unknown = merchants[rules:]
+
+    weights = 1.0 / np.arange(1, len(known) + 1)
+    picks = rng.choice(len(known), size=transactions, p=weights / weights.sum())
+    is_known = rng.random(transactions) < 0.8
+    names = np.where(is_known, np.array(known, dtype=object)[picks], np.array(unknown, dtype=object)[rng.integers(0, len(unknown), transactions)])
+    refs = rng.integers(1000, 99999, transactions).astype(str)
+    descriptions = pd.Series(names) + ' #' + refs + ' ' + pd.Series(rng.choice(CITIES, transactions))
+
+    merchant_category = {m: CATEGORIES[i % len(CATEGORIES)] for i, m in enumerate(merchants)}
+    days = rng.integers(0, 5 * 365, transactions)
+    amounts = -np.round(rng.lognormal(3.5, 1.0, transactions), 2)
+    income = rng.random(transactions) < 0.03
+    amounts[income] = np.round(rng.uniform(1000, 8000, income.sum()), 2)
+    history = pd.DataFrame({
+        'id': np.arange(1, transactions + 1),
+        'Date': pd.Timestamp('2021-01-01') + pd.to_timedelta(days, unit='D'),
+        'Description': descriptions,
+        'Amount': amounts,
+        'Source': rng.choice([f"Card {i:02d}" for i in range(sources)], transactions),
+        'Name': np.where(is_known, pd.Series(names).str.title(), ''),
+        'Category': np.where(is_known, pd.Series(names).map(merchant_category), 'Uncategorized'),
+        'SubCategory': np.where(rng.random(transactions) < 0.5, '', 'General'),
+        'Person': rng.choice(PEOPLE, transactions),
+        'Locked': rng.random(transactions) < 0.1,
+    }).sort_values('Date', kind='mergesort').reset_index(drop=True)
+
+    # ~5% of rules only apply to one amount, as when a rule is created with "Include Amt"
+    rule_amounts = np.where(rng.random(rules) < 0.05, -np.round(rng.lognormal(3.5, 1.0, rules), 2), np.nan)
+    rules_df = pd.DataFrame({
+        'id': np.arange(1, rules + 1),
+        'Keyword': [m.lower() for m in known],
+        'Name': [m.title() for m in known],
+        'Category': [merchant_category[m] for m in known],
+        'SubCategory': '',
+        'Person': 'Family',
+        'Amount': rule_amounts,
+    })
+    return history, rules_df
+
+def make_statement(history, rows, seed=42):
+    """A raw bank export like the import tab receives: text amounts with CR/DR, commas and $."""
+    sample = history.sample(n=min(rows, len(history)), random_state=seed, replace=rows > len(history))
+    amounts = sample['Amount'].abs().map('${:,.2f}'.format) + np.where(sample['Amount'] < 0, ' DR', ' CR')
+    return pd.DataFrame({
+        'Transaction Date': sample['Date'].dt.strftime('%Y-%m-%d').values,
+        'Description': sample['Description'].values,
+        'Amount (HKD)': amounts.values,
+    })
+
+def time_case(fn, repeat, items):
+    """Run `fn` `repeat` times; min/median/mean seconds and microseconds per item of the median."""
+    runs = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - started)
+    median = statistics.median(runs)
+    return {
+        'items': items,
+        'repeat': repeat,
+        'min_s': round(min(runs), 6),
+        'median_s': round(median, 6),
+        'mean_s': round(statistics.fmean(runs), 6),
+        'per_item_us': round(median / max(items, 1) * 1e6, 3),
+    }
+
+def build_cases(history, rules_df, params, seed):
+    """{name: (fn, items)} for every benchmarked hot path."""
+    rng = np.random.default_rng(seed)
+    match_sample = history.sample(n=min(params['match_rows'], len(history)), random_state=seed)
+    pairs = list(zip(match_sample['Description'], match_sample['Amount']))
+
+    imported = match_sample.assign(Name='', Category='Uncategorized', SubCategory='', Person='')
+    unlocked = match_sample.assign(Locked=False)
+    records = history.head(params['records_rows'])
+    statement = make_statement(history, params['statement_rows'], seed)
+
+    categories = [c for c in history['Category'].unique() if c != 'Transfer/Payment']
+    subcats = history['SubCategory'].unique().tolist()
+    people = history['Person'].unique().tolist()
+    sources = history['Source'].unique().tolist()[:max(1, history['Source'].nunique() * 3 // 4)]
+    search = history['Description'].iloc[len(history) // 2].split()[0].lower()
+    filtered = history[filter_mask(history, categories, subcats, people, sources)]
+
+    page = history.head(EDITOR_PAGE_ROWS)
+    edited = page.copy()
+    touched = rng.choice(len(page), size=max(1, len(page) // 100), replace=False)
+    edited.iloc[touched, edited.columns.get_loc('Category')] = 'Shopping'
+    diff_cols = ['Locked', 'Date', 'Name', 'Description', 'Amount', 'Category', 'SubCategory', 'Person']
+
+    compiled = RuleSet(rules_df)
+
+    def get_match_rows():
+        rules = prepare_rules(rules_df)  # once per batch, as per-row callers do
+        return [get_match(desc, amount, rules) for desc, amount in pairs]
+
+    return {
+        'compile_rules': (lambda: RuleSet(rules_df), len(rules_df)),
+        'match_compiled': (lambda: [compiled.find(desc, amount) for desc, amount in pairs], len(pairs)),
+        'get_match': (get_match_rows, len(pairs)),
+        'fill_from_rules': (lambda: fill_from_rules(imported, rules_df), len(imported)),
+        'reapply_rules': (lambda: reapply_rules(unlocked.copy(), rules_df), len(unlocked)),
+        'prepare_records': (lambda: prepare_records(records), len(records)),
+        'parse_statement': (lambda: parse_statement(statement, 'Bench Card'), len(statement)),
+        'filter_mask': (lambda: filter_mask(history, categories, subcats, people, sources), len(history)),
+        'filter_mask_search': (lambda: filter_mask(history, categories, subcats, people, sources, search, "Both"), len(history)),
+        'dashboard_totals': (lambda: dashboard_totals(filtered), len(filtered)),
+        'editor_diff': (lambda: changed_rows(page, edited, diff_cols), len(page)),
+    }
+
+def git_commit():
+    """(short sha, dirty) of the working tree, or ('unknown', False) outside a git checkout."""
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+def cmd_run(args):
+    params = dict(SIZES[args.size])
+    for key in ('transactions', 'rules', 'match_rows'):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    started = time.perf_counter()
+    history, rules_df = make_dataset(params['transactions'], params['rules'], params['sources'], args.seed)
+    cases = build_cases(history, rules_df, params, args.seed)
+    print(f"Generated {len(history):,} transactions and {len(rules_df):,} rules in {time.perf_counter() - started:.1f}s")
+
+    selected = args.only or list(cases)
+    unknown = [name for name in selected if name not in cases]
+    if unknown:
+        raise SystemExit(f"Unknown case(s): {', '.join(unknown)} (have: {', '.join(cases)})")
+
+    results = {}
+    for name in selected:
+        fn, items = cases[name]
+        results[name] = time_case(fn, args.repeat, items)
+        r = results[name]
+        print(f"{name:<20} {r['median_s']:>10.4f}s median  {r['per_item_us']:>12.2f}us/item  ({items:,} items)")
+
+    write_report(args, params, results, args.size)
+
+def write_report(args, params, results, prefix):
+    """Save results with enough metadata to tell runs apart; default name is <prefix>-<commit>.json."""
+    sha, dirty = git_commit()
+    report = {
+        'meta': {
+            'commit': sha,
+            'dirty': dirty,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'size': args.size,
+            'seed': args.seed,
+            'params': params,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': f"{platform.system()} {platform.machine()}",
+        },
+        'results': results,
+    }
+    out = args.out or os.path.join(BENCH_DIR, f"{prefix}-{sha}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+
+def widget(widgets, label):
+    """The AppTest widget with this label (labels are stable, positions are not)."""
+    return next(w for w in widgets if w.label == label)
+
+def app_secrets(users):
+    """secrets.toml contents that know `users` (password = user name), each on its own fake URL."""
+    return {
+        "users": {user: user for user in users},
+        "licenses": {**{f"{user}_account": "BENCH" for user in users}, **{f"{user}_expiry": "2999-12-31" for user in users}},
+        "supabase": {**{f"{user}_url": f"http://{user}.fake.invalid" for user in users}, **{f"{user}_key": "fake" for user in users}},
+    }
+
+def new_app_test(users, timeout, with_secrets=True):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    if with_secrets:
+        at.secrets.update(app_secrets(users))
+    return at
+
+@contextlib.contextmanager
+def concurrent_app_tests(users):
+    """Let AppTests run at the same time in several threads, as sessions of one server.
+
+    Each AppTest run installs its own st.secrets, Runtime singleton and config patch
+    and tears them down at the end, which races between threads. Inside this block the
+    secrets are installed once (create the AppTests with with_secrets=False), the
+    Runtime seen by scripts is the most recent one set up, and global.appTest stays on.
+    """
+    import streamlit as st
+    from unittest.mock import patch
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.secrets import Secrets
+
+    latest = [None]
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest[0] = cls._instance
+        if latest[0] is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return latest[0]
+
+    secrets, saved_secrets = Secrets(), st.secrets
+    secrets._secrets = app_secrets(users)
+    st.secrets = secrets
+    config.set_option("global.appTest", True)
+    try:
+        with patch.object(Runtime, 'instance', classmethod(instance)), patch.object(Runtime, 'exists', classmethod(lambda cls: True)):
+            yield
+    finally:
+        config.set_option("global.appTest", False)
+        st.secrets = saved_secrets
+
+def log_in(at, user):
+    at.text_input(key="username").input(user)
+    at.text_input(key="password").input(user)
+    widget(at.button, "Login").click()
+
+def run_fragment(at, name):
+    """at.run(), but rerun only the fragment function `name`, as a widget inside it does in the browser.
+
+    AppTest always reruns the whole script; here its runner gets the fragment's id
+    the way Streamlit's session passes it. The element tree afterwards holds only
+    that fragment's elements.
+    """
+    fragment_id = next(fid for fid, fn in at._fragment_storage._fragments.items()
+                       if any(getattr(cell.cell_contents, '__name__', None) == name for cell in fn.__closure__ or ()))
+    rerun_data = local_script_runner.RerunData
+    local_script_runner.RerunData = functools.partial(rerun_data, fragment_id_queue=[fragment_id])
+    try:
+        at.run()
+    finally:
+        local_script_runner.RerunData = rerun_data
+
+def e2e_steps(statement_csv):
+    """The scripted session as (name, action): each action sets widgets on the AppTest before its timed run.
+
+    An action that returns a fragment's function name is timed as a rerun of that fragment only.
+    """
+    def filter_category(at):
+        selected = at.multiselect(key="cat_filter").value
+        at.multiselect(key="cat_filter").unselect(selected[0])
+
+    def lock_page(at):
+        at.checkbox(key="bulk_lock_all").check()
+        widget(at.button, "▶️ Apply Selected Actions").click()
+
+    def paste(at):
+        at.text_area(key="paste_area").input(statement_csv)
+        widget(at.button, "Process Pasted Data").click()
+
+    def editor_page(page, fragment=None):
+        def action(at):
+            at.number_input(key="editor_page").set_value(page)
+            return fragment
+        return action
+
+    def open_rules(at):
+        at.session_state["rules_expander"] = True
+
+    def rule_sort(option, fragment=None):
+        def action(at):
+            at.radio(key="rule_sort").set_value(option)
+            return fragment
+        return action
+
+    return [
+        ("open", lambda at: None),
+        ("login", lambda at: log_in(at, E2E_USER)),
+        ("idle_rerun", lambda at: None),
+        ("search", lambda at: widget(at.text_input, "Search").input("cafe")),
+        ("filter_category", filter_category),
+        ("clear_search", lambda at: widget(at.text_input, "Search").input("")),
+        ("editor_page", editor_page(2)),
+        ("editor_page_fragment", editor_page(1, "render_dashboard")),
+        ("open_rules", open_rules),
+        ("rule_sort", rule_sort("Category")),
+        ("rule_sort_fragment", rule_sort("Name", "manage_rules_panel")),
+        ("lock_page", lock_page),
+        ("save_page", lambda at: widget(at.button, "💾 Save Changes & Create Rules").click()),
+        ("paste_mode", lambda at: widget(at.radio, "Input Method:").set_value("Paste Text")),
+        ("paste_import", paste),
+        ("backup", lambda at: widget(at.button, "📥 Create Backup").click()),
+    ]
+
+def run_session(fake, steps, timeout):
+    """One scripted session on a fresh AppTest; {step: (seconds, requests by (table, op), problems)}."""
+    at = new_app_test([E2E_USER], timeout)
+    timings = {}
+    for name, action in steps:
+        fragment = action(at)
+        fragment = fragment if isinstance(fragment, str) else None  # widget setters return the widget
+        fake.take_requests()
+        started = time.perf_counter()
+        if fragment:
+            run_fragment(at, fragment)
+        else:
+            at.run()
+        seconds = time.perf_counter() - started
+        problems = [e.value for e in at.exception] + [e.value for e in at.error]
+        timings[name] = (seconds, fake.take_requests(), problems)
+        if fragment:
+            at.run()  # untimed: bring back the rest of the page for the next step
+    return timings
+
+def cmd_e2e(args):
+    import supabase
+    params = dict(SIZES[args.size])
+    if args.transactions is not None:
+        params['transactions'] = args.transactions
+    if args.rules is not None:
+        params['rules'] = args.rules
+    params.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+
+    history, rules_df = make_dataset(params['transactions'], params['rules'], params['sources'], args.seed)
+    fresh = history.assign(Date=history['Date'] + pd.Timedelta(days=1))
+    statement_csv = make_statement(fresh, E2E_PASTE_ROWS, args.seed).to_csv(index=False)
+    fake = FakeSupabase(args.latency_ms, args.jitter_ms, args.seed)
+    steps = e2e_steps(statement_csv)
+
+    create_client = supabase.create_client
+    supabase.create_client = lambda url, key: fake  # the app imports it on every rerun
+    expense_core.BACKUP_DIR = tempfile.mkdtemp(prefix="expense-bench-")
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            fake.load_frames(history, rules_df, sorted(history['Category'].unique()), ['General'], PEOPLE)
+            expense_core.data_cache.invalidate(E2E_USER)  # every session starts cold
+            runs.append(run_session(fake, steps, args.timeout))
+    finally:
+        supabase.create_client = create_client
+
+    results = {}
+    for name, _ in steps:
+        seconds = [run[name][0] for run in runs]
+        requests = [sum(run[name][1].values()) for run in runs]
+        problems = runs[-1][name][2]
+        median = statistics.median(seconds)
+        results[f"e2e/{name}"] = {
+            'items': 1,
+            'repeat': len(runs),
+            'min_s': round(min(seconds), 6),
+            'median_s': round(median, 6),
+            'mean_s': round(statistics.fmean(seconds), 6),
+            'per_item_us': round(median * 1e6, 3),
+            'requests': int(statistics.median(requests)),
+            'requests_by_op': {f"{table}.{op}": n for (table, op), n in sorted(runs[-1][name][1].items())},
+            'problems': problems,
+        }
+        flag = f"  ! {problems[0][:60]}" if problems else ""
+        print(f"{name:<22} {median:>8.3f}s median  {results[f'e2e/{name}']['requests']:>4} requests{flag}")
+    write_report(args, params, results, f"e2e-{args.size}")
+
+def load_action(at, kind, rng, paste_rows):
+    """Set the widgets for one interaction of `kind`; returns False when it does not apply to this screen."""
+    if kind == 'browse':
+        choice = rng.randrange(3)
+        if choice == 1:
+            page = at.number_input(key="editor_page")
+            page.set_value(rng.randint(int(page.min), int(page.max)))
+        elif choice == 2:
+            categories = at.multiselect(key="cat_filter")
+            option = rng.choice(categories.options)
+            if option in categories.value:
+                categories.unselect(option)
+            else:
+                categories.select(option)
+        return True
+    if kind == 'search':
+        widget(at.text_input, "Search").input(rng.choice(LOAD_SEARCHES) if rng.random() < 0.7 else "")
+        return True
+    if kind == 'edit':
+        if not at.checkbox(key="bulk_lock_all").value and not at.checkbox(key="bulk_unlock_all").value:
+            at.checkbox(key=rng.choice(["bulk_lock_all", "bulk_unlock_all"])).check()
+            widget(at.button, "▶️ Apply Selected Actions").click()
+        else:
+            widget(at.button, "💾 Save Changes & Create Rules").click()
+        return True
+    if kind == 'import':
+        if widget(at.radio, "Input Method:").value != "Paste Text":
+            widget(at.radio, "Input Method:").set_value("Paste Text")
+        else:
+            at.text_area(key="paste_area").input(paste_rows())
+            widget(at.button, "Process Pasted Data").click()
+        return True
+    return False
+
+def load_session(user, users, actions, seed, think_ms, timeout, history, samples):
+    """One simulated user tab: log in, then `actions` weighted-random interactions; appends (kind, seconds, ok)."""
+    rng = random.Random(seed)
+    at = new_app_test(users, timeout, with_secrets=False)
+    pasted = [0]
+
+    def paste_rows():
+        # Dated past the history so every pasted row is new and really gets inserted
+        pasted[0] += 1
+        rows = history.sample(n=5, random_state=rng.randrange(2**32))
+        rows = rows.assign(Date=history['Date'].max() + pd.Timedelta(days=pasted[0]), Description=rows['Description'] + f" S{seed}")
+        return make_statement(rows, len(rows), seed).to_csv(index=False)
+
+    def timed(kind):
+        started = time.perf_counter()
+        try:
+            at.run()
+            ok = not at.exception
+        except Exception:
+            ok = False
+        samples.append((kind, time.perf_counter() - started, ok))
+
+    at.run()
+    log_in(at, user)
+    timed('login')
+    kinds, weights = list(LOAD_MIX), list(LOAD_MIX.values())
+    for _ in range(actions):
+        kind = rng.choices(kinds, weights)[0]
+        try:
+            load_action(at, kind, rng, paste_rows)
+        except (StopIteration, KeyError, ValueError):
+            kind = 'browse'  # the widget isn't on screen (e.g. an empty filter result): just rerun
+        timed(kind)
+        if think_ms:
+            time.sleep(rng.uniform(0, think_ms) / 1000)
+
+def rss_mb():
+    """Resident set size of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_load_level(sessions, users, args, history, fakes):
+    """Run `sessions` concurrent sessions spread over `users`; throughput, latency, CPU and RSS."""
+    samples = []
+    for fake in fakes.values():
+        fake.take_requests()
+    peak = [rss_mb()]
+    baseline = peak[0]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.2):
+            peak[0] = max(peak[0], rss_mb())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    threads = [threading.Thread(target=load_session, args=(users[i % len(users)], users, args.actions, args.seed * 1000 + i,
+                                                           args.think_ms, args.timeout, history, samples))
+               for i in range(sessions)]
+    cpu_started, started = time.process_time(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    done.set()
+    sampler.join()
+
+    latencies = pd.Series([seconds for kind, seconds, ok in samples if kind != 'login']) * 1000
+    by_kind = pd.DataFrame(samples, columns=['kind', 'seconds', 'ok']).groupby('kind')['seconds']
+    return {
+        'sessions': sessions,
+        'interactions': len(latencies),
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'wall_s': round(wall, 3),
+        'throughput_per_s': round(len(latencies) / wall, 2),
+        'p50_ms': round(latencies.quantile(0.5), 1),
+        'p95_ms': round(latencies.quantile(0.95), 1),
+        'p99_ms': round(latencies.quantile(0.99), 1),
+        'max_ms': round(latencies.max(), 1),
+        'p95_ms_by_kind': (by_kind.quantile(0.95) * 1000).round(1).to_dict(),
+        'cpu_pct': round(cpu / wall * 100, 1),
+        'rss_peak_mb': round(peak[0], 1),
+        'rss_per_session_mb': round((peak[0] - baseline) / sessions, 2),
+        'requests': sum(sum(fake.take_requests().values()) for fake in fakes.values()),
+    }
+
+def cmd_load(args):
+    import supabase
+    params = dict(SIZES[args.size])
+    if args.transactions is not None:
+        params['transactions'] = args.transactions
+    if args.rules is not None:
+        params['rules'] = args.rules
+    params.update(users=args.users, actions=args.actions, think_ms=args.think_ms, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+
+    history, rules_df = make_dataset(params['transactions'], params['rules'], params['sources'], args.seed)
+    users = [f"load{i}" for i in range(args.users)]
+    fakes = {}
+    for user in users:
+        fakes[f"http://{user}.fake.invalid"] = FakeSupabase(args.latency_ms, args.jitter_ms, args.seed)
+        fakes[f"http://{user}.fake.invalid"].load_frames(history, rules_df, sorted(history['Category'].unique()), ['General'], PEOPLE)
+
+    create_client = supabase.create_client
+    supabase.create_client = lambda url, key: fakes[url]
+    expense_core.BACKUP_DIR = tempfile.mkdtemp(prefix="expense-load-")
+    results = {}
+    print(f"{'sessions':>8} {'tput/s':>8} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'cpu%':>6} {'rss_mb':>8} {'mb/sess':>8} {'errors':>6}")
+    try:
+        for sessions in args.sessions:
+            for user in users:
+                expense_core.data_cache.invalidate(user)  # each level starts with cold caches
+            with concurrent_app_tests(users):
+                level = run_load_level(sessions, users, args, history, fakes)
+            results[f"load/{sessions}"] = dict(level, median_s=round(level['p50_ms'] / 1000, 6))
+            print(f"{sessions:>8} {level['throughput_per_s']:>8} {level['p50_ms']:>8} {level['p95_ms']:>8} {level['p99_ms']:>8} "
+                  f"{level['cpu_pct']:>6} {level['rss_peak_mb']:>8} {level['rss_per_session_mb']:>8} {level['errors']:>6}")
+    finally:
+        supabase.create_client = create_client
+    write_report(args, params, results, f"load-{args.size}")
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base['meta']['params'] != new['meta']['params']:
+        print("Warning: the runs used different dataset parameters", file=sys.stderr)
+
+    regressions = []
+    print(f"{'case':<20} {'base_s':>10} {'new_s':>10} {'ratio':>7}")
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            print(f"{name:<20} {'-':>10} {result['median_s']:>10.4f} {'new':>7}")
+            continue
+        before = base['results'][name]['median_s']
+        ratio = result['median_s'] / before if before else float('inf')
+        flag = "  SLOWER" if ratio > args.threshold else ""
+        print(f"{name:<20} {before:>10.4f} {result['median_s']:>10.4f} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressions.append(name)
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than {args.threshold}x: {', '.join(regressions)}")
+        sys.exit(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expense tracker benchmarks on synthetic data")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="time the hot paths and write the results as JSON")
+    run.add_argument("--size", choices=list(SIZES), default="small")
+    run.add_argument("--seed", type=int, default=42)
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--transactions", type=int, help="override the size's transaction count")
+    run.add_argument("--rules", type=int, help="override the size's rule count")
+    run.add_argument("--match-rows", type=int, help="rows matched against the rules per repeat")
+    run.add_argument("--only", nargs="+", metavar="CASE", help="run only these cases")
+    run.add_argument("--out", help=f"results file (default: {BENCH_DIR}/<size>-<commit>.json)")
+    run.set_defaults(func=cmd_run)
+
+    e2e = sub.add_parser("e2e", help="time a scripted app session against an in-memory Supabase")
+    e2e.add_argument("--size", choices=list(SIZES), default="small")
+    e2e.add_argument("--seed", type=int, default=42)
+    e2e.add_argument("--repeat", type=int, default=3, help="sessions to run; the median is reported")
+    e2e.add_argument("--transactions", type=int, help="override the size's transaction count")
+    e2e.add_argument("--rules", type=int, help="override the size's rule count")
+    e2e.add_argument("--latency-ms", type=float, default=40.0, help="injected per-request latency")
+    e2e.add_argument("--jitter-ms", type=float, default=20.0, help="extra random latency, up to this much")
+    e2e.add_argument("--timeout", type=float, default=600.0, help="seconds allowed per interaction")
+    e2e.add_argument("--out", help=f"results file (default: {BENCH_DIR}/e2e-<size>-<commit>.json)")
+    e2e.set_defaults(func=cmd_e2e)
+
+    load = sub.add_parser("load", help="run N concurrent simulated sessions per level; throughput, tail latency, CPU, RSS")
+    load.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10, 20], help="concurrent session counts to try")
+    load.add_argument("--users", type=int, default=4, help="distinct users (each with its own fake database)")
+    load.add_argument("--actions", type=int, default=20, help="interactions per session after login")
+    load.add_argument("--think-ms", type=float, default=500.0, help="random pause between a session's interactions, up to this much")
+    load.add_argument("--size", choices=list(SIZES), default="small")
+    load.add_argument("--seed", type=int, default=42)
+    load.add_argument("--transactions", type=int, help="override the size's transaction count")
+    load.add_argument("--rules", type=int, help="override the size's rule count")
+    load.add_argument("--latency-ms", type=float, default=40.0, help="injected per-request latency")
+    load.add_argument("--jitter-ms", type=float, default=20.0, help="extra random latency, up to this much")
+    load.add_argument("--timeout", type=float, default=600.0, help="seconds allowed per interaction")
+    load.add_argument("--out", help=f"results file (default: {BENCH_DIR}/load-<size>-<commit>.json)")
+    load.set_defaults(func=cmd_load)
+
+    compare = sub.add_parser("compare", help="compare two result files; exit 1 on regressions")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    set_log_level("error")
+    # No database and no user: keeps @profiled off Streamlit's session state and writes no rule stats
+    expense_core.use_client(None, None)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
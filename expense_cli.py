@@ -0,0 +1,139 @@
+"""Batch jobs for the expense tracker, without a browser session.
+
+    python expense_cli.py backup  --user alex [--incremental] [--format parquet]
+    python expense_cli.py import  --user alex statements/ [--source "HSBC Credit"]
+    python expense_cli.py reapply --user alex [--full] [--jobs 4]
+
+Credentials come from the same .streamlit/secrets.toml as the app ([supabase]
+<user>_url / <user>_key), and the work is done by the same code (expense_core).
+Example nightly cron entry:
+
+    0 2 * * *  cd /path/to/app && python expense_cli.py backup --user alex --incremental
+
+Saved backups are pruned as they go (see expense_core.BACKUP_KEEP_FULL): after
+EXPENSE_BACKUP_MAX_INCREMENTALS incrementals in a row (30 by default) the next run
+takes a full backup, and a full backup deletes the older chains, keeping the newest
+EXPENSE_BACKUP_KEEP_FULL (1).
+"""
+import argparse
+import os
+import sys
+import streamlit as st
+from streamlit.logger import set_log_level
+from supabase import create_client
+import expense_core
+from expense_core import (
+    WRITE_BATCH_SIZE, fetch_expenses, insert_expenses, upsert_expenses, changed_rows,
+    fetch_rules, parse_statement, fill_from_rules, expense_keys, reapply_rules,
+    changed_rule_keywords, rows_for_keywords, mark_rules_applied, flush_rule_hits,
+    create_saved_backup, format_timings
+)
+import pandas as pd
+
+IMPORT_CHUNK_ROWS = 1000  # CSV rows parsed, matched and inserted at a time
+
+def connect(user):
+    """Bind expense_core to the user's Supabase project from secrets.toml."""
+    if "supabase" not in st.secrets or f"{user}_url" not in st.secrets["supabase"]:
+        raise SystemExit(f"No database configured for '{user}' in .streamlit/secrets.toml")
+    expense_core.use_client(create_client(st.secrets["supabase"][f"{user}_url"], st.secrets["supabase"][f"{user}_key"]), user)
+
+def load_or_exit(what, fetch):
+    """fetch() or exit non-zero: carrying on with an empty frame would re-insert or mis-mark everything."""
+    try:
+        return fetch()
+    except Exception as e:
+        raise SystemExit(f"Error loading {what}: {e}")
+
+def statement_files(paths):
+    """CSV/Excel files named on the command line, with folders expanded (sorted, not recursive)."""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(('.csv', '.xlsx')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def read_statement(path):
+    """Yield raw frames from a statement: CSVs are streamed in chunks, Excel is read whole."""
+    if path.lower().endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=IMPORT_CHUNK_ROWS)
+    else:
+        yield pd.read_excel(path)
+
+def cmd_backup(args):
+    entry = create_saved_backup(args.user, incremental=args.incremental, fmt=args.format)
+    meta = entry['meta']
+    print(f"{entry['kind'].title()} backup {entry['file']}: {meta['total_expenses']} expenses, {meta['total_rules']} rules")
+    print(format_timings(meta.get('timings', {})).replace("  \n", "\n"))
+
+def cmd_import(args):
+    rules_df = load_or_exit("rules", fetch_rules)
+    known = set(expense_keys(load_or_exit("expenses", fetch_expenses)))
+    total = 0
+    for path in statement_files(args.paths):
+        added = 0
+        for raw in read_statement(path):
+            clean = parse_statement(raw, args.source or os.path.basename(path))
+            if clean is None:
+                print(f"{path}: headers missing (need Date, Description, Amount)", file=sys.stderr)
+                break
+            clean = fill_from_rules(clean, rules_df, args.jobs)
+            keys = expense_keys(clean)
+            new = clean[~keys.isin(known)]
+            if not new.empty:
+                insert_expenses(new)
+                known.update(keys[new.index])
+                added += len(new)
+        print(f"{path}: added {added} new transactions")
+        total += added
+    flush_rule_hits()
+    print(f"Imported {total} transactions")
+
+def cmd_reapply(args):
+    df = load_or_exit("expenses", fetch_expenses)
+    rules_df = load_or_exit("rules", fetch_rules)
+    original = df.copy()
+    keywords = None if args.full else changed_rule_keywords(rules_df)
+    rows = None if keywords is None else rows_for_keywords(df, keywords)
+    matched = reapply_rules(df, rules_df, args.jobs, rows=rows)
+    cols = [c for c in ['Name', 'Category', 'SubCategory', 'Person'] if c in df.columns]
+    changed = changed_rows(original.loc[matched], df.loc[matched], cols) if matched else df.iloc[0:0]
+    for i in range(0, len(changed), WRITE_BATCH_SIZE):
+        upsert_expenses(changed.iloc[i:i + WRITE_BATCH_SIZE])
+    if not rules_df.empty:
+        mark_rules_applied(rules_df)  # only reached once every upsert above went through
+    flush_rule_hits()
+    scope = "all transactions" if rows is None else f"{len(rows)} transactions affected by {len(keywords)} rule changes"
+    print(f"Checked {scope}: rules matched {len(matched)}, {len(changed)} changed")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expense tracker batch jobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    backup = sub.add_parser("backup", help="save a full or incremental backup to the backup dir")
+    backup.add_argument("--incremental", action="store_true", help="only rows changed since the last backup")
+    backup.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson", help="full backups only")
+    backup.set_defaults(func=cmd_backup)
+
+    imp = sub.add_parser("import", help="import CSV/Excel statements (files or folders)")
+    imp.add_argument("paths", nargs="+")
+    imp.add_argument("--source", help="Source for rows without one (default: the file name)")
+    imp.set_defaults(func=cmd_import)
+
+    reapply = sub.add_parser("reapply", help="re-apply the rules changed since the last re-apply (all of them the first time)")
+    reapply.add_argument("--full", action="store_true", help="re-check every unlocked transaction")
+    reapply.set_defaults(func=cmd_reapply)
+
+    for command in (backup, imp, reapply):
+        command.add_argument("--user", required=True)
+        command.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="processes for rule matching")
+
+    args = parser.parse_args(argv)
+    set_log_level("error")  # no "missing ScriptRunContext" noise outside `streamlit run`
+    connect(args.user)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
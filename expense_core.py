@@ -0,0 +1,2237 @@
+"""Data access, rules and backup code shared by the Streamlit app (expense_app.py) and the CLI (expense_cli.py).
+
+Nothing here draws UI. Call use_client() with a Supabase client before using any
+function that talks to the database.
+"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import io
+import os
+import gzip
+import shutil
+import hashlib
+import datetime
+import json
+import zipfile
+import time
+import queue
+import threading
+import functools
+import sys
+import bisect
+import re
+import http.server
+import multiprocessing
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Optional: Parquet backups need pyarrow (installed alongside streamlit)
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+_bound = threading.local()
+
+Binding = namedtuple('Binding', 'client user calls profiler')
+
+def _binding():
+    """Binding set on this thread by use_client()/with_client(), else the Streamlit session's."""
+    binding = getattr(_bound, 'binding', None)
+    return binding if binding is not None else st.session_state.get('supabase_binding', Binding(None, None, None, None))
+
+class CallLog:
+    """Supabase requests made for one session, one record per execute(), newest last.
+
+    `run` numbers the script reruns (see new_run()) so per-rerun totals can be shown;
+    a fragment-only rerun is a run of its own, tagged with the fragment (see fragment_run()).
+    """
+
+    def __init__(self, maxlen=5000):
+        self.calls = deque(maxlen=maxlen)
+        self.run = 0
+        self.fragment = None
+
+    def new_run(self, fragment=None):
+        self.run += 1
+        self.fragment = fragment
+
+    def fragment_run(self, fragment):
+        """Call at the top of a fragment: starts a new run if only fragments are rerunning."""
+        ctx = get_script_run_ctx()
+        if ctx is not None and ctx.fragment_ids_this_run:
+            self.new_run(fragment)
+
+    def record(self, table, op, rows, payload_bytes, seconds, error=None):
+        self.calls.append({
+            'run': self.run, 'fragment': self.fragment, 'at': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'table': table, 'op': op, 'rows': rows, 'payload_bytes': payload_bytes,
+            'ms': round(seconds * 1000, 2), 'error': error
+        })
+
+    def frame(self):
+        return pd.DataFrame(list(self.calls), columns=['run', 'fragment', 'at', 'table', 'op', 'rows', 'payload_bytes', 'ms', 'error'])
+
+class InstrumentedQuery:
+    """Wraps a postgrest query builder so execute() is timed into the metrics and, if given, a CallLog."""
+
+    VERBS = {'select', 'insert', 'upsert', 'update', 'delete'}
+
+    def __init__(self, builder, table, calls, op=None, payload_bytes=0):
+        self._builder = builder
+        self._table = table
+        self._calls = calls
+        self._op = op
+        self._payload_bytes = payload_bytes
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            op, payload_bytes = self._op, self._payload_bytes
+            if name in self.VERBS:
+                op = name
+                if name != 'select' and args and self._calls is not None:
+                    payload_bytes = len(json.dumps(args[0], default=str))
+            return InstrumentedQuery(attr(*args, **kwargs), self._table, self._calls, op, payload_bytes)
+        return call
+
+    def execute(self):
+        started = time.perf_counter()
+        try:
+            resp = self._builder.execute()
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            metrics.observe('expense_supabase_request_seconds', seconds, table=self._table, op=self._op)
+            metrics.inc('expense_supabase_errors_total', table=self._table, op=self._op)
+            if self._calls is not None:
+                self._calls.record(self._table, self._op, 0, self._payload_bytes, seconds, str(e)[:200])
+            raise
+        seconds = time.perf_counter() - started
+        metrics.observe('expense_supabase_request_seconds', seconds, table=self._table, op=self._op)
+        if self._calls is not None:
+            rows = len(resp.data) if isinstance(getattr(resp, 'data', None), list) else 0
+            self._calls.record(self._table, self._op, rows, self._payload_bytes, seconds)
+        return resp
+
+class BoundClient:
+    """Stands in for the Supabase client given to use_client().
+
+    One server process runs many sessions (and users with different projects), so
+    the client is kept per thread and in the session state, never module-wide.
+    Table queries are instrumented into the metrics and the binding's CallLog.
+    """
+
+    def __getattr__(self, name):
+        binding = _binding()
+        if binding.client is None:
+            raise RuntimeError("No Supabase client - call use_client() first")
+        if name == 'table':
+            return lambda table_name: InstrumentedQuery(binding.client.table(table_name), table_name, binding.calls)
+        return getattr(binding.client, name)
+
+sb = BoundClient()
+
+def use_client(client, user, calls=None, profiler=None):
+    """Point every function in this module at `client` for this session (or CLI process).
+
+    Data is cached under `user`; requests are recorded in `calls` (a CallLog) and
+    @profiled functions timed into `profiler` (a RerunProfiler) if given.
+    """
+    _bound.binding = Binding(client, user, calls, profiler)
+    st.session_state['supabase_binding'] = _bound.binding
+
+def with_client(fn):
+    """Wrap `fn` to run with the calling thread's client, for thread pool workers."""
+    binding = _binding()
+
+    def run(*args):
+        _bound.binding = binding
+        return fn(*args)
+    return run
+
+class RerunProfiler:
+    """Wall-clock time per script section and per @profiled function, for the last `history` reruns.
+
+    Sections are delimited by mark(): the time since the previous mark is charged
+    to the section that mark opened. Does nothing unless `enabled`.
+    """
+
+    def __init__(self, history=50):
+        self.enabled = False
+        self.runs = deque(maxlen=history)
+        self.current = None
+
+    def start_run(self):
+        self.current = None
+        if self.enabled:
+            self.current = {'at': datetime.datetime.now().isoformat(timespec='seconds'), 'sections': {}, 'functions': {}, 'complete': False}
+            self._section, self._since = "Startup", time.perf_counter()
+            self.runs.append(self.current)
+
+    def mark(self, section):
+        if self.current is None:
+            return
+        now = time.perf_counter()
+        sections = self.current['sections']
+        sections[self._section] = sections.get(self._section, 0.0) + now - self._since
+        self._section, self._since = section, now
+
+    def finish(self):
+        self.mark(None)
+        if self.current is not None:
+            self.current['complete'] = True
+            self.current = None
+
+    def record_function(self, name, seconds):
+        if self.current is not None:
+            calls, total = self.current['functions'].get(name, (0, 0.0))
+            self.current['functions'][name] = (calls + 1, total + seconds)
+
+    def section_summary(self):
+        """Seconds per section: last complete rerun, mean and p95 over the kept history."""
+        runs = [run for run in self.runs if run['complete']]
+        if not runs:
+            return pd.DataFrame(columns=['section', 'last_s', 'mean_s', 'p95_s'])
+        history = pd.DataFrame([run['sections'] for run in runs]).fillna(0.0)
+        return pd.DataFrame({
+            'section': history.columns,
+            'last_s': history.iloc[-1].values,
+            'mean_s': history.mean().values,
+            'p95_s': history.quantile(0.95).values
+        }).round(3)
+
+    def function_summary(self):
+        runs = [run for run in self.runs if run['complete']]
+        if not runs:
+            return pd.DataFrame(columns=['function', 'calls', 'total_s'])
+        rows = [{'function': name, 'calls': calls, 'total_s': round(total, 3)} for name, (calls, total) in runs[-1]['functions'].items()]
+        return pd.DataFrame(rows, columns=['function', 'calls', 'total_s']).sort_values('total_s', ascending=False)
+
+def profiled(fn):
+    """Time `fn` into the bound RerunProfiler while profiling is on."""
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        profiler = _binding().profiler
+        if profiler is None or profiler.current is None:
+            return fn(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.record_function(fn.__name__, time.perf_counter() - started)
+    return run
+
+def latency_summary(calls_df):
+    """Calls, rows, KB sent and p50/p95 latency per table and operation."""
+    if calls_df.empty:
+        return pd.DataFrame(columns=['table', 'op', 'calls', 'rows', 'kb_sent', 'p50_ms', 'p95_ms'])
+    grouped = calls_df.groupby(['table', 'op'], dropna=False)
+    return pd.DataFrame({
+        'calls': grouped.size(),
+        'rows': grouped['rows'].sum(),
+        'kb_sent': (grouped['payload_bytes'].sum() / 1024).round(1),
+        'p50_ms': grouped['ms'].quantile(0.5).round(1),
+        'p95_ms': grouped['ms'].quantile(0.95).round(1)
+    }).reset_index().sort_values('calls', ascending=False)
+
+# Histogram buckets in seconds, shared by every latency metric
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Exporters: a /metrics HTTP endpoint and/or a file rewritten every interval (node_exporter textfile style)
+METRICS_PORT = os.environ.get("EXPENSE_METRICS_PORT")
+METRICS_HOST = os.environ.get("EXPENSE_METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.environ.get("EXPENSE_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("EXPENSE_METRICS_INTERVAL", "15"))
+
+class Metrics:
+    """Process-wide counters, gauges and histograms in the Prometheus text format.
+
+    Series are created on first inc()/set()/observe() with keyword labels; describe()
+    gives a metric its type and help text. Callbacks added with collect() return
+    extra (name, labels, value) samples computed at scrape time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (type, help)
+        self.values = {}      # (name, labels) -> float
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self.collectors = []
+
+    def describe(self, name, kind, text):
+        self.meta[name] = (kind, text)
+
+    def collect(self, callback):
+        self.collectors.append(callback)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+            index = bisect.bisect_left(METRIC_BUCKETS, value)
+            if index < len(METRIC_BUCKETS):  # past the last bucket only counts towards +Inf
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        """Every series in the Prometheus text exposition format (version 0.0.4)."""
+        def fmt(labels):
+            if not labels:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(series) for key, series in self.histograms.items()}
+        for callback in self.collectors:
+            for name, labels, value in callback():
+                values[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        for name in sorted({key[0] for key in values} | {key[0] for key in histograms}):
+            kind, text = self.meta.get(name, ('untyped', ''))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for (series_name, labels), value in sorted(values.items()):
+                if series_name == name:
+                    lines.append(f"{name}{fmt(labels)} {value}")
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name == name:
+                    cumulative = 0
+                    for bound, count in zip(METRIC_BUCKETS, series):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {series[-1]}")
+                    lines.append(f"{name}_sum{fmt(labels)} {series[-2]}")
+                    lines.append(f"{name}_count{fmt(labels)} {series[-1]}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+for _name, _kind, _text in [
+    ('expense_rerun_seconds', 'histogram', 'Wall time of complete app script runs'),
+    ('expense_data_load_seconds', 'histogram', 'Time to load a table into the data cache'),
+    ('expense_rows_loaded_total', 'counter', 'Rows loaded into the data cache'),
+    ('expense_supabase_request_seconds', 'histogram', 'Supabase request latency by table and operation'),
+    ('expense_supabase_errors_total', 'counter', 'Supabase requests that raised, by table and operation'),
+    ('expense_import_rows_total', 'counter', 'Statement rows inserted by imports'),
+    ('expense_import_seconds', 'histogram', 'Time to parse, match and insert one imported statement'),
+    ('expense_import_rows_per_second', 'gauge', 'Throughput of the most recent import'),
+    ('expense_cache_hits_total', 'counter', 'Data cache hits'),
+    ('expense_cache_misses_total', 'counter', 'Data cache misses (loads)'),
+    ('expense_cache_evictions_total', 'counter', 'Data cache entries evicted for the memory budget'),
+    ('expense_cache_hit_ratio', 'gauge', 'Data cache hits / lookups since start'),
+    ('expense_cache_bytes', 'gauge', 'Estimated size of the data cache'),
+    ('expense_cache_entries', 'gauge', 'Entries in the data cache'),
+    ('expense_match_memo_hits_total', 'counter', 'Rule matches served from the match memo'),
+    ('expense_match_memo_misses_total', 'counter', 'Rule matches computed (distinct description/amount per batch)'),
+    ('expense_match_memo_hit_ratio', 'gauge', 'Match memo hits / lookups since start'),
+    ('expense_match_memo_entries', 'gauge', 'Entries in the match memo'),
+    ('expense_sessions', 'gauge', 'Sessions seen in the last hour, by user'),
+    ('expense_session_memory_bytes', 'gauge', 'Estimated session state size summed over the sessions, by user'),
+]:
+    metrics.describe(_name, _kind, _text)
+
+SESSION_MEMORY_INTERVAL = 60  # seconds between re-measuring one session's state
+SESSION_MEMORY_TTL = 3600     # sessions not seen for this long drop out of the gauges
+_session_memory = {}          # session id -> (user, bytes, measured_at)
+
+def track_session_memory(user):
+    """Re-estimate this session's state size for the per-user memory gauge, at most once a minute."""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    entry = _session_memory.get(ctx.session_id)
+    if entry is not None and time.monotonic() - entry[2] < SESSION_MEMORY_INTERVAL:
+        return
+    size = 0
+    for key in list(st.session_state.keys()):
+        try:
+            size += estimate_size(st.session_state[key])
+        except Exception:
+            pass
+    _session_memory[ctx.session_id] = (user, size, time.monotonic())
+
+def _session_samples():
+    now = time.monotonic()
+    for session_id, (user, size, seen) in list(_session_memory.items()):
+        if now - seen > SESSION_MEMORY_TTL:
+            _session_memory.pop(session_id, None)
+    users = {}
+    for user, size, seen in list(_session_memory.values()):
+        count, total = users.get(user, (0, 0))
+        users[user] = (count + 1, total + size)
+    for user, (count, total) in users.items():
+        yield 'expense_sessions', {'user': user}, count
+        yield 'expense_session_memory_bytes', {'user': user}, total
+
+metrics.collect(_session_samples)
+
+def record_import(rows, seconds):
+    """Count one imported statement (rows actually inserted) for the import metrics."""
+    metrics.inc('expense_import_rows_total', rows)
+    metrics.observe('expense_import_seconds', seconds)
+    if seconds > 0:
+        metrics.set('expense_import_rows_per_second', round(rows / seconds, 1))
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+def start_metrics_exporters():
+    """Start the /metrics endpoint (EXPENSE_METRICS_PORT) and/or file dump (EXPENSE_METRICS_FILE) once per process."""
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+    if METRICS_PORT:
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((METRICS_HOST, int(METRICS_PORT)), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    if METRICS_FILE:
+        def dump():
+            while True:
+                write_metrics_file(METRICS_FILE)
+                time.sleep(METRICS_INTERVAL)
+        threading.Thread(target=dump, name="metrics-file", daemon=True).start()
+
+def write_metrics_file(path):
+    """Write the metrics to `path` atomically, so a collector never reads half a file."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(metrics.render())
+    os.replace(tmp, path)
+
+EXP_COLS = {
+    'date': 'Date', 'description': 'Description', 'amount': 'Amount',
+    'name': 'Name', 'category': 'Category', 'subcategory': 'SubCategory', 
+    'source': 'Source', 'person': 'Person', 'locked': 'Locked'
+}
+EXP_COLS_REV = {v: k for k, v in EXP_COLS.items()}
+
+RULES_COLS = {
+    'keyword': 'Keyword', 'name': 'Name', 'category': 'Category',
+    'subcategory': 'SubCategory', 'person': 'Person', 'amount': 'Amount'
+}
+RULES_COLS_REV = {v: k for k, v in RULES_COLS.items()}
+
+# Max ids per set-based request (keeps PostgREST URLs a sane length)
+WRITE_BATCH_SIZE = 500
+
+BACKUP_TABLES = ['expenses', 'rules', 'categories', 'subcategories', 'people', 'deleted_expenses']
+BACKUP_PAGE_SIZE = 1000  # Supabase caps a single select at 1000 rows by default
+BACKUP_FORMAT_VERSION = 2
+PARQUET_SCHEMA_VERSION = 1
+# Rows per insert/upsert during restore; the wide, numerous tables get bigger batches
+RESTORE_BATCH_SIZES = {'expenses': 1000, 'deleted_expenses': 1000}
+# Saved backups, the manifest chaining full and incremental snapshots, and row hashes live here per user
+BACKUP_DIR = os.environ.get("EXPENSE_BACKUP_DIR", os.path.expanduser("~/.expense_app/backups"))
+# Retention of saved backups (plaintext financial data on the server's disk): after each full
+# backup only the newest BACKUP_KEEP_FULL full backups and the incrementals chained on them are
+# kept. An incremental asked for after BACKUP_MAX_INCREMENTALS in a row is taken as a full
+# backup instead, so a nightly incremental job starts a new chain and the old one is deleted.
+BACKUP_KEEP_FULL = int(os.environ.get("EXPENSE_BACKUP_KEEP_FULL", "1"))
+BACKUP_MAX_INCREMENTALS = int(os.environ.get("EXPENSE_BACKUP_MAX_INCREMENTALS", "30"))
+# Memory budget for the process-wide data cache, and how long an entry may serve before a reload
+CACHE_BUDGET_MB = float(os.environ.get("EXPENSE_CACHE_MB", "256"))
+CACHE_TTL_SECONDS = float(os.environ.get("EXPENSE_CACHE_TTL", "300"))
+
+def estimate_size(value):
+    """Rough in-memory size of a cached value in bytes."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+class DataCache:
+    """Process-wide LRU cache of per-user data, shared by all of a user's sessions (tabs).
+
+    Entries are keyed (user, name). The least recently used are evicted once the
+    total estimated size passes `budget_bytes`, and entries older than `ttl`
+    seconds are reloaded so writes made outside this process still show up.
+    Every invalidation bumps the user's version, which sessions compare to notice
+    writes made from another tab.
+    """
+
+    def __init__(self, budget_bytes, ttl):
+        self.budget_bytes = budget_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (user, name) -> (value, size, loaded_at)
+        self.versions = {}
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def get(self, user, name, loader):
+        key = (user, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._drop(key)
+            self.misses += 1
+            version = self.versions.get(user, 0)
+        # Load outside the lock so one slow query doesn't stall every other user
+        value = loader()
+        if value is None:
+            return None
+        size = estimate_size(value)
+        with self.lock:
+            # A write that landed while loading makes this value stale: hand it out, don't keep it
+            if self.versions.get(user, 0) == version and size <= self.budget_bytes:
+                self._drop(key)
+                self.entries[key] = (value, size, time.monotonic())
+                self.size += size
+                while self.size > self.budget_bytes:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, user, names=()):
+        with self.lock:
+            self.versions[user] = self.versions.get(user, 0) + 1
+            for key in [k for k in self.entries if k[0] == user and (not names or k[1] in names)]:
+                self._drop(key)
+
+    def version(self, user):
+        return self.versions.get(user, 0)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries), 'users': len({user for user, _ in self.entries}),
+                'bytes': self.size, 'budget_bytes': self.budget_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions
+            }
+
+data_cache = DataCache(int(CACHE_BUDGET_MB * 1024 * 1024), CACHE_TTL_SECONDS)
+
+def _cache_samples():
+    stats = data_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    yield 'expense_cache_hits_total', {}, stats['hits']
+    yield 'expense_cache_misses_total', {}, stats['misses']
+    yield 'expense_cache_evictions_total', {}, stats['evictions']
+    yield 'expense_cache_hit_ratio', {}, round(stats['hits'] / lookups, 4) if lookups else 0.0
+    yield 'expense_cache_bytes', {}, stats['bytes']
+    yield 'expense_cache_entries', {}, stats['entries']
+
+metrics.collect(_cache_samples)
+
+def cached(name, loader):
+    """Data shared by all of this user's sessions via data_cache, kept until invalidate() after a write.
+
+    Returns a copy, so callers may modify what they get. A None from `loader` is not cached.
+    """
+    def timed_loader():
+        started = time.perf_counter()
+        value = loader()
+        metrics.observe('expense_data_load_seconds', time.perf_counter() - started, table=name)
+        if value is not None and hasattr(value, '__len__'):
+            metrics.inc('expense_rows_loaded_total', len(value), table=name)
+        return value
+
+    value = data_cache.get(_binding().user, name, timed_loader)
+    return value.copy() if hasattr(value, 'copy') else value
+
+def invalidate(*names):
+    """Drop this user's cached data after a write. No names drops everything."""
+    data_cache.invalidate(_binding().user, names)
+
+def data_version():
+    """Bumped by every invalidate() for this user, from any session."""
+    return data_cache.version(_binding().user)
+
+def prepare_records(df):
+    records = []
+    for _, row in df.iterrows():
+        record = {}
+        for col, val in row.items():
+            if isinstance(val, bool):
+                record[col] = val
+            elif pd.isna(val):
+                record[col] = None
+            elif isinstance(val, (pd.Timestamp, datetime.datetime)):
+                record[col] = val.strftime('%Y-%m-%d')
+            elif isinstance(val, datetime.date):
+                record[col] = val.strftime('%Y-%m-%d')
+            elif hasattr(val, 'item'):
+                record[col] = val.item()
+            else:
+                record[col] = val
+        records.append(record)
+    return records
+
+@profiled
+def fetch_expenses():
+    """Every expense, paged: a single select stops at the server's max rows (1000 by default)."""
+    rows = list(iter_table_rows("expenses"))
+    if rows:
+        df = pd.DataFrame(rows)
+        df = df.rename(columns=EXP_COLS)
+        return df
+    return pd.DataFrame(columns=['id'] + list(EXP_COLS.values()))
+
+@profiled
+def load_expenses():
+    try:
+        return fetch_expenses()
+    except Exception as e:
+        st.error(f"Error loading expenses: {e}")
+        return pd.DataFrame(columns=['id'] + list(EXP_COLS.values()))
+
+@profiled
+def get_expenses():
+    """Expenses through the shared cache; on error shows it and returns an empty frame (not cached)."""
+    try:
+        return cached("expenses", fetch_expenses)
+    except Exception as e:
+        st.error(f"Error loading expenses: {e}")
+        return pd.DataFrame(columns=['id'] + list(EXP_COLS.values()))
+
+def slice_period(df, start_date, end_date):
+    """Rows of a Date-sorted frame within [start_date, end_date], found by binary search."""
+    dates = df['Date']
+    lo = dates.searchsorted(pd.Timestamp(start_date), side='left')
+    hi = dates.searchsorted(pd.Timestamp(end_date) + pd.Timedelta(days=1), side='left')
+    return df.iloc[lo:hi]
+
+def filter_mask(df, categories, subcats, people, sources, search_term="", search_field="Both"):
+    """Boolean mask of the sidebar filters: the four multiselects plus the keyword search.
+
+    Blank sub-categories always pass; search keywords (space/comma separated) match any of them.
+    """
+    mask = (df['Category'].isin(categories)) & (df['SubCategory'].isin(subcats) | (df['SubCategory'] == '')) & (df['Person'].isin(people)) & (df['Source'].isin(sources))
+    keywords = [k.strip() for k in search_term.replace(',', ' ').split() if k.strip()]
+    if keywords:
+        pattern = '|'.join(keywords)
+        if search_field == "Name":
+            mask = mask & df['Name'].astype(str).str.contains(pattern, case=False, na=False)
+        elif search_field == "Description":
+            mask = mask & df['Description'].astype(str).str.contains(pattern, case=False, na=False)
+        else:
+            mask = mask & (df['Name'].astype(str).str.contains(pattern, case=False, na=False) | df['Description'].astype(str).str.contains(pattern, case=False, na=False))
+    return mask
+
+def dashboard_totals(filtered_df):
+    """(spending, income, per-Category sums, per-Person sums) for the dashboard metrics and pies."""
+    total_spending = filtered_df[filtered_df['Amount'] < 0]['Amount'].sum()  # Negative number
+    total_income = filtered_df[filtered_df['Amount'] > 0]['Amount'].sum()    # Positive number
+    cat_group = filtered_df.groupby('Category')['Amount'].sum().reset_index()
+    cat_group['AbsAmount'] = cat_group['Amount'].abs()  # For pie chart (needs positive)
+    p_group = filtered_df.groupby('Person')['Amount'].sum().reset_index()
+    p_group['AbsAmount'] = p_group['Amount'].abs()
+    return total_spending, total_income, cat_group, p_group
+
+def changed_rows(original, edited, cols):
+    """Rows of `edited` that differ from `original` (matched on index) in any of `cols`."""
+    before = original.loc[edited.index, cols]
+    after = edited[cols]
+    diff = (after != before) & ~(after.isna() & before.isna())
+    return edited[diff.any(axis=1)]
+
+@profiled
+def insert_expenses(df):
+    df_save = df.rename(columns=EXP_COLS_REV)
+    if 'id' in df_save.columns:
+        df_save = df_save.drop(columns=['id'])
+    valid_cols = list(EXP_COLS_REV.values())
+    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
+    records = prepare_records(df_save)
+    if records:
+        sb.table("expenses").insert(records).execute()
+        invalidate("expenses")
+
+@profiled
+def upsert_expenses(df):
+    df_save = df.rename(columns=EXP_COLS_REV)
+    valid_cols = ['id'] + list(EXP_COLS_REV.values())
+    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
+    df_save['id'] = df_save['id'].astype(int)
+    records = prepare_records(df_save)
+    if records:
+        sb.table("expenses").upsert(records).execute()
+        invalidate("expenses")
+
+@profiled
+def delete_expenses(ids):
+    ids = [int(i) for i in ids]
+    for i in range(0, len(ids), WRITE_BATCH_SIZE):
+        sb.table("expenses").delete().in_("id", ids[i:i + WRITE_BATCH_SIZE]).execute()
+    if ids:
+        invalidate("expenses")
+
+@profiled
+def update_expenses_by_ids(ids, values):
+    """Apply the same column values to many expenses, one request per batch of ids. Returns rows updated."""
+    ids = [int(i) for i in ids]
+    updated = 0
+    for i in range(0, len(ids), WRITE_BATCH_SIZE):
+        resp = sb.table("expenses").update(values).in_("id", ids[i:i + WRITE_BATCH_SIZE]).execute()
+        updated += len(resp.data) if resp.data else 0
+    if ids:
+        invalidate("expenses")
+    return updated
+
+@profiled
+def move_to_trash(df):
+    df_save = df.copy()
+    rename_map = {col: EXP_COLS_REV[col] for col in df_save.columns if col in EXP_COLS_REV}
+    df_save = df_save.rename(columns=rename_map)
+    
+    if 'id' in df_save.columns:
+        df_save['original_id'] = df_save['id']
+        df_save = df_save.drop(columns=['id'])
+    
+    cols_to_remove = ['Delete', 'delete', 'Create Rule', 'create rule', 'Include Amt', 'include amt']
+    for col in cols_to_remove:
+        if col in df_save.columns:
+            df_save = df_save.drop(columns=[col])
+    
+    valid_cols = ['original_id', 'date', 'description', 'amount', 'name', 'category', 'subcategory', 'source', 'person', 'locked']
+    df_save = df_save[[c for c in df_save.columns if c.lower() in valid_cols]]
+    
+    records = prepare_records(df_save)
+    for i in range(0, len(records), WRITE_BATCH_SIZE):
+        sb.table("deleted_expenses").insert(records[i:i + WRITE_BATCH_SIZE]).execute()
+    if records:
+        invalidate("trash")
+
+@profiled
+def load_trash():
+    try:
+        resp = sb.table("deleted_expenses").select("*").order("deleted_at", desc=True).execute()
+        if resp.data:
+            df = pd.DataFrame(resp.data)
+            col_mapping = {
+                'date': 'Date', 'description': 'Description', 'amount': 'Amount',
+                'name': 'Name', 'category': 'Category', 'subcategory': 'SubCategory',
+                'source': 'Source', 'person': 'Person', 'locked': 'Locked',
+                'deleted_at': 'Deleted At', 'original_id': 'Original ID'
+            }
+            df = df.rename(columns=col_mapping)
+            return df
+        return pd.DataFrame()
+    except:
+        return pd.DataFrame()
+
+@profiled
+def restore_from_trash(ids):
+    restored_count = 0
+    for trash_id in ids:
+        try:
+            resp = sb.table("deleted_expenses").select("*").eq("id", int(trash_id)).execute()
+            if resp.data:
+                item = resp.data[0]
+                restore_item = {k: v for k, v in item.items() if k not in ['id', 'original_id', 'deleted_at']}
+                sb.table("expenses").insert(restore_item).execute()
+                sb.table("deleted_expenses").delete().eq("id", int(trash_id)).execute()
+                restored_count += 1
+        except Exception as e:
+            st.error(f"Error restoring item {trash_id}: {e}")
+    invalidate("trash", "expenses")
+    return restored_count
+
+@profiled
+def empty_trash():
+    try:
+        sb.table("deleted_expenses").delete().gte("id", 0).execute()
+    except Exception as e:
+        st.error(f"Error emptying trash: {e}")
+    invalidate("trash")
+
+@profiled
+def load_list(table_name):
+    try:
+        resp = sb.table(table_name).select("name").execute()
+        if resp.data:
+            return sorted([r['name'] for r in resp.data if r.get('name')])
+        return []
+    except Exception as e:
+        st.error(f"⚠️ Failed to load {table_name}: {e}")
+        return None
+
+@profiled
+def get_list(table_name):
+    return cached(table_name, lambda: load_list(table_name))
+
+@profiled
+def save_list(table_name, items):
+    try:
+        sb.table(table_name).delete().gte("id", 0).execute()
+        if items:
+            sb.table(table_name).insert([{"name": item} for item in items if item]).execute()
+    except Exception as e:
+        st.error(f"Error saving {table_name}: {e}")
+    invalidate(table_name)
+
+@profiled
+def fetch_rules():
+    """Every rule, paged like fetch_expenses(); errors propagate."""
+    rows = list(iter_table_rows("rules"))
+    if rows:
+        df = pd.DataFrame(rows)
+        df = df.rename(columns=RULES_COLS)
+        if 'Name' not in df.columns:
+            df['Name'] = ''
+        if 'Amount' not in df.columns:
+            df['Amount'] = None
+        return df
+    return pd.DataFrame(columns=['id'] + list(RULES_COLS.values()))
+
+def load_rules():
+    try:
+        return fetch_rules()
+    except:
+        return pd.DataFrame(columns=['id'] + list(RULES_COLS.values()))
+
+@profiled
+def save_rules_full(df):
+    try:
+        sb.table("rules").delete().gte("id", 0).execute()
+        df_save = df.rename(columns=RULES_COLS_REV)
+        if 'id' in df_save.columns:
+            df_save = df_save.drop(columns=['id'])
+        valid_cols = list(RULES_COLS_REV.values())
+        df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
+        records = prepare_records(df_save)
+        if records:
+            sb.table("rules").insert(records).execute()
+    except Exception as e:
+        st.error(f"Error saving rules: {e}")
+    invalidate("rules")
+
+@profiled
+def add_rules(new_rules_df):
+    df_save = new_rules_df.rename(columns=RULES_COLS_REV)
+    if 'id' in df_save.columns:
+        df_save = df_save.drop(columns=['id'])
+    valid_cols = list(RULES_COLS_REV.values())
+    df_save = df_save[[c for c in df_save.columns if c in valid_cols]]
+    records = prepare_records(df_save)
+    if records:
+        sb.table("rules").upsert(records, on_conflict="keyword").execute()
+        invalidate("rules")
+
+@profiled
+def get_rules():
+    """Rules are only loaded when a panel or import needs them, then cached until a rules write."""
+    return cached("rules", load_rules)
+
+# Bounded LRU of rule matches shared by imports, Re-Apply and previews (all users, all sessions)
+MATCH_MEMO_ENTRIES = int(os.environ.get("EXPENSE_MATCH_MEMO_ENTRIES", "50000"))
+
+# Rule kinds are picked by a keyword prefix, so the rules table needs no extra column:
+#   uber                     the description contains it anywhere (the default)
+#   word:uber                as whole word(s), not inside a longer word
+#   prefix:uber              the description starts with it
+#   re:uber\s*\*?(trip|eats) a regular expression (case-insensitive)
+#   contains:re: invoice     plain text that itself starts like a prefix (make_keyword() adds it)
+RULE_KIND_PREFIXES = {'contains:': 'substring', 'word:': 'word', 'prefix:': 'prefix', 're:': 'regex'}
+RULE_KIND_LABELS = {'substring': 'Contains', 'word': 'Whole word', 'prefix': 'Starts with', 'regex': 'Regex'}
+_UNSUPPORTED_REGEX = re.compile(r"\\\d|\(\?P[<=]")  # backreferences/named groups break the combined pattern
+
+def rule_kind(keyword):
+    """(kind, text) of a rule keyword."""
+    keyword = str(keyword)
+    for prefix, kind in RULE_KIND_PREFIXES.items():
+        if keyword.startswith(prefix):
+            return kind, keyword[len(prefix):]
+    return 'substring', keyword
+
+def make_keyword(kind, text):
+    """Keyword for a rule of `kind` on `text`; plain text is only prefixed (contains:) if it starts like a prefix."""
+    text = str(text).strip()
+    if kind == 'substring':
+        return normalize_keyword(('contains:' if rule_kind(text.lower())[1] != text.lower() else '') + text)
+    prefix = next(p for p, k in RULE_KIND_PREFIXES.items() if k == kind)
+    return normalize_keyword(prefix + text)
+
+def normalize_keyword(keyword):
+    """Keywords are stored stripped and lower-cased, except regex patterns (\\S is not \\s)."""
+    keyword = str(keyword).strip()
+    if keyword.lower().startswith('re:'):
+        return 're:' + keyword[3:]
+    return keyword.lower()
+
+def rule_pattern(keyword):
+    """Regex source for a rule keyword, to search lower-cased descriptions. Raises re.error for a bad pattern."""
+    kind, text = rule_kind(keyword)
+    if kind == 'regex':
+        if _UNSUPPORTED_REGEX.search(text):
+            raise re.error("backreferences and named groups are not supported in rules")
+        re.compile(f"(?i:{text})")
+        return f"(?i:{text})"
+    text = re.escape(text.lower())
+    if kind == 'word':
+        return rf"(?<!\w){text}(?!\w)"
+    if kind == 'prefix':
+        return rf"^\s*{text}"
+    return text
+
+def invalid_keywords(keywords):
+    """{keyword: error} for the keywords whose pattern does not compile."""
+    problems = {}
+    for keyword in keywords:
+        try:
+            rule_pattern(keyword)
+        except re.error as e:
+            problems[keyword] = str(e)
+    return problems
+
+def keyword_mask(descriptions, keyword):
+    """Which lower-cased descriptions a rule keyword matches, whatever its amount (numpy bools)."""
+    kind, text = rule_kind(keyword)
+    if kind == 'substring':
+        return descriptions.str.contains(text.lower(), regex=False).to_numpy(dtype=bool)
+    pattern = re.compile(rule_pattern(keyword))
+    return np.fromiter((pattern.search(d) is not None for d in descriptions), dtype=bool, count=len(descriptions))
+
+def rules_in_match_order(rules_df):
+    """Rules in priority order: longest keyword text first (kind prefix not counted), ties keep table order."""
+    rules_sorted = rules_df.copy()
+    rules_sorted['_kw_len'] = [len(rule_kind(k)[1]) if pd.notna(k) else -1 for k in rules_sorted['Keyword']]
+    return rules_sorted.sort_values('_kw_len', ascending=False, kind='stable')
+
+def trie_pattern(names):
+    """One regex for {literal: group name}, shaped as a trie that tries longer literals first.
+
+    Each literal ends in an empty group of its name, so after a match `lastgroup`
+    names the longest literal that matched there.
+    """
+    trie = {}
+    for text, name in names.items():
+        node = trie
+        for char in text:
+            node = node.setdefault(char, {})
+        node[None] = name
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in node.items() if char is not None]
+        inner = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if None not in node:
+            return inner
+        marker = f"(?P<{node[None]}>)"
+        return marker + (f"(?:{inner})?" if branches else "")
+
+    return build(trie)
+
+def rule_result(row):
+    """(Name, Category, SubCategory, Person) a rule assigns."""
+    return (
+        row.get('Name', '') if pd.notna(row.get('Name')) else '',
+        row['Category'],
+        row.get('SubCategory', '') if pd.notna(row.get('SubCategory')) else '',
+        row.get('Person', 'Family') if pd.notna(row.get('Person')) else 'Family'
+    )
+
+NO_MATCH = (None, (None, None, None, None))  # memo value: (keyword, result) of the deciding rule
+
+def rules_version(rules_df):
+    """Hash of everything that decides a match (keywords, assignments, amounts, table order)."""
+    values = [rules_df[col].tolist() if col in rules_df.columns else None for col in ['Keyword'] + RULE_LABEL_COLS + ['Amount']]
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).hexdigest()
+
+class RuleSet:
+    """Rules compiled into one matcher per rules version (see prepare_rules()).
+
+    Priority is rules_in_match_order(). Any-amount "contains" rules become one
+    trie-shaped regex, so each position of a description costs the depth of the
+    trie rather than the number of rules; word/prefix/regex rules are one more
+    alternation in priority order. Both run as lookaheads at every position and
+    report the best rule starting there; the best over all positions wins. Amount
+    rules are looked up by amount first, then searched one by one. Rules whose
+    pattern does not compile never match (analyze_rules() reports them).
+    """
+
+    def __init__(self, rules_df):
+        self.version = rules_version(rules_df)
+        self.rules_sorted = rules_in_match_order(rules_df)
+        self.labels = list(self.rules_sorted.index)  # priority -> index label
+        amounts = self.rules_sorted['Amount'] if 'Amount' in self.rules_sorted.columns else [None] * len(self.labels)
+        literals, others = {}, []
+        self.by_cents = {}  # amount in cents -> [(priority, amount, compiled pattern)]
+        for priority, (keyword, amount) in enumerate(zip(self.rules_sorted['Keyword'], amounts)):
+            if pd.isna(keyword):
+                continue
+            try:
+                pattern = rule_pattern(keyword)
+            except re.error:
+                continue
+            kind, text = rule_kind(keyword)
+            if amount is not None and pd.notna(amount):
+                self.by_cents.setdefault(round(float(amount) * 100), []).append((priority, float(amount), re.compile(pattern)))
+            elif kind == 'substring':
+                literals.setdefault(text.lower(), f"r{priority}")
+            else:
+                others.append(f"(?P<r{priority}>{pattern})")
+        self.searches = [re.compile(f"(?=(?:{source}))") for source in (
+            trie_pattern(literals) if literals else None, "|".join(others) if others else None
+        ) if source is not None]
+
+    def amount_rules(self, amount):
+        """Amount rules within a cent of `amount`, best priority first."""
+        if amount is None or pd.isna(amount) or not self.by_cents:
+            return []
+        cents = round(float(amount) * 100)
+        found = [rule for c in (cents - 1, cents, cents + 1) for rule in self.by_cents.get(c, ())]
+        return sorted(rule for rule in found if abs(float(amount) - rule[1]) <= 0.01)
+
+    def find(self, description, amount):
+        """Index label of the rule that decides this transaction, or None."""
+        desc = str(description).lower()
+        best = len(self.labels)
+        for search in self.searches:
+            for m in search.finditer(desc):
+                best = min(best, int(m.lastgroup[1:]))
+        for priority, _, pattern in self.amount_rules(amount):
+            if priority >= best:
+                break
+            if pattern.search(desc):
+                best = priority
+                break
+        return self.labels[best] if best < len(self.labels) else None
+
+    def memo_key(self, description, amount):
+        """(version, lower-cased description, amount to the cent). The amount is only part of the
+        key when some amount rule is within a cent of it, since only then can it matter."""
+        bucket = round(float(amount), 2) if self.amount_rules(amount) else None
+        return (self.version, str(description).lower(), bucket)
+
+    def value(self, label):
+        if label is None:
+            return NO_MATCH
+        row = self.rules_sorted.loc[label]
+        return (row['Keyword'], rule_result(row))
+
+    def match_keys(self, keys):
+        return [self.value(self.find(desc, amount)) for _, desc, amount in keys]
+
+class MatchMemo:
+    """Process-wide LRU of (rules version, description, amount bucket) -> (keyword, result).
+
+    Keys carry the rules version, so editing the rules makes every older entry
+    unreachable; those age out of the LRU instead of being cleared, which would
+    also throw away the entries of other users' rule sets.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, keys, compute):
+        """Values for `keys` (one per row). The distinct keys not in the memo are computed in one
+        `compute(missing)` call, which returns their values in the same order."""
+        found, missing = {}, []
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    continue
+                value = self.entries.get(key)
+                if value is None:
+                    found[key] = None
+                    missing.append(key)
+                else:
+                    self.entries.move_to_end(key)
+                    found[key] = value
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            computed = compute(missing)
+            found.update(zip(missing, computed))
+            with self.lock:
+                for key, value in zip(missing, computed):
+                    self.entries[key] = value
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+match_memo = MatchMemo(MATCH_MEMO_ENTRIES)
+
+def _match_memo_samples():
+    stats = match_memo.stats()
+    lookups = stats['hits'] + stats['misses']
+    yield 'expense_match_memo_hits_total', {}, stats['hits']
+    yield 'expense_match_memo_misses_total', {}, stats['misses']
+    yield 'expense_match_memo_hit_ratio', {}, round(stats['hits'] / lookups, 4) if lookups else 0.0
+    yield 'expense_match_memo_entries', {}, stats['entries']
+
+metrics.collect(_match_memo_samples)
+
+_rule_sets = OrderedDict()  # version -> RuleSet, the few most recent
+_rule_sets_lock = threading.Lock()
+
+def prepare_rules(rules_df):
+    """The RuleSet for these rules, reused while they are unchanged."""
+    version = rules_version(rules_df)
+    with _rule_sets_lock:
+        rules = _rule_sets.get(version)
+        if rules is not None:
+            _rule_sets.move_to_end(version)
+    if rules is None:
+        rules = RuleSet(rules_df)
+        with _rule_sets_lock:
+            _rule_sets[version] = rules
+            while len(_rule_sets) > 8:
+                _rule_sets.popitem(last=False)
+    return rules
+
+def get_match(description, amount, rules):
+    """Match one transaction. `rules` is a rules frame, or the RuleSet prepare_rules() made
+    from it: callers matching row by row prepare once, since preparing hashes every rule."""
+    if not isinstance(rules, RuleSet):
+        if rules.empty:
+            return None, None, None, None
+        rules = prepare_rules(rules)
+    return match_memo.resolve([rules.memo_key(description, amount)], rules.match_keys)[0][1]
+
+@profiled
+def parse_statement(raw, default_source):
+    """Turn a bank export (CSV/Excel frame) into expense rows, or None if Date, Description or Amount is missing.
+
+    Headers are matched loosely ('memo' for description, 'debit'/'hkd' for amount, ...);
+    optional Source/Name/Category/SubCategory/Person columns are kept.
+    """
+    raw = raw.copy()
+    raw.columns = [str(c).lower().strip() for c in raw.columns]
+    date_col = next((c for c in raw.columns if 'date' in c), None)
+    desc_col = next((c for c in raw.columns if 'desc' in c or 'memo' in c), None)
+    amt_col = next((c for c in raw.columns if 'amount' in c or 'debit' in c or 'value' in c or 'hkd' in c), None)
+    src_col = next((c for c in raw.columns if 'source' in c), None)
+    name_col_in = next((c for c in raw.columns if c == 'name'), None)
+    cat_col_in = next((c for c in raw.columns if 'category' in c and 'sub' not in c), None)
+    sub_col_in = next((c for c in raw.columns if 'sub' in c), None)
+    person_col_in = next((c for c in raw.columns if 'person' in c), None)
+    if not (date_col and desc_col and amt_col):
+        return None
+
+    raw[amt_col] = raw[amt_col].astype(str).str.upper().str.replace('CR','', regex=False).str.replace('DR','', regex=False).str.replace(',','', regex=False).str.replace('$','', regex=False)
+    raw[amt_col] = pd.to_numeric(raw[amt_col], errors='coerce')
+    clean = pd.DataFrame({
+        'Date': pd.to_datetime(raw[date_col], errors='coerce'),
+        'Description': raw[desc_col],
+        'Amount': raw[amt_col],
+        'Source': raw[src_col] if src_col else default_source,
+        'Name': raw[name_col_in] if name_col_in else '',
+        'Category': raw[cat_col_in] if cat_col_in else 'Uncategorized',
+        'SubCategory': raw[sub_col_in] if sub_col_in else '',
+        'Person': raw[person_col_in] if person_col_in else 'Family',
+        'Locked': False
+    })
+    return clean.dropna(subset=['Date', 'Amount'])
+
+@profiled
+def fill_from_rules(clean, rules_df, processes=1):
+    """Fill blank Name/Category/SubCategory/Person of newly imported rows from the rules.
+
+    Rows that already have both a category and a name are left alone.
+    """
+    if clean.empty or rules_df.empty:
+        return clean
+    clean = clean.copy()
+    categorized = (clean['Category'] != 'Uncategorized') & clean['Category'].notna()
+    todo = clean[~(categorized & (clean['Name'] != ''))]
+    for idx, (name, cat, sub, person) in zip(todo.index, match_all(todo['Description'], todo['Amount'], rules_df, processes)):
+        row = clean.loc[idx]
+        if name and (row['Name'] == '' or pd.isna(row['Name'])):
+            clean.at[idx, 'Name'] = name
+        if cat and (row['Category'] == 'Uncategorized' or pd.isna(row['Category'])):
+            clean.at[idx, 'Category'] = cat
+        if sub and (row['SubCategory'] == '' or pd.isna(row['SubCategory'])):
+            clean.at[idx, 'SubCategory'] = sub
+        if person and (row['Person'] == '' or pd.isna(row['Person'])):
+            clean.at[idx, 'Person'] = person
+    return clean
+
+def expense_keys(df):
+    return df['Date'].astype(str) + '|' + df['Description'].astype(str) + '|' + df['Amount'].astype(str)
+
+@profiled
+def drop_existing(clean, existing):
+    """Rows of `clean` whose Date|Description|Amount is not already in `existing`."""
+    if existing.empty or clean.empty:
+        return clean
+    return clean[~expense_keys(clean).isin(expense_keys(existing))]
+
+_worker_rules = None  # RuleSet of a match_all() worker process
+
+def _init_match_worker(rules_df):
+    global _worker_rules
+    _worker_rules = RuleSet(rules_df)
+
+def _match_worker(key):
+    return _worker_rules.find(key[1], key[2])
+
+def match_all(descriptions, amounts, rules_df, processes=1):
+    """get_match() for every (description, amount) pair, optionally spread over worker processes.
+
+    Each distinct description/amount is matched once, through the match memo, and
+    the hits are added to the user's rule stats.
+    """
+    rules = prepare_rules(rules_df)
+    keys = [rules.memo_key(desc, amount) for desc, amount in zip(descriptions, amounts)]
+
+    def compute(missing):
+        if processes <= 1 or len(missing) < 1000:
+            return rules.match_keys(missing)
+        with multiprocessing.Pool(processes, initializer=_init_match_worker, initargs=(rules_df,)) as pool:
+            labels = pool.map(_match_worker, missing, chunksize=max(1, len(missing) // (processes * 4)))
+        return [rules.value(label) for label in labels]
+
+    values = match_memo.resolve(keys, compute)
+    record_rule_hits(Counter(keyword for keyword, _ in values if keyword is not None))
+    return [result for _, result in values]
+
+@profiled
+def reapply_rules(df, rules_df, processes=1, rows=None):
+    """Re-run the rules over the unlocked expenses in `df` (only index labels `rows`, if given), in place.
+
+    Returns the index labels that matched.
+    """
+    if df.empty or rules_df.empty:
+        return []
+    if rows is not None:
+        df_rows = df.loc[rows]
+    else:
+        df_rows = df
+    unlocked = df_rows[~df_rows['Locked'].fillna(False).astype(bool)] if 'Locked' in df_rows.columns else df_rows
+    changed_ids = []
+    for idx, (name, cat, sub, person) in zip(unlocked.index, match_all(unlocked['Description'], unlocked['Amount'], rules_df, processes)):
+        if name:
+            df.at[idx, 'Name'] = name
+        if cat:
+            df.at[idx, 'Category'] = cat
+        if sub:
+            df.at[idx, 'SubCategory'] = sub
+        if person:
+            df.at[idx, 'Person'] = person
+        if name or cat or sub or person:
+            changed_ids.append(idx)
+    return changed_ids
+
+# Incremental Re-Apply: the rules last applied to the whole history are kept per user, so the
+# next Re-Apply only re-evaluates transactions containing a keyword that was added, changed or removed
+APPLIED_RULES_FILE = "rules_applied.json"
+
+class TokenIndex:
+    """Reverse index of lower-cased descriptions: token -> index labels of the rows containing it."""
+
+    def __init__(self, descriptions):
+        tokens = descriptions.astype(str).str.lower().str.split().explode().dropna()
+        self.postings = {token: labels for token, labels in tokens.groupby(tokens, sort=False).groups.items()}
+        self.descriptions = descriptions.astype(str).str.lower()
+
+    def candidates(self, keyword):
+        """Index labels of the rows a rule keyword matches (any amount); none for a bad regex."""
+        kind, text = rule_kind(keyword)
+        pieces = text.lower().split()
+        if kind == 'regex' or not pieces:
+            found = self.descriptions.index
+        else:
+            # Any row containing the keyword has its longest word inside one of its tokens
+            piece = max(pieces, key=len)
+            labels = [self.postings[token] for token in self.postings if piece in token]
+            if not labels:
+                return self.descriptions.index[:0]
+            found = labels[0].append(labels[1:]).unique() if len(labels) > 1 else labels[0]
+        try:
+            return found[keyword_mask(self.descriptions.loc[found], keyword)]
+        except re.error:
+            return self.descriptions.index[:0]
+
+def rule_snapshot(rules_df):
+    """{keyword: [Name, Category, SubCategory, Person, Amount]}: what each rule assigns, JSON-ready."""
+    values = rules_df.reindex(columns=['Keyword'] + RULE_LABEL_COLS + ['Amount']).astype(object)
+    values = values.where(values.notna(), None)
+    return {str(row[0]): list(row[1:]) for row in values.itertuples(index=False)}
+
+def load_applied_rules(user):
+    path = os.path.join(user_backup_dir(user), APPLIED_RULES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['rules']
+
+def mark_rules_applied(rules_df):
+    """Remember `rules_df` as applied to the bound user's whole history (after its changes were saved)."""
+    user = _binding().user
+    if user is None:
+        return
+    path = os.path.join(user_backup_dir(user), APPLIED_RULES_FILE)
+    with open(path + ".tmp", 'w') as f:
+        json.dump({'applied_at': datetime.datetime.now().isoformat(timespec='seconds'), 'rules': rule_snapshot(rules_df)}, f)
+    os.replace(path + ".tmp", path)
+
+def changed_rule_keywords(rules_df):
+    """Keywords of rules added, changed or removed since mark_rules_applied(), or None if never applied."""
+    user = _binding().user
+    applied = load_applied_rules(user) if user is not None else None
+    if applied is None:
+        return None
+    current = json.loads(json.dumps(rule_snapshot(rules_df)))  # same float/None forms as the saved file
+    return {k for k in current.keys() | applied.keys() if current.get(k) != applied.get(k)}
+
+@profiled
+def rows_for_keywords(df, keywords):
+    """Index labels of `df` rows whose description contains any of `keywords`, found via a TokenIndex."""
+    if not keywords or df.empty:
+        return df.index[:0]
+    index = TokenIndex(df['Description'])
+    found = [index.candidates(keyword) for keyword in keywords]
+    return found[0].append(found[1:]).unique()
+
+# Rule hit telemetry: {keyword: {'hits': n, 'last_hit': 'YYYY-MM-DD'}} per user, next to the backup manifest
+RULE_STATS_FILE = "rule_stats.json"
+RULE_STATS_FLUSH_SECONDS = 60  # pending hits older than this are written on the next recording
+_rule_stats_lock = threading.Lock()
+_pending_rule_hits = {}  # user -> Counter of hits not yet in the file
+_rule_stats_flushed = {}  # user -> monotonic time of the last write
+
+def load_rule_stats(user):
+    path = os.path.join(user_backup_dir(user), RULE_STATS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def record_rule_hits(hits):
+    """Count {keyword: rows matched} from an import or Re-Apply for the bound user.
+
+    Hits collect in memory so matching never waits on the file: the operation calls
+    flush_rule_hits() once when it is done, and a recording more than
+    RULE_STATS_FLUSH_SECONDS after the last write flushes as well.
+    """
+    user = _binding().user
+    if user is None or not hits:
+        return
+    with _rule_stats_lock:
+        _pending_rule_hits.setdefault(user, Counter()).update(hits)
+        due = time.monotonic() - _rule_stats_flushed.setdefault(user, time.monotonic()) > RULE_STATS_FLUSH_SECONDS
+    if due:
+        flush_rule_hits()
+
+def flush_rule_hits():
+    """Add the bound user's pending hits to rule_stats.json: one read and one write."""
+    user = _binding().user
+    if user is None:
+        return
+    today = datetime.date.today().isoformat()
+    with _rule_stats_lock:
+        _rule_stats_flushed[user] = time.monotonic()
+        hits = _pending_rule_hits.pop(user, None)
+        if not hits:
+            return
+        stats = load_rule_stats(user)
+        for keyword, n in hits.items():
+            entry = stats.setdefault(str(keyword), {'hits': 0, 'last_hit': None})
+            entry['hits'] += int(n)
+            entry['last_hit'] = today
+        path = os.path.join(user_backup_dir(user), RULE_STATS_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(stats, f)
+        os.replace(path + ".tmp", path)
+
+@profiled
+def analyze_rules(rules_df, history):
+    """Rule health for pruning: the rules in match order with Reach, Wins, Hits, Last Hit and Status.
+
+    Reach is the history rows the keyword (and amount) matches, Wins the rows the rule
+    decides as get_match() would, Hits/Last Hit what imports and Re-Apply recorded. Status:
+    'prefixed' (read as a word/prefix/regex rule, yet the whole keyword occurs as plain
+    text in descriptions: most likely saved before rule kinds existed, and meant as
+    contains:<keyword>), 'invalid' (a regex that does not compile, so it never matches), 'duplicate' (an
+    earlier rule has the same keyword and amount, so it can never win), 'shadowed'
+    (reaches rows, but a longer keyword always wins them), 'unused' (reaches no row)
+    or 'ok'.
+    """
+    rules_sorted = rules_in_match_order(rules_df).drop(columns=['_kw_len'])
+    if rules_sorted.empty:
+        return rules_sorted.assign(Reach=0, Wins=0, Hits=0, **{'Last Hit': None}, Status='ok')
+    # Each distinct (description, amount) once, weighted by how often it occurs
+    pairs = pd.DataFrame({
+        'desc': history['Description'].astype(str).str.lower(),
+        'amount': pd.to_numeric(history['Amount'], errors='coerce')
+    }).value_counts(dropna=False).rename('n').reset_index()
+    desc, amounts, counts = pairs['desc'], pairs['amount'].to_numpy(), pairs['n'].to_numpy()
+    undecided = np.ones(len(pairs), dtype=bool)
+    reach, wins = [], []
+    invalid, prefixed = [], []
+    for keyword, amount in zip(rules_sorted['Keyword'], rules_sorted['Amount']):
+        prefixed.append(rule_kind(keyword)[0] != 'substring' and bool(desc.str.contains(str(keyword).lower(), regex=False).any()))
+        try:
+            contains = keyword_mask(desc, keyword)
+            invalid.append(False)
+        except re.error:
+            contains = np.zeros(len(pairs), dtype=bool)
+            invalid.append(True)
+        if pd.notna(amount):
+            contains = contains & (np.abs(amounts - float(amount)) <= 0.01)
+        won = contains & undecided
+        undecided &= ~won
+        reach.append(int(counts[contains].sum()))
+        wins.append(int(counts[won].sum()))
+
+    flush_rule_hits()
+    stats = load_rule_stats(_binding().user) if _binding().user is not None else {}
+    keys = pd.DataFrame({'k': [normalize_keyword(k) for k in rules_sorted['Keyword']], 'a': pd.to_numeric(rules_sorted['Amount'], errors='coerce').round(2)})
+    out = rules_sorted.assign(
+        Reach=reach, Wins=wins,
+        Hits=[stats.get(str(k), {}).get('hits', 0) for k in rules_sorted['Keyword']],
+        **{'Last Hit': [stats.get(str(k), {}).get('last_hit') for k in rules_sorted['Keyword']]}
+    )
+    out['Status'] = np.select(
+        [np.array(prefixed), np.array(invalid), keys.duplicated().to_numpy(), out['Reach'].to_numpy() == 0, out['Wins'].to_numpy() == 0],
+        ['prefixed', 'invalid', 'duplicate', 'unused', 'shadowed'], default='ok'
+    )
+    return out
+
+@profiled
+def delete_rules(ids):
+    ids = [int(i) for i in ids]
+    for i in range(0, len(ids), WRITE_BATCH_SIZE):
+        sb.table("rules").delete().in_("id", ids[i:i + WRITE_BATCH_SIZE]).execute()
+    if ids:
+        invalidate("rules")
+
+# Auto-Learn: keywords are runs of up to LEARN_MAX_TOKENS description words; a keyword is
+# kept only if at least LEARN_MIN_PRECISION of the categorized rows containing it share its category
+LEARN_MAX_TOKENS = 3
+LEARN_MIN_KEYWORD_LEN = 3
+LEARN_MIN_PRECISION = 0.95
+RULE_LABEL_COLS = ['Name', 'Category', 'SubCategory', 'Person']
+_NOISE_TOKEN = re.compile(r"^#|\d.*\d|^[^a-z]+$")  # refs, store/card numbers, bare punctuation
+
+def keyword_candidates(descriptions):
+    """(row, keyword) pairs, deduplicated: every run of 1..LEARN_MAX_TOKENS words of each lower-cased description.
+
+    Runs stop at noise tokens (references, numbers), which differ between otherwise identical transactions.
+    """
+    rows, keywords = [], []
+    for row, desc in zip(descriptions.index, descriptions):
+        tokens = desc.split()
+        for start in range(len(tokens)):
+            for end in range(start + 1, min(start + LEARN_MAX_TOKENS, len(tokens)) + 1):
+                if _NOISE_TOKEN.search(tokens[end - 1]):
+                    break
+                keyword = ' '.join(tokens[start:end])
+                if len(keyword) >= LEARN_MIN_KEYWORD_LEN:
+                    rows.append(row)
+                    keywords.append(keyword)
+    return pd.DataFrame({'row': rows, 'keyword': keywords}).drop_duplicates()
+
+def longest_clean_run(description):
+    """The longest run of words of `description` without noise tokens (the first of equal runs), or ''."""
+    best, run = [], []
+    for token in description.split() + ['#']:
+        if _NOISE_TOKEN.search(token):
+            if len(run) > len(best):
+                best = run
+            run = []
+        else:
+            run.append(token)
+    return ' '.join(best)
+
+def rule_keyword_mask(descriptions, rules_df):
+    """Which lower-cased descriptions an any-amount rule already matches."""
+    if rules_df.empty:
+        return pd.Series(False, index=descriptions.index)
+    any_amount = rules_df[rules_df['Amount'].isna()] if 'Amount' in rules_df.columns else rules_df
+    rules = RuleSet(any_amount)
+    matched = {desc for desc in descriptions.unique() if rules.find(desc, None) is not None}
+    return descriptions.isin(matched)
+
+@profiled
+def learn_rules(history, rules_df, min_precision=LEARN_MIN_PRECISION):
+    """Propose a compact rule set from categorized history. Returns (proposal, report).
+
+    Rows an existing rule already matches are left alone. Per category, the fewest and
+    most general keywords covering its rows are picked greedily among the precise ones;
+    rows none covers fall back to the longest run of their description without refs or
+    numbers, if that is precise too (rows with none stay uncovered). Each rule takes
+    the most common Name/SubCategory/Person of the rows it matches. The proposal is
+    checked the way get_match() applies it (substring, longest keyword first):
+    `Matches` and `Precision` per rule, coverage and precision in the report, which
+    also counts the one-off rules (matching a single past transaction) apart.
+    """
+    columns = ['Keyword'] + RULE_LABEL_COLS + ['Amount', 'Matches', 'Precision']
+    labeled = history[history['Category'].notna() & ~history['Category'].isin(['Uncategorized', '']) & history['Description'].notna()]
+    desc = labeled['Description'].astype(str).str.lower().str.strip()
+    category = labeled['Category'].astype(str)
+    todo = ~rule_keyword_mask(desc, rules_df)
+    report = {
+        'labeled_rows': len(labeled), 'already_matched': int((~todo).sum()), 'to_learn': int(todo.sum()),
+        'one_per_description': int(desc[todo].nunique()), 'rules': 0, 'covered': 0, 'correct': 0,
+        'coverage': 0.0, 'precision': 0.0, 'one_off_rules': 0, 'one_off_covered': 0, 'general_coverage': 0.0
+    }
+    if not todo.any():
+        return pd.DataFrame(columns=columns), report
+
+    # Vectorized counting: rows per (category, keyword) against rows per keyword over all categories
+    pairs = keyword_candidates(desc)
+    pairs['category'] = category.loc[pairs['row']].values
+    per_keyword = pairs.groupby('keyword').size()
+    hits = pairs.groupby(['category', 'keyword']).size().rename('hits').reset_index()
+    hits = hits[hits['hits'] >= hits['keyword'].map(per_keyword) * min_precision]
+    if not rules_df.empty:
+        hits = hits[~hits['keyword'].isin(rules_df['Keyword'].dropna().astype(str).str.lower())]
+    usable = pairs[todo.loc[pairs['row']].values].merge(hits[['category', 'keyword']], on=['category', 'keyword'])
+
+    chosen = {}  # keyword -> category
+    todo_category = category[todo]
+    for cat, group in usable.groupby('category'):
+        cover = group.groupby('keyword')['row'].apply(set).to_dict()
+        uncovered = set(todo_category.index[todo_category == cat])
+        while uncovered and cover:
+            # Most new rows first; on ties fewer words (more general), then more characters (less ambiguous)
+            keyword = max(cover, key=lambda k: (len(cover[k] & uncovered), -k.count(' '), len(k)))
+            gained = cover.pop(keyword) & uncovered
+            if not gained:
+                break
+            chosen[keyword] = cat
+            uncovered -= gained
+
+    # Check the mined keywords as get_match() would apply them: substring match, longest keyword wins
+    desc_todo = desc[todo]
+    todo_mask = todo.to_numpy()
+    categories = category.to_numpy()
+    assigned = np.full(len(desc_todo), '', dtype=object)
+    rules = []  # (keyword, category, positions of the labeled rows it matches, rows it decides, precision)
+    for keyword in sorted(chosen, key=len, reverse=True):
+        contains = desc.str.contains(keyword, regex=False).to_numpy()
+        precision = float((categories[contains] == chosen[keyword]).mean())
+        won = contains[todo_mask] & (assigned == '')
+        if precision < min_precision or not won.any():
+            continue
+        assigned[won] = chosen[keyword]
+        rules.append((keyword, chosen[keyword], np.flatnonzero(contains), int(won.sum()), round(precision, 3)))
+
+    # Fallback: rows still uncovered, by the longest run of their description without refs or numbers
+    # (a whole description with its reference in it would only ever match that one transaction)
+    leftover = desc_todo[assigned == '']
+    runs = leftover.map(longest_clean_run)
+    runs = runs[(runs.str.len() >= LEARN_MIN_KEYWORD_LEN) & ~runs.isin(list(chosen))]
+    for keyword in sorted(runs.unique(), key=len, reverse=True):
+        cats = set(todo_category[runs.index[runs == keyword]])
+        contains = desc.str.contains(keyword, regex=False).to_numpy()
+        won = contains[todo_mask] & (assigned == '')
+        if len(cats) != 1 or not won.any():
+            continue
+        cat = cats.pop()
+        precision = float((categories[contains] == cat).mean())
+        if precision < min_precision:
+            continue
+        assigned[won] = cat
+        rules.append((keyword, cat, np.flatnonzero(contains), int(won.sum()), round(precision, 3)))
+
+    proposal = pd.DataFrame(
+        [(make_keyword('substring', keyword), cat, matches, precision) for keyword, cat, _, matches, precision in rules],
+        columns=['Keyword', 'Category', 'Matches', 'Precision']
+    )
+    # Name/SubCategory/Person: the most common value among the rows each rule matches
+    matched = labeled[RULE_LABEL_COLS].fillna('').iloc[np.concatenate([r[2] for r in rules] or [[]]).astype(int)]
+    matched = matched.assign(_rule=np.repeat(np.arange(len(rules)), [len(r[2]) for r in rules]))
+    for col in ['Name', 'SubCategory', 'Person']:
+        counts = matched.groupby(['_rule', col]).size().rename('n').reset_index()
+        top = counts.sort_values(['_rule', 'n'], ascending=[True, False]).drop_duplicates('_rule')
+        proposal[col] = top.set_index('_rule')[col].reindex(proposal.index).fillna('')
+    proposal['Amount'] = None
+    proposal = proposal[columns].sort_values(['Category', 'Keyword'])
+    assigned = pd.Series(assigned, index=desc_todo.index)
+    covered = assigned != ''
+    correct = int((assigned[covered] == todo_category[covered]).sum())
+    one_offs = [decided for _, _, matched_rows, decided, _ in rules if len(matched_rows) == 1]
+    report.update(rules=len(proposal), covered=int(covered.sum()), correct=correct,
+                  coverage=round(float(covered.mean()), 4), precision=round(correct / int(covered.sum()), 4) if covered.any() else 0.0,
+                  one_off_rules=len(one_offs), one_off_covered=sum(one_offs),
+                  general_coverage=round((int(covered.sum()) - sum(one_offs)) / len(desc_todo), 4))
+    return proposal, report
+
+def iter_table_rows(table_name, page_size=BACKUP_PAGE_SIZE):
+    """Yield every row of a table, one page at a time, ordered by id."""
+    start = 0
+    while True:
+        resp = sb.table(table_name).select("*").order("id").range(start, start + page_size - 1).execute()
+        rows = resp.data or []
+        yield from rows
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+RESTORE_BATCH_SIZE = 500
+
+class BatchWriter:
+    """Buffers records and writes them in per-table batches (RESTORE_BATCH_SIZES) via insert or upsert.
+
+    Postgres refuses an upsert that names the same id twice, so a later upsert record
+    for an id already in the batch replaces the earlier one, as writing them one at a
+    time would. `count` still counts both.
+    """
+
+    def __init__(self, table_name, method="insert"):
+        self.table_name = table_name
+        self.method = method
+        self.batch_size = RESTORE_BATCH_SIZES.get(table_name, RESTORE_BATCH_SIZE)
+        self.batch = []
+        self.positions = {}  # id -> index in batch, for upserts
+        self.pending = 0
+        self.count = 0
+
+    def add(self, record):
+        self.pending += 1
+        row_id = record.get('id') if self.method == "upsert" else None
+        if row_id is not None and row_id in self.positions:
+            self.batch[self.positions[row_id]] = record
+            return
+        if row_id is not None:
+            self.positions[row_id] = len(self.batch)
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        getattr(sb.table(self.table_name), self.method)(self.batch).execute()
+        self.count += self.pending
+        self.batch = []
+        self.positions = {}
+        self.pending = 0
+
+def table_timing(rows, seconds):
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_sec': round(rows / seconds) if seconds > 0 else None}
+
+def format_timings(timings):
+    """One line per table: rows, wall-clock seconds and rows/s."""
+    return "  \n".join(
+        f"{table}: {t['rows']:,} rows in {t['seconds']:.2f}s" + (f" ({t['rows_per_sec']:,}/s)" if t.get('rows_per_sec') else "")
+        for table, t in timings.items()
+    )
+
+def same_content(existing, incoming):
+    """True if every non-id field in `incoming` already has the same value in `existing`."""
+    return all(existing.get(k) == v for k, v in incoming.items() if k != 'id')
+
+def row_hash(row):
+    return hashlib.blake2b(json.dumps(row, sort_keys=True, default=str).encode('utf-8'), digest_size=8).hexdigest()
+
+class TableChecksum:
+    """Order-independent running checksum of a table: its row count and the sum of row digests.
+
+    Row digests ignore id and nulls and treat 5 and 5.0 alike, so a table checksums
+    the same live, in an NDJSON backup, in a Parquet backup and after a restore.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.total = 0
+
+    def add(self, row):
+        content = {k: float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else v
+                   for k, v in row.items() if k != 'id' and v is not None}
+        self.rows += 1
+        self.total = (self.total + int(row_hash(content), 16)) % 2 ** 64
+
+    def hexdigest(self):
+        return f"{self.total:016x}"
+
+def table_checksum(rows):
+    checksum = TableChecksum()
+    for row in rows:
+        checksum.add(row)
+    return checksum.hexdigest()
+
+@profiled
+def write_backup(path, user, base_state=None):
+    """Stream all tables to `path` as gzip-compressed NDJSON. Returns (metadata, row_state).
+
+    Layout: a {"_metadata": ...} line, then for each table a {"_table": name} line
+    followed by one line per row. The metadata line is its own gzip member, written
+    after the rows are counted, so readers get the summary without decompressing rows.
+
+    row_state maps table -> {id: content hash}. When the previous backup's row_state
+    is passed as base_state, only new or changed rows are written, followed by a
+    {"_deleted": [ids]} line per table (an incremental backup).
+
+    Tables are fetched concurrently, each into its own gzip member, then joined in
+    BACKUP_TABLES order. metadata['checksums'] holds a TableChecksum of the rows written
+    per table (see verify_backup); metadata['timings'] has seconds and rows/s per table.
+    """
+    def dump_table(table_name):
+        started = time.perf_counter()
+        table_state = {}
+        checksum = TableChecksum()
+        previous = base_state.get(table_name, {}) if base_state is not None else None
+        with gzip.open(f"{path}.{table_name}", 'wt', encoding='utf-8') as part:
+            part.write(json.dumps({"_table": table_name}) + "\n")
+            try:
+                for row in iter_table_rows(table_name):
+                    row_id = str(row.get('id'))
+                    table_state[row_id] = row_hash(row)
+                    if previous is not None and previous.get(row_id) == table_state[row_id]:
+                        continue
+                    part.write(json.dumps(row, default=str) + "\n")
+                    checksum.add(row)
+            except Exception:
+                if table_name != 'deleted_expenses':
+                    raise
+            deleted_ids = [row_id for row_id in previous if row_id not in table_state] if previous is not None else []
+            if deleted_ids:
+                part.write(json.dumps({"_deleted": deleted_ids}) + "\n")
+        return checksum, table_state, len(deleted_ids), table_timing(len(table_state), time.perf_counter() - started)
+
+    counts = {}
+    checksums = {}
+    deleted_counts = {}
+    state = {}
+    timings = {}
+    try:
+        with ThreadPoolExecutor(max_workers=len(BACKUP_TABLES)) as pool:
+            results = dict(zip(BACKUP_TABLES, pool.map(with_client(dump_table), BACKUP_TABLES)))
+        for table_name, (checksum, table_state, deleted_count, timing) in results.items():
+            counts[table_name] = checksum.rows
+            checksums[table_name] = checksum.hexdigest()
+            state[table_name] = table_state
+            timings[table_name] = timing
+            if base_state is not None:
+                deleted_counts[table_name] = deleted_count
+        meta = {
+            'backup_date': datetime.datetime.now().isoformat(),
+            'user': user,
+            'format': 'ndjson.gz',
+            'version': BACKUP_FORMAT_VERSION,
+            'kind': 'incremental' if base_state is not None else 'full',
+            'tables': counts,
+            'total_expenses': counts['expenses'],
+            'total_rules': counts['rules'],
+            'total_categories': counts['categories'],
+            'total_subcategories': counts['subcategories'],
+            'total_people': counts['people'],
+            'checksums': checksums,
+            'timings': timings
+        }
+        if base_state is not None:
+            meta['deleted'] = deleted_counts
+        with open(path, 'wb') as out:
+            out.write(gzip.compress((json.dumps({"_metadata": meta}) + "\n").encode('utf-8')))
+            for table_name in BACKUP_TABLES:
+                with open(f"{path}.{table_name}", 'rb') as part:
+                    shutil.copyfileobj(part, out)
+    finally:
+        for table_name in BACKUP_TABLES:
+            if os.path.exists(f"{path}.{table_name}"):
+                os.remove(f"{path}.{table_name}")
+    return meta, state
+
+@profiled
+def write_parquet_backup(path, user):
+    """Write every table as a zstd-compressed Parquet file inside a zip at `path`. Returns (metadata, row_state).
+
+    Unlike JSON, `date` columns are stored as real dates and `amount` as float64.
+    A manifest.json member carries the metadata and schema version so it can be
+    read without touching the tables. Tables are fetched and encoded concurrently.
+    """
+    def encode_table(table_name):
+        started = time.perf_counter()
+        try:
+            rows = list(iter_table_rows(table_name))
+        except Exception:
+            if table_name != 'deleted_expenses':
+                raise
+            rows = []
+        table = pa.Table.from_pylist(rows) if rows else pa.table({})
+        for column, arrow_type in [('date', pa.date32()), ('amount', pa.float64())]:
+            if column in table.column_names:
+                table = table.set_column(table.column_names.index(column), column, pc.cast(table[column], arrow_type))
+        buf = io.BytesIO()
+        pq.write_table(table, buf, compression='zstd')
+        table_state = {str(row.get('id')): row_hash(row) for row in rows}
+        return buf.getvalue(), table_state, table_checksum(rows), table_timing(len(rows), time.perf_counter() - started)
+
+    counts = {}
+    checksums = {}
+    state = {}
+    timings = {}
+    with ThreadPoolExecutor(max_workers=len(BACKUP_TABLES)) as pool:
+        results = dict(zip(BACKUP_TABLES, pool.map(with_client(encode_table), BACKUP_TABLES)))
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for table_name, (data, table_state, checksum, timing) in results.items():
+            zf.writestr(f"{table_name}.parquet", data)
+            state[table_name] = table_state
+            checksums[table_name] = checksum
+            counts[table_name] = timing['rows']
+            timings[table_name] = timing
+        meta = {
+            'backup_date': datetime.datetime.now().isoformat(),
+            'user': user,
+            'format': 'parquet.zip',
+            'version': BACKUP_FORMAT_VERSION,
+            'schema_version': PARQUET_SCHEMA_VERSION,
+            'kind': 'full',
+            'tables': counts,
+            'total_expenses': counts['expenses'],
+            'total_rules': counts['rules'],
+            'total_categories': counts['categories'],
+            'total_subcategories': counts['subcategories'],
+            'total_people': counts['people'],
+            'checksums': checksums,
+            'timings': timings
+        }
+        zf.writestr("manifest.json", json.dumps({"_metadata": meta}, indent=2))
+    return meta, state
+
+def read_parquet_table(zf, table_name):
+    """Rows of one table from a Parquet backup zip, with dates turned back into ISO strings for Supabase."""
+    table = pq.read_table(io.BytesIO(zf.read(f"{table_name}.parquet")))
+    for i, field in enumerate(table.schema):
+        if pa.types.is_date(field.type) or pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, pc.cast(table[field.name], pa.string()))
+    return table.to_pylist()
+
+@profiled
+def read_backup(file):
+    """Parse a backup (gzip NDJSON or legacy JSON) into {table: rows, '_metadata': {...}}.
+
+    Incremental backups also carry '_deleted': {table: [ids]}.
+    """
+    file.seek(0)
+    magic = file.read(2)
+    if magic == b'PK':
+        backup_data = {'_metadata': read_backup_header(file)}
+        backup_data.update({table_name: list(rows) for table_name, rows in iter_backup_tables(file)})
+        return backup_data
+    if magic != b'\x1f\x8b':
+        file.seek(0)
+        return json.loads(file.read().decode('utf-8'))
+    file.seek(0)
+    backup_data = {}
+    table_name = None
+    with gzip.open(file, 'rt', encoding='utf-8') as lines:
+        for line in lines:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if '_metadata' in obj:
+                backup_data['_metadata'] = obj['_metadata']
+            elif '_table' in obj:
+                table_name = obj['_table']
+                backup_data.setdefault(table_name, [])
+            elif '_deleted' in obj:
+                backup_data.setdefault('_deleted', {})[table_name] = obj['_deleted']
+            elif table_name is not None:
+                backup_data[table_name].append(obj)
+    return backup_data
+
+def read_backup_header(file):
+    """Backup metadata without reading any rows (first NDJSON line or the Parquet zip manifest). None for legacy JSON."""
+    file.seek(0)
+    magic = file.read(2)
+    if magic == b'PK':
+        file.seek(0)
+        with zipfile.ZipFile(file) as zf:
+            return json.loads(zf.read("manifest.json")).get('_metadata')
+    if magic != b'\x1f\x8b':
+        return None
+    file.seek(0)
+    with gzip.open(file, 'rt', encoding='utf-8') as lines:
+        first = json.loads(lines.readline() or '{}')
+    file.seek(0)
+    return first.get('_metadata')
+
+def iter_backup_tables(file):
+    """Yield (table_name, rows) for each table in a backup, decoding one line at a time.
+
+    `rows` is a lazy iterator over that table's records; anything left unread is skipped
+    when the next table is requested. Parquet backups are decoded one table at a time;
+    legacy JSON backups have no line structure and are decoded whole.
+    """
+    file.seek(0)
+    magic = file.read(2)
+    if magic == b'PK':
+        if pa is None:
+            raise RuntimeError("Parquet backups need the pyarrow package")
+        file.seek(0)
+        with zipfile.ZipFile(file) as zf:
+            for table_name in BACKUP_TABLES:
+                if f"{table_name}.parquet" in zf.namelist():
+                    yield table_name, iter(read_parquet_table(zf, table_name))
+        return
+    if magic != b'\x1f\x8b':
+        file.seek(0)
+        for table_name, rows in json.loads(file.read().decode('utf-8')).items():
+            if not table_name.startswith('_'):
+                yield table_name, iter(rows)
+        return
+    file.seek(0)
+    with gzip.open(file, 'rt', encoding='utf-8') as lines:
+        records = (json.loads(line) for line in lines if line.strip())
+        marker = next(records, None)
+        while marker is not None:
+            if '_table' not in marker:
+                marker = next(records, None)
+                continue
+            following = {}
+
+            def table_rows(following=following):
+                for obj in records:
+                    if '_table' in obj:
+                        following['marker'] = obj
+                        return
+                    if '_deleted' not in obj and '_metadata' not in obj:
+                        yield obj
+
+            rows = table_rows()
+            yield marker['_table'], rows
+            for _ in rows:
+                pass
+            marker = following.get('marker')
+
+@profiled
+def verify_backup(file):
+    """Stream a backup and check every table's row count and checksum against its header.
+
+    Returns a list of problems, empty when the file is intact. Nothing is written,
+    so this runs before any restore. Backups older than checksums are only checked
+    for readability and row counts.
+    """
+    seen = set()
+    problems = []
+    try:
+        meta = read_backup_header(file) or {}
+        for table_name, rows in iter_backup_tables(file):
+            checksum = TableChecksum()
+            for row in rows:
+                checksum.add(row)
+            seen.add(table_name)
+            expected_rows = meta.get('tables', {}).get(table_name)
+            if expected_rows is not None and checksum.rows != expected_rows:
+                problems.append(f"{table_name}: {checksum.rows:,} rows, expected {expected_rows:,}")
+            elif checksum.hexdigest() != meta.get('checksums', {}).get(table_name, checksum.hexdigest()):
+                problems.append(f"{table_name}: checksum mismatch")
+        problems += [f"{table_name}: missing" for table_name in meta.get('tables', {}) if table_name not in seen]
+    except Exception as e:
+        problems.append(f"file is truncated or corrupt ({e})")
+    return problems
+
+def restore_key(table_name):
+    """Function giving the natural key restore_backup matches backup rows to existing rows on."""
+    if table_name == 'expenses':
+        # float() so 5 from Postgres and 5.0 from a typed (Parquet) backup match
+        return lambda r: f"{r.get('date')}|{r.get('description')}|{float(r['amount']) if r.get('amount') is not None else None}"
+    if table_name == 'rules':
+        return lambda r: (r.get('keyword') or '').lower()
+    return lambda r: (r.get('name') or '').lower()
+
+def restore_table(table_name, mode, batches, stats, checksum=None):
+    """Worker for restore_backup: write one table's batches as they arrive on the `batches` queue.
+
+    Runs off the main thread, so it only touches Supabase and its own `stats` dict.
+    A None on the queue ends the table. If the live table already matches the
+    backup's `checksum`, or after an error, it just drains the queue so the reader
+    never blocks on a full one.
+    """
+    finished = False
+
+    def incoming():
+        nonlocal finished
+        yield from iter(batches.get, None)
+        finished = True
+
+    def skip_identical():
+        for batch in incoming():
+            stats['unchanged'] = stats['written'] = stats['written'] + len(batch)
+
+    started = time.perf_counter()
+    try:
+        if mode == 'overwrite':
+            if checksum is not None and table_checksum(iter_table_rows(table_name)) == checksum:
+                return skip_identical()
+            writer = None
+            for batch in incoming():
+                if writer is None:
+                    sb.table(table_name).delete().gte("id", 0).execute()
+                    writer = BatchWriter(table_name, "insert")
+                for row in batch:
+                    writer.add({k: v for k, v in row.items() if k != 'id'})
+                writer.flush()
+                stats['added'] = stats['written'] = writer.count
+            return
+        key_of = restore_key(table_name)
+        existing_map = {}
+        live_checksum = TableChecksum()
+        for r in iter_table_rows(table_name):
+            existing_map[key_of(r)] = r
+            live_checksum.add(r)
+        if live_checksum.hexdigest() == checksum:
+            return skip_identical()
+        inserts = BatchWriter(table_name, "insert")
+        updates = BatchWriter(table_name, "upsert")
+        for batch in incoming():
+            for row in batch:
+                clean_row = {k: v for k, v in row.items() if k != 'id'}
+                existing = existing_map.get(key_of(row))
+                if existing is None:
+                    inserts.add(clean_row)
+                elif mode == 'prefer_backup' and table_name in ('expenses', 'rules'):
+                    # Conflicts become batched upserts keyed on id; identical rows cost no write
+                    if same_content(existing, clean_row):
+                        stats['unchanged'] += 1
+                        continue
+                    clean_row['id'] = existing['id']
+                    updates.add(clean_row)
+            stats['written'] = inserts.count + updates.count + stats['unchanged']
+        inserts.flush()
+        updates.flush()
+        stats['added'], stats['updated'] = inserts.count, updates.count
+        stats['written'] = inserts.count + updates.count + stats['unchanged']
+    except Exception as e:
+        if table_name != 'deleted_expenses':
+            stats['error'] = e
+        if not finished:
+            for _ in incoming():
+                pass
+    finally:
+        stats['seconds'] = time.perf_counter() - started
+
+def check_restore_mode(mode, kind):
+    """ValueError if a backup of this kind cannot be restored in this mode."""
+    if mode == 'overwrite' and kind == 'incremental':
+        raise ValueError(
+            "an incremental backup only holds the rows changed since the previous backup, so it cannot "
+            "replace everything - restore that point from Saved backups (it replays the whole chain)"
+        )
+
+@profiled
+def restore_backup(tables, mode, progress=None, expected=None, checksums=None, kind=None):
+    """Restore (table_name, rows) pairs from iter_backup_tables() into Supabase.
+
+    mode is 'overwrite' (empty each table the backup has rows for, then insert),
+    'prefer_backup' (add missing rows, upsert differing conflicts) or 'keep_existing'
+    (only add missing rows). `kind` is the backup's metadata kind: an incremental
+    only holds the rows changed since its parent, so it cannot overwrite (ValueError);
+    replay_backup_chain() rebuilds the full snapshot for that.
+
+    The backup is read once on this thread and each table's rows are handed, in
+    batches, to its own worker thread through a small bounded queue, so tables are
+    written concurrently while memory stays bounded. Only this thread touches
+    `progress`. Tables whose live contents match `checksums` (from a verified
+    full backup) are left untouched and counted as unchanged.
+    Returns (added_counts, updated_counts, unchanged_counts, timings).
+    """
+    check_restore_mode(mode, kind)
+    checksums = checksums or {}
+    expected_total = sum((expected or {}).values())
+    stats = {}
+
+    def report():
+        if progress is not None:
+            written = sum(table_stats['written'] for table_stats in stats.values())
+            fraction = min(1.0, written / expected_total) if expected_total else 0.0
+            progress.progress(fraction, text=f"Restoring: {written:,} rows")
+
+    with ThreadPoolExecutor(max_workers=len(BACKUP_TABLES)) as pool:
+        futures = []
+        for table_name, rows in tables:
+            if table_name not in BACKUP_TABLES or table_name in stats:
+                continue
+            if mode != 'overwrite' and table_name == 'deleted_expenses':
+                continue
+            stats[table_name] = {'added': 0, 'updated': 0, 'unchanged': 0, 'written': 0, 'read': 0}
+            batches = queue.Queue(maxsize=4)
+            futures.append(pool.submit(with_client(restore_table), table_name, mode, batches, stats[table_name], checksums.get(table_name)))
+            batch_size = RESTORE_BATCH_SIZES.get(table_name, RESTORE_BATCH_SIZE)
+            batch = []
+            try:
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        batches.put(batch)
+                        stats[table_name]['read'] += len(batch)
+                        batch = []
+                        report()
+                if batch:
+                    batches.put(batch)
+                    stats[table_name]['read'] += len(batch)
+            finally:
+                # Always end the table, even if the backup turns out corrupt, so the worker can exit
+                batches.put(None)
+        while futures and wait(futures, timeout=0.2).not_done:
+            report()
+    report()
+
+    for table_stats in stats.values():
+        if 'error' in table_stats:
+            raise table_stats['error']
+    added_counts, updated_counts, unchanged_counts, timings = {}, {}, {}, {}
+    for table_name, table_stats in stats.items():
+        if table_stats['read'] == 0 and mode == 'overwrite':
+            continue
+        count_key = 'trash' if table_name == 'deleted_expenses' else table_name
+        added_counts[count_key] = table_stats['added']
+        if mode != 'overwrite' and table_name in ('expenses', 'rules'):
+            updated_counts[table_name] = table_stats['updated']
+        if table_stats['unchanged']:
+            unchanged_counts[table_name] = table_stats['unchanged']
+        timings[table_name] = table_timing(table_stats['read'], table_stats['seconds'])
+    return added_counts, updated_counts, unchanged_counts, timings
+
+def user_backup_dir(user):
+    path = os.path.join(BACKUP_DIR, user)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def load_manifest(user):
+    """Backup chain for a user: {'chain': [entries, oldest first]}. Each entry names its file and parent."""
+    path = os.path.join(user_backup_dir(user), "manifest.json")
+    if not os.path.exists(path):
+        return {'chain': []}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(user, manifest):
+    path = os.path.join(user_backup_dir(user), "manifest.json")
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def prune_saved_backups(user, keep_full=BACKUP_KEEP_FULL):
+    """Delete saved backups older than the newest `keep_full` full ones; their incrementals stay. Returns the files removed."""
+    manifest = load_manifest(user)
+    chain = manifest['chain']
+    fulls = [i for i, entry in enumerate(chain) if entry['kind'] == 'full']
+    if len(fulls) <= max(keep_full, 1):
+        return []
+    start = fulls[-max(keep_full, 1)]
+    dropped, manifest['chain'] = chain[:start], chain[start:]
+    save_manifest(user, manifest)  # first, so the manifest never names a deleted file
+    folder = user_backup_dir(user)
+    for entry in dropped:
+        try:
+            os.remove(os.path.join(folder, entry['file']))
+        except FileNotFoundError:
+            pass
+    return [entry['file'] for entry in dropped]
+
+def load_row_state(user):
+    path = os.path.join(user_backup_dir(user), "row_state.json.gz")
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+@profiled
+def create_saved_backup(user, incremental=False, fmt='ndjson'):
+    """Write a full or incremental backup into the user's backup dir and append it to the manifest.
+
+    An incremental needs an existing chain; it stores only rows changed since the
+    row hashes recorded by the previous backup. Full backups can use fmt='parquet';
+    incrementals are always NDJSON. After BACKUP_MAX_INCREMENTALS incrementals in a
+    row a full backup is taken instead, and every full backup prunes the ones
+    prune_saved_backups() no longer keeps. Returns the manifest entry.
+    """
+    folder = user_backup_dir(user)
+    manifest = load_manifest(user)
+    chain = manifest['chain']
+    last_full = max((i for i, entry in enumerate(chain) if entry['kind'] == 'full'), default=-1)
+    if incremental and chain and len(chain) - 1 - last_full >= BACKUP_MAX_INCREMENTALS:
+        incremental = False
+    base_state = load_row_state(user) if incremental else None
+    if incremental and (base_state is None or not manifest['chain']):
+        raise ValueError("No previous backup to build an incremental on - create a full backup first.")
+    kind = 'incremental' if incremental else 'full'
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    if fmt == 'parquet' and not incremental:
+        file_name = f"supabase_backup_{stamp}_{kind}.parquet.zip"
+        meta, state = write_parquet_backup(os.path.join(folder, file_name), user)
+    else:
+        file_name = f"supabase_backup_{stamp}_{kind}.ndjson.gz"
+        meta, state = write_backup(os.path.join(folder, file_name), user, base_state=base_state)
+    entry = {
+        'file': file_name,
+        'kind': kind,
+        'parent': manifest['chain'][-1]['file'] if incremental else None,
+        'created': meta['backup_date'],
+        'meta': meta
+    }
+    manifest['chain'].append(entry)
+    with gzip.open(os.path.join(folder, "row_state.json.gz"), 'wt', encoding='utf-8') as f:
+        json.dump(state, f)
+    save_manifest(user, manifest)
+    if kind == 'full':
+        prune_saved_backups(user)
+    return entry
+
+@profiled
+def replay_backup_chain(user, upto):
+    """Rebuild the snapshot as of manifest entry `upto`: its last full backup plus every later incremental.
+
+    Every file is verified first, so a damaged link raises ValueError before anything is restored.
+    """
+    chain = load_manifest(user)['chain'][:upto + 1]
+    base = max(i for i, entry in enumerate(chain) if entry['kind'] == 'full')
+    folder = user_backup_dir(user)
+    tables = {}
+    for entry in chain[base:]:
+        with open(os.path.join(folder, entry['file']), 'rb') as f:
+            problems = verify_backup(f)
+            if problems:
+                raise ValueError(f"{entry['file']} failed verification: " + "; ".join(problems))
+            part = read_backup(f)
+        for table_name in BACKUP_TABLES:
+            rows = tables.setdefault(table_name, {})
+            for row in part.get(table_name, []):
+                rows[str(row.get('id'))] = row
+            for row_id in part.get('_deleted', {}).get(table_name, []):
+                rows.pop(row_id, None)
+    backup_data = {table_name: list(rows.values()) for table_name, rows in tables.items()}
+    backup_data['_metadata'] = dict(chain[-1]['meta'], kind='replayed', **{
+        f"total_{t}": len(backup_data[t]) for t in ['expenses', 'rules', 'categories', 'subcategories', 'people']
+    })
+    backup_data['_metadata']['tables'] = {t: len(rows) for t, rows in backup_data.items() if t != '_metadata'}
+    backup_data['_metadata']['checksums'] = {t: table_checksum(rows) for t, rows in backup_data.items() if t != '_metadata'}
+    return backup_data
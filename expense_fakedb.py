@@ -0,0 +1,241 @@
+"""In-memory stand-in for the Supabase client, for benchmarks and offline runs.
+
+Implements the part of the PostgREST query builder the app and expense_core use:
+
+    client.table(name).select(cols, count=None) / insert(rows) / upsert(rows, on_conflict='id')
+          / update(values) / delete()
+          .eq/.neq/.gt/.gte/.lt/.lte/.in_(col, ...)  .order(col, desc=False)  .range(a, b)  .limit(n)
+          .execute() -> response with .data (list of dicts) and .count
+
+Every execute() sleeps `latency_ms` (plus up to `jitter_ms`) outside the lock, so
+concurrent requests overlap like they would against a real server, and is counted
+in `requests` by (table, op). Like PostgREST, a select returns at most `max_rows`
+rows (1000 by default, None for no cap), so code that forgets to page shows up,
+and an upsert naming the same row twice fails as it does in Postgres.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+import pandas as pd
+from expense_core import EXP_COLS_REV, RULES_COLS_REV
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    """One request being built; filters are (op, column, value) applied on execute()."""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.op = None
+        self.columns = None
+        self.payload = None
+        self.on_conflict = 'id'
+        self.want_count = False
+        self.filters = []
+        self.order_by = []
+        self.bounds = None
+
+    def select(self, columns="*", count=None):
+        self.op = 'select'
+        self.columns = None if columns.strip() == "*" else [c.strip() for c in columns.split(',')]
+        self.want_count = count is not None
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.op, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, on_conflict='id', **kwargs):
+        self.op, self.payload, self.on_conflict = 'upsert', rows, on_conflict
+        return self
+
+    def update(self, values, **kwargs):
+        self.op, self.payload = 'update', values
+        return self
+
+    def delete(self, **kwargs):
+        self.op = 'delete'
+        return self
+
+    def _filter(self, op, column, value):
+        self.filters.append((op, column, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter('eq', column, value)
+
+    def neq(self, column, value):
+        return self._filter('neq', column, value)
+
+    def gt(self, column, value):
+        return self._filter('gt', column, value)
+
+    def gte(self, column, value):
+        return self._filter('gte', column, value)
+
+    def lt(self, column, value):
+        return self._filter('lt', column, value)
+
+    def lte(self, column, value):
+        return self._filter('lte', column, value)
+
+    def in_(self, column, values):
+        return self._filter('in', column, set(values))
+
+    def order(self, column, desc=False, **kwargs):
+        self.order_by.append((column, desc))
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def limit(self, size):
+        self.bounds = (0, size)
+        return self
+
+    def matches(self, row):
+        for op, column, value in self.filters:
+            cell = row.get(column)
+            if op == 'eq' and cell != value or op == 'neq' and cell == value or op == 'in' and cell not in value:
+                return False
+            if op in ('gt', 'gte', 'lt', 'lte'):
+                if cell is None:
+                    return False
+                if op == 'gt' and not cell > value or op == 'gte' and not cell >= value \
+                        or op == 'lt' and not cell < value or op == 'lte' and not cell <= value:
+                    return False
+        return True
+
+    def execute(self):
+        if self.op is None:
+            raise ValueError("execute() needs select/insert/upsert/update/delete first")
+        self.client.wait()
+        with self.client.lock:
+            self.client.requests[(self.table, self.op)] += 1
+            rows = self.client.tables.setdefault(self.table, {})
+            return getattr(self, f"_{self.op}")(rows)
+
+    def _select(self, rows):
+        found = [row for row in rows.values() if self.matches(row)]
+        for column, desc in reversed(self.order_by):
+            found.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        total = len(found)
+        if self.bounds:
+            found = found[self.bounds[0]:self.bounds[1]]
+        if self.client.max_rows is not None:
+            found = found[:self.client.max_rows]
+        if self.columns:
+            found = [{c: row.get(c) for c in self.columns} for row in found]
+        else:
+            found = [dict(row) for row in found]
+        return FakeResponse(found, total if self.want_count else None)
+
+    def _insert(self, rows):
+        out = []
+        for record in self.payload if isinstance(self.payload, list) else [self.payload]:
+            row = dict(record)
+            if row.get('id') is None:
+                row['id'] = next(self.client.ids)
+            elif row['id'] in rows:
+                raise Exception(f"duplicate key value violates unique constraint \"{self.table}_pkey\"")
+            rows[row['id']] = row
+            out.append(dict(row))
+        return FakeResponse(out)
+
+    def _upsert(self, rows):
+        key = self.on_conflict
+        records = self.payload if isinstance(self.payload, list) else [self.payload]
+        keys = [record.get(key) for record in records if record.get(key) is not None]
+        if len(keys) != len(set(keys)):
+            raise Exception("ON CONFLICT DO UPDATE command cannot affect row a second time")
+        by_key = {row.get(key): row for row in rows.values()} if key != 'id' else rows
+        out = []
+        for record in records:
+            existing = by_key.get(record.get(key)) if record.get(key) is not None else None
+            if existing is not None:
+                existing.update({c: v for c, v in record.items() if not (c == 'id' and v is None)})
+                row = existing
+            else:
+                row = dict(record)
+                if row.get('id') is None:
+                    row['id'] = next(self.client.ids)
+                rows[row['id']] = row
+                if key != 'id':
+                    by_key[row.get(key)] = row
+            out.append(dict(row))
+        return FakeResponse(out)
+
+    def _update(self, rows):
+        out = []
+        for row in rows.values():
+            if self.matches(row):
+                row.update(self.payload)
+                out.append(dict(row))
+        return FakeResponse(out)
+
+    def _delete(self, rows):
+        gone = [row_id for row_id, row in rows.items() if self.matches(row)]
+        return FakeResponse([rows.pop(row_id) for row_id in gone])
+
+class FakeSupabase:
+    """Tables are {id: row dict}; ids come from one counter shared by all tables."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, seed=None, max_rows=1000):
+        self.latency_ms = latency_ms
+        self.max_rows = max_rows
+        self.jitter_ms = jitter_ms
+        self.random = random.Random(seed)
+        self.tables = {}
+        self.ids = itertools.count(1)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def wait(self):
+        delay = self.latency_ms + (self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def take_requests(self):
+        """Requests counted since the last call, as {(table, op): n}, and reset the counter."""
+        with self.lock:
+            counts, self.requests = dict(self.requests), Counter()
+        return counts
+
+    def load_frames(self, expenses, rules_df, categories=(), subcategories=(), people=()):
+        """Seed the tables from app-shaped frames (Title-case columns, as get_expenses()/get_rules() return)."""
+        tables = {
+            'expenses': frame_records(expenses.rename(columns=EXP_COLS_REV)),
+            'rules': frame_records(rules_df.rename(columns=RULES_COLS_REV)),
+            'categories': [{'name': name} for name in categories],
+            'subcategories': [{'name': name} for name in subcategories],
+            'people': [{'name': name} for name in people],
+        }
+        with self.lock:
+            for name, records in tables.items():
+                rows = self.tables[name] = {}
+                for record in records:
+                    record['id'] = record.get('id') or next(self.ids)
+                    rows[record['id']] = record
+            top = max((row_id for rows in self.tables.values() for row_id in rows), default=0)
+            self.ids = itertools.count(max(top, next(self.ids)) + 1)
+
+def frame_records(df):
+    """JSON-ready row dicts like the API returns: dates as YYYY-MM-DD, NaN as None, native Python scalars.
+
+    Same output as expense_core.prepare_records(), vectorized for seeding large tables.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d')
+    return df.astype(object).where(df.notna(), None).to_dict('records')